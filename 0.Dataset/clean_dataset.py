@@ -1,31 +1,21 @@
-import pandas as pd
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from pipeline.cleaner import clean_recipes
 
 input_path = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\Dataset\RecipeNLG_dataset.csv"
 output_path = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\Dataset\RecipeNLG_clean.csv"
+parquet_path = os.path.splitext(output_path)[0] + ".parquet"
 
-ds = pd.read_csv(
-    input_path,
-    engine="python",
-    sep=",",
-    quotechar='"',
-    doublequote=True,
-    on_bad_lines="skip",
-    dtype=str,
-    keep_default_na=False
-)
-
-# rinomina la colonna id (se nel file è "Unnamed: 0")
-if "Unnamed: 0" in ds.columns:
-    ds.rename(columns={"Unnamed: 0": "id"}, inplace=True)
-
-# tieni solo le colonne che ti servono (aggiungi/togli a piacere)
-cols = ["id","title", "ingredients", "directions"]
-cols = [c for c in cols if c in ds.columns]  # evita errori se una colonna manca
-ds_clean = ds[cols].copy()
+# tieni solo le colonne che ti servono (aggiungi/togli a piacere):
+# vengono lette solo queste, a blocchi, senza caricare tutto il file in RAM
+cols = ["id", "title", "ingredients", "directions"]
 
-# salva
-ds_clean.to_csv(output_path, index=False)
+if __name__ == "__main__":
+    stats = clean_recipes(input_path, output_path, parquet_path, columns=cols)
 
-print("Salvato:", output_path)
-print("Righe, Colonne:", ds_clean.shape)
-print("Colonne:", ds_clean.columns.tolist())
+    print("Salvato:", output_path, "+", parquet_path)
+    print("Righe, Colonne:", (stats["rows"], len(stats["columns"])))
+    print("Colonne:", stats["columns"])
+    print(f"Tempo: {stats['seconds']}s ({stats['rows_per_sec']} righe/s), picco RSS: {stats['peak_rss_mb']:.0f} MB")
@@ -1,153 +1,25 @@
-import json
-import re
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, StoppingCriteria, StoppingCriteriaList
+import os
+import sys
 
-class StopOnCompleteJson(StoppingCriteria):
-    def __init__(self, tokenizer, start_len: int):
-        self.tokenizer = tokenizer
-        self.start_len = start_len
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from pipeline import engine, scoring, splits
+from pipeline.profiles import get_profile
 
-    def __call__(self, input_ids, scores, **kwargs) -> bool:
-        # decodifica solo la parte generata
-        gen_ids = input_ids[0][self.start_len:]
-        text = self.tokenizer.decode(gen_ids, skip_special_tokens=True)
+# parametri del modello (id, dtype, attention, budget, prompt): pipeline/profiles.py
+PROFILE = get_profile("mistral")
 
-        start = text.find("{")
-        if start == -1:
-            return False
+# quante ricette passano insieme in una chiamata a generate
+BATCH_SIZE = 8
+# decoding vincolato allo schema {title, ingredients, steps}: niente JSON rotto
+# né retry. False = generazione libera (come nelle misure della relazione)
+CONSTRAINED = True
+# `python <script> --resume` riprende un run interrotto da recipes_extracted.jsonl
+RESUME = "--resume" in sys.argv
+# `--cache`: riusa gli output gia' generati (pipeline/gen_cache.py), es. dopo aver cambiato solo il parsing
+CACHE = "--cache" in sys.argv
 
-        depth = 0
-        in_str = False
-        esc = False
-
-        # percorre dal primo '{' e chiude al matching '}'
-        for ch in text[start:]:
-            if in_str:
-                if esc:
-                    esc = False
-                elif ch == "\\":
-                    esc = True
-                elif ch == '"':
-                    in_str = False
-            else:
-                if ch == '"':
-                    in_str = True
-                elif ch == "{":
-                    depth += 1
-                elif ch == "}":
-                    depth -= 1
-                    if depth == 0:
-                        return True  # JSON completo
-
-        return False
-
-torch.backends.cuda.matmul.allow_tf32 = True
-torch.set_float32_matmul_precision("high")
-
-
-MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.3"
-
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print("CUDA available:", torch.cuda.is_available())
-
-def strip_code_fences(s: str) -> str:
-    # rimuove eventuali ```json ... ``` che il modello a volte aggiunge
-    s = re.sub(r"```(?:json)?\s*", "", s, flags=re.IGNORECASE)
-    s = s.replace("```", "")
-    return s.strip()
-
-def extract_first_json_block(s: str):
-    """
-    Estrae il primo blocco JSON completo { ... }.
-    Gestisce correttamente { } dentro stringhe JSON (tra " ").
-    """
-    s = strip_code_fences(s)
-    start = s.find("{")
-    if start == -1:
-        return None
-
-    depth = 0
-    in_str = False
-    esc = False
-
-    for i in range(start, len(s)):
-        ch = s[i]
-
-        if in_str:
-            if esc:
-                esc = False
-            elif ch == "\\":
-                esc = True
-            elif ch == '"':
-                in_str = False
-        else:
-            if ch == '"':
-                in_str = True
-            elif ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    return s[start : i + 1]
-
-    return None
-
-tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, trust_remote_code=True)
-config = AutoConfig.from_pretrained(MODEL_ID, trust_remote_code=True)
-
-# Fix rope_scaling edge-cases that can break loading in some environments
-rs = getattr(config, "rope_scaling", None)
-if isinstance(rs, dict):
-    if "type" not in rs and "rope_type" in rs:
-        rs["type"] = rs["rope_type"]
-    if rs.get("type") in (None, "default", "linear", "dynamic"):
-        config.rope_scaling = None
-
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_ID,
-    config=config,
-    trust_remote_code=True,
-    torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-    device_map="auto" if device == "cuda" else None,
-    attn_implementation="sdpa",
-)
-model.eval()
-if device == "cpu":
-    model = model.to(device)
-
-SYSTEM = (
-    "You are an information extraction engine.\n"
-    "Input: a raw recipe written in natural language.\n"
-    "Output: ONLY valid JSON with EXACTLY these keys: title, ingredients, steps.\n"
-    "No extra text.\n\n"
-    "Extraction rules:\n"
-    "- title: use an explicit title if present; otherwise infer a short, non-empty title from the recipe; if impossible use \"\".\n"
-    "- ingredients: list ONLY ingredients mentioned in the text. Keep quantities if present (e.g., \"200g spaghetti\").\n"
-    "- steps: ordered list of cooking actions derived from the text, split into multiple short imperative steps.\n"
-    "- Use double quotes for all strings. No trailing commas. Valid JSON.\n"
-    "- Do not add any keys besides title, ingredients, steps.\n"
-    "Start your answer with '{' and end with '}'.\n\n"
-    "Do NOT wrap the JSON in markdown code fences (no ```json and no ```).\n"
-    "Output must be plain JSON text only.\n\n"
-    "End the output immediately after the closing '}'.\n\n"
-    "JSON format:\n"
-    "{\n"
-    "  \"title\": \"...\",\n"
-    "  \"ingredients\": [\"...\"],\n"
-    "  \"steps\": [\"...\"]\n"
-    "}\n"
-)
-
-RETRY_SYSTEM = (
-    SYSTEM
-    + "\nIMPORTANT:\n"
-      "- Your previous output was invalid or cut off.\n"
-      "- Return ONLY ONE complete JSON object.\n"
-      "- Ensure it is valid JSON and fully closed.\n"
-      "- Do not add any extra commentary.\n"
-      "- End immediately after the final '}'.\n"
-)
+OUT_DIR = os.path.dirname(os.path.abspath(__file__))
+OUT_JSONL = os.path.join(OUT_DIR, "recipes_extracted.jsonl")
 
 RECIPES = [
     "No-Bake Nut Cookies. In a heavy two-quart saucepan, combine 1 cup firmly packed brown sugar, 1/2 cup evaporated milk, 2 tablespoons butter or margarine, and 1/2 cup broken pecans. Cook over medium heat, stirring constantly, until the mixture bubbles across the surface. Continue boiling and stirring for 5 minutes. Remove from heat and stir in 1/2 teaspoon vanilla, then add 3 1/2 cups bite-size shredded rice biscuits and mix thoroughly. Using two teaspoons, drop the mixture onto wax paper to form about 30 clusters. Let stand for approximately 30 minutes, until firm.",
@@ -203,89 +75,16 @@ RECIPES = [
 ]
 
 
-def generate_once(recipe_text: str, max_new_tokens: int, system_text: str):
-    messages = [
-        {"role": "system", "content": system_text},
-        {"role": "user", "content": "Recipe text:\n" + recipe_text},
-    ]
-
-    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = tokenizer(prompt, return_tensors="pt").to(device)
-    start_len = inputs["input_ids"].shape[1]
-
-    stopping = StoppingCriteriaList([StopOnCompleteJson(tokenizer, start_len)])
-
-    with torch.inference_mode():
-        out = model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=False,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=tokenizer.eos_token_id,
-            stopping_criteria=stopping,   # <-- STOP qui
-        )
-
-    gen_ids = out[0][start_len:]
-    return tokenizer.decode(gen_ids, skip_special_tokens=True)
-
-def try_parse(decoded: str):
-    json_str = extract_first_json_block(decoded)
-    if json_str is None:
-        return None, "no_json", None
-
-    try:
-        obj = json.loads(json_str)
-    except json.JSONDecodeError:
-        return None, "invalid_json", json_str
-
-    if set(obj.keys()) != {"title", "ingredients", "steps"}:
-        return None, "bad_keys", json_str
-
-    return obj, None, json_str
-
-def run_extraction(recipes):
-    results = []
-    failures = []
-
-    for i, recipe_text in enumerate(recipes):
-        print(f"\n=== Processing recipe {i+1}/{len(recipes)} ===")
-
-        # 1) primo tentativo
-        decoded = generate_once(recipe_text, max_new_tokens=300, system_text=SYSTEM)
-        obj, err, json_str = try_parse(decoded)
-
-        # 2) retry “vero” se serve
-        if obj is None:
-            decoded_retry = generate_once(recipe_text, max_new_tokens=600, system_text=RETRY_SYSTEM)
-            decoded = decoded_retry
-            obj, err, json_str = try_parse(decoded)
-
-        if obj is None:
-            print("❌ Failed:", err)
-            failures.append({
-                "index": i,
-                "reason": err,
-                "recipe_text": recipe_text,
-                "raw": decoded,
-                "json_str": json_str,
-            })
-            continue
-
-        results.append(obj)
-        print("✅ OK:", obj.get("title", ""))
-
-    return results, failures
-
 if __name__ == "__main__":
-    results, failures = run_extraction(RECIPES)
-
-    with open("recipes_extracted.json", "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
-
-    with open("recipes_failures.json", "w", encoding="utf-8") as f:
-        json.dump(failures, f, ensure_ascii=False, indent=2)
-
-    print("\n=== DONE ===")
-    print("Extracted:", len(results), "/", len(RECIPES))
-    print("Failures:", len(failures))
-    print("Saved: recipes_extracted.json and recipes_failures.json")
\ No newline at end of file
+    if CACHE:
+        engine.use_generation_cache()
+
+    # RECIPES = ricette 0-49, in ordine di id: ogni record in OUT_JSONL porta il suo recipe id
+    ids = splits.ids_in("inference")
+    results, failures = engine.run_extraction(
+        PROFILE, RECIPES, batch_size=BATCH_SIZE, constrained=CONSTRAINED, jsonl_path=OUT_JSONL, resume=RESUME,
+        ids=ids, stage="inferenza",
+    )
+    engine.save_outputs(OUT_DIR, results, failures, len(RECIPES))
+    # SINTASSI / STRUTTURA / SEMANTICA contro D1, join per id sui record di OUT_JSONL
+    scoring.score_run(OUT_JSONL, ids, index_base=0)
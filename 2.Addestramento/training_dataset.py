@@ -1,73 +1,48 @@
-import re
-import ast
-import json
-import pandas as pd
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from pipeline import validation
+from pipeline.d3_builder import build_d3
 
 # Percorsi
 CSV_PATH = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\Dataset\RecipeNLG_dataset.csv"
 TXT_PATH = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\Dataset\Dataset_testuale.txt"
 OUT_CSV  = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\Dataset\Training_Dataset_Clean.csv"
 
-# --- 1) Caricamento Dataset Strutturato ---
-print("Caricamento RecipeNLG...")
-ds = pd.read_csv(CSV_PATH, engine="python", on_bad_lines="skip", dtype=str, keep_default_na=False)
-if "Unnamed: 0" in ds.columns: ds.rename(columns={"Unnamed: 0": "id"}, inplace=True)
-
-# --- 2) Parsing Dataset Testuale (Logica anti-fusione) ---
-print("Parsing Dataset_testuale.txt...")
-with open(TXT_PATH, "r", encoding="utf-8", errors="replace") as f:
-    raw_txt = f.read()
-
-# Questa regex garantisce che il testo venga preso integralmente dall'ID X all'ID Y
-recipe_pattern = re.compile(r"i?ID\s+(\d+)\s*[—-]*\s*(.*?)(?=i?ID\s+\d+|$)", re.DOTALL | re.IGNORECASE)
-id_to_text = {int(m[0]): m[1].strip() for m in recipe_pattern.findall(raw_txt)}
-
-# --- 3) Selezione Intervallo Fisso (50 -> 900) ---
-# Tagliamo i primi 50 e gli ultimi 100 dalle prime 1000 righe
-df_subset = ds.iloc[50:900].copy()
-
-# --- 4) Definizione Blacklist (Ricette corrotte nell'intervallo 50-900) ---
-ID_DA_ESCLUDERE = [
-    25, 261, 380, 383, 585, 619, 674, 844, 851, 899, 902, 993, 994, 999
-]
-
-# --- 5) Creazione Dataset Finale ---
-final_data = []
-
-print("Pulizia e validazione finale...")
-for _, row in df_subset.iterrows():
-    rid = int(row["id"])
-    
-    # Se l'ID è nella blacklist o non ha testo nel TXT, lo saltiamo
-    if rid in ID_DA_ESCLUDERE or rid not in id_to_text:
-        continue
-    
-    # Prepariamo il JSON
-    try:
-        ing = ast.literal_eval(row["ingredients"])
-        steps = ast.literal_eval(row["directions"])
-    except:
-        continue # Salta se il formato lista è rotto nel sorgente
-        
-    json_str = json.dumps({
-        "title": row["title"].strip(),
-        "ingredients": ing,
-        "directions": steps
-    }, ensure_ascii=False)
-    
-    final_data.append({
-        "id": rid,
-        "text": id_to_text[rid],
-        "json": json_str
-    })
-
-# Salvataggio
-df_final = pd.DataFrame(final_data)
-df_final.to_csv(OUT_CSV, index=False, encoding="utf-8")
-
-# --- Report ---
-print("-" * 30)
-print(f"PROCESSO COMPLETATO")
-print(f"Ricette originali nel range 50-900: 850")
-print(f"Ricette rimosse perché corrotte/mancanti: {850 - len(df_final)}")
-print(f"Numero finale record salvati: {len(df_final)}")
\ No newline at end of file
+# --- Selezione: le prime 1001 righe (D1), solo gli id di train/validation ---
+# le prime 50 (inferenza) e le ultime 101 (test) le esclude il manifest degli
+# split (pipeline/splits.py), lo stesso che leggono training e valutazione
+# (START = 0, STOP = None: tutto il CSV, anche i ~2M di RecipeNLG, a memoria costante)
+START, STOP = 0, 1001
+SPLITS = ("train", "validation")
+
+# --- Ricette corrotte: le scarta pipeline/validation.py (titolo/ingredienti/passi che
+# non corrispondono al testo di D2, liste vuote o rotte, due ricette sotto lo stesso id);
+# report completo: python -m pipeline.validation
+VALIDA = True
+
+# --- Blacklist (Ricette corrotte nell'intervallo 50-900) ---
+# i controlli automatici ne riconoscono solo una parte (validation.KNOWN_EXCEPTIONS:
+# ricette scherzo, non alimentari, passi ridotti a una nota): resta esclusa a mano
+ID_DA_ESCLUDERE = list(validation.BLACKLIST)
+
+# CSV letto a blocchi (parser C), D2 scorso in parallelo, liste parsate in un pool di processi
+CHUNKSIZE = 20_000
+WORKERS = None  # None = cpu_count() - 1
+
+if __name__ == "__main__":
+    print("Costruzione dataset di training (streaming)...")
+    stats = build_d3(CSV_PATH, TXT_PATH, OUT_CSV, start=START, stop=STOP, exclude=ID_DA_ESCLUDERE, validate=VALIDA,
+                     chunksize=CHUNKSIZE, workers=WORKERS, splits=SPLITS)
+
+    # --- Report ---
+    print("-" * 30)
+    print(f"PROCESSO COMPLETATO")
+    print(f"Ricette nel range {START}-{STOP}: {stats['rows']} (di inferenza/test: {stats['other_split']})")
+    print(f"Ricette rimosse perché corrotte/mancanti: {stats['rows'] - stats['other_split'] - stats['written']}")
+    print(f"  (blacklist: {stats['excluded']}, corrotte: {stats.get('corrupt', 0)}, senza testo: {stats['missing_text']}, "
+          f"liste rotte: {stats['broken_lists']})")
+    for key in sorted(k for k in stats if k.startswith("corrupt_") and stats[k]):
+        print(f"    {key[len('corrupt_'):]}: {stats[key]}")
+    print(f"Numero finale record salvati: {stats['written']} in {stats['seconds']}s")
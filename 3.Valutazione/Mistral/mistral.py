@@ -2,109 +2,40 @@ import os
 os.environ["TRANSFORMERS_NO_TF"] = "1"
 os.environ["TRANSFORMERS_NO_FLAX"] = "1"
 
-import re
-import json
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
-from peft import PeftModel
+import sys
 
-from transformers import StoppingCriteria,StoppingCriteriaList
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from pipeline import engine, export, scoring, splits
+from pipeline.profiles import get_profile
 
-
-class StopOnJsonObjectEnd(StoppingCriteria):
-    def __init__(self, tokenizer, start_len: int):
-        self.tokenizer = tokenizer
-
-        self.depth = 0
-        self.in_str = False
-        self.esc = False
-        self.started = False
-
-        self.prev_len = start_len  # IMPORTANT: ignora il prompt!
-
-    def __call__(self, input_ids, scores, **kwargs):
-        ids = input_ids[0]
-        cur_len = ids.shape[0]
-
-        if cur_len <= self.prev_len:
-            return False
-
-        new_ids = ids[self.prev_len:cur_len]
-        self.prev_len = cur_len
-
-        chunk = self.tokenizer.decode(new_ids, skip_special_tokens=False)
-
-        for ch in chunk:
-            if not self.started:
-                if ch == "{":
-                    self.started = True
-                    self.depth = 1
-                continue
-
-            if self.in_str:
-                if self.esc:
-                    self.esc = False
-                elif ch == "\\":
-                    self.esc = True
-                elif ch == '"':
-                    self.in_str = False
-            else:
-                if ch == '"':
-                    self.in_str = True
-                elif ch == "{":
-                    self.depth += 1
-                elif ch == "}":
-                    self.depth -= 1
-                    if self.depth == 0:
-                        return True
-
-        return False
- 
-# -----------------------
+# =======================
 # CONFIG
-# -----------------------
-BASE_MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.3"
-
-ADAPTER_DIR = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\2.Addestramento\Mistral\mistral-recipe-json-model"
-OUT_DIR = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\3.Valutazione\Mistral"
-
-OFFLOAD_DIR = os.path.join(OUT_DIR, "offload")
-os.makedirs(OUT_DIR, exist_ok=True)
-os.makedirs(OFFLOAD_DIR, exist_ok=True)
+# =======================
+# modello base + adapter salvato da 2.Addestramento: pipeline/profiles.py.
+# Se c'e' il checkpoint unito (python -m pipeline.export --profile mistral-ft) si carica
+# direttamente quello, senza PeftModel ne' offload; `--adapter` forza base + adapter
+PROFILE = get_profile("mistral-ft") if "--adapter" in sys.argv else export.resolve(get_profile("mistral-ft"))
 
-# Output files (stesso stile di Phi-3)
-OUT_JSON  = os.path.join(OUT_DIR, "recipes_extracted.json")
-OUT_FAIL  = os.path.join(OUT_DIR, "recipes_failures.json")
+OUT_DIR = os.path.dirname(os.path.abspath(__file__))
 OUT_JSONL = os.path.join(OUT_DIR, "recipes_extracted.jsonl")
 
-MAX_NEW_TOKENS = 768
-TEMPERATURE = 0.0
-TOP_P = 1.0
-
-SYSTEM = (
-    "You are an information extraction engine.\n"
-    "Input: a raw recipe written in natural language.\n"
-    "Output: ONLY valid JSON with EXACTLY these keys: title, ingredients, steps.\n"
-    "No extra text.\n\n"
-    "Extraction rules:\n"
-    "- title: use an explicit title if present; otherwise infer a short, non-empty title from the recipe; if impossible use \"\".\n"
-    "- ingredients: list ONLY ingredients mentioned in the text. Keep quantities if present (e.g., \"200g spaghetti\").\n"
-    "- steps: ordered list of cooking actions derived from the text, split into multiple short imperative steps.\n"
-    "- Use double quotes for all strings. No trailing commas. Valid JSON.\n"
-    "- Do not add any keys besides title, ingredients, steps.\n"
-    "Start your answer with '{' and end with '}'.\n\n"
-    "Do NOT wrap the JSON in markdown code fences (no ```json and no ```).\n"
-    "Output must be plain JSON text only.\n\n"
-    "End the output immediately after the closing '}'.\n\n"
-    "JSON format:\n"
-    "{\n"
-    "  \"title\": \"...\",\n"
-    "  \"ingredients\": [\"...\"],\n"
-    "  \"steps\": [\"...\"]\n"
-    "}\n"
-)
-
-
+# quante ricette passano insieme in una chiamata a generate
+BATCH_SIZE = 8
+# decoding vincolato allo schema {title, ingredients, steps}: niente JSON rotto
+# né retry. False = generazione libera (come nelle misure della relazione)
+CONSTRAINED = True
+# `python <script> --resume` riprende un run interrotto: salta gli id gia' riusciti in OUT_JSONL
+RESUME = "--resume" in sys.argv
+# `--cache`: riusa gli output gia' generati (pipeline/gen_cache.py), es. dopo aver cambiato solo il parsing
+CACHE = "--cache" in sys.argv
+# `--split`: invece di RECIPES, le ricette di inferenza + test lette da D2.txt per id
+# secondo il manifest degli split (pipeline/splits.py); risultati per id in SPLIT_JSONL
+SPLIT = "--split" in sys.argv
+SPLIT_JSONL = os.path.join(OUT_DIR, "recipes_split.jsonl")
+
+# =======================
+# INCOLLA QUI LE TUE RICETTE
+# =======================
 RECIPES = [
     # --- LE PRIME 50 RICETTE ---
     "No-Bake Nut Cookies. In a heavy two-quart saucepan, combine 1 cup firmly packed brown sugar, 1/2 cup evaporated milk, 2 tablespoons butter or margarine, and 1/2 cup broken pecans. Cook over medium heat, stirring constantly, until the mixture bubbles across the surface. Continue boiling and stirring for 5 minutes. Remove from heat and stir in 1/2 teaspoon vanilla, then add 3 1/2 cups bite-size shredded rice biscuits and mix thoroughly. Using two teaspoons, drop the mixture onto wax paper to form about 30 clusters. Let stand for approximately 30 minutes, until firm.",
@@ -262,220 +193,47 @@ RECIPES = [
     "Hidden Valley Ranch Oyster Crackers. Mix 1 pkg. Hidden Valley Ranch salad dressing mix with 3/4 to 1 c. salad oil, add 1/4 tsp. lemon pepper, 1/2 to 1 tsp. dill weed, and 1/4 tsp. garlic powder, pour over 12 to 16 oz. plain oyster crackers and stir to coat, then warm in a very low oven for 15 to 20 minutes."
 ]
 
-# -----------------------
-# LOAD MODEL (4-bit) + ADAPTER
-# -----------------------
-def load_model_and_tokenizer():
-    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
-    compute_dtype = torch.bfloat16 if use_bf16 else torch.float16
-
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_use_double_quant=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=compute_dtype,
-    )
-
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_ID, trust_remote_code=True)
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.pad_token_id = tokenizer.eos_token_id
-
-    base = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL_ID,
-        quantization_config=bnb_config,
-        device_map="auto",
-        trust_remote_code=True,
-        attn_implementation="sdpa",
-    )
-
-    model = PeftModel.from_pretrained(
-        base,
-        ADAPTER_DIR,
-        offload_dir=OFFLOAD_DIR,
-    )
-
-    model.eval()
-    return model, tokenizer
-
-
-# -----------------------
-# HELPERS
-# -----------------------
-def strip_code_fences(s: str) -> str:
-    s = re.sub(r"```(?:json)?\s*", "", s, flags=re.IGNORECASE)
-    s = s.replace("```", "")
-    return s.strip()
-
-def extract_first_json_block(s: str):
-    """
-    Estrae il primo blocco JSON completo { ... }.
-    Gestisce correttamente { } dentro stringhe JSON (tra " ").
-    """
-    s = strip_code_fences(s)
-    start = s.find("{")
-    if start == -1:
-        return None
-
-    depth = 0
-    in_str = False
-    esc = False
-
-    for i in range(start, len(s)):
-        ch = s[i]
-
-        if in_str:
-            if esc:
-                esc = False
-            elif ch == "\\":
-                esc = True
-            elif ch == '"':
-                in_str = False
-        else:
-            if ch == '"':
-                in_str = True
-            elif ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    return s[start : i + 1]
-
-    return None
-
-def try_parse(decoded: str):
-    json_str = extract_first_json_block(decoded)
-    if json_str is None:
-        return None, "no_json", None
-
-    try:
-        obj = json.loads(json_str)
-    except json.JSONDecodeError as e:
-        return None, f"invalid_json: {e}", json_str
-
-    # alias: directions -> steps (nel caso raro)
-    if "steps" not in obj and "directions" in obj:
-        obj["steps"] = obj.pop("directions")
-
-    # tieni SOLO le chiavi richieste
-    obj = {
-        "title": obj.get("title", ""),
-        "ingredients": obj.get("ingredients", []),
-        "steps": obj.get("steps", []),
-    }
-
-    if not isinstance(obj["title"], str) or not isinstance(obj["ingredients"], list) or not isinstance(obj["steps"], list):
-        return None, "bad_types", json_str
-
-    return obj, None, json_str
-
-@torch.no_grad()
-def infer_one(model, tokenizer, recipe_text: str) -> dict:
-    messages = [
-    {"role": "system", "content": SYSTEM},
-    {"role": "user", "content": recipe_text + "\n\nReturn ONLY JSON. Start now:\n"},
-]
-
-    prompt = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True
-    )
-
-    # IMPORTANTE: con device_map="auto" + offload è più robusto NON forzare .to(device)
-    inputs = tokenizer(prompt, return_tensors="pt")
-    input_len = inputs["input_ids"].shape[1]
-    max_total = getattr(model.config, "max_position_embeddings", 2048)
-
-    max_new = max(256, min(1200, max_total - input_len - 8))
-
-    # Metti gli input sul device del modello (tipicamente cuda:0)
-    first_param_device = next(model.parameters()).device
-    inputs = {k: v.to(first_param_device) for k, v in inputs.items()}
-
-    prompt_len = inputs["input_ids"].shape[1]
-    stoppers = StoppingCriteriaList([StopOnJsonObjectEnd(tokenizer, start_len=prompt_len)])
-
-    gen = model.generate(
-        **inputs,
-        max_new_tokens=max_new,
-        do_sample=False,
-        eos_token_id=tokenizer.eos_token_id,
-        pad_token_id=tokenizer.pad_token_id,
-        stopping_criteria=stoppers,
-    )
-
-    gen_tokens = gen[0][prompt_len:]
-    gen_text = tokenizer.decode(gen_tokens, skip_special_tokens=False).strip()
-
 
-    obj, err, json_str = try_parse(gen_text)
-    if obj is None:
-        return {
-            "_error": err,
-            "_raw": gen_text,
-            "_json_text": json_str if json_str is not None else "",
-        }
-
-    return obj
-
-def run_extraction(recipes, model, tokenizer):
-    results = []
-    failures = []
-
-    for i, recipe_text in enumerate(recipes, start=1):
-        print(f"\n=== Processing recipe {i}/{len(recipes)} ===")
-        out = infer_one(model, tokenizer, recipe_text)
-
-        if "_error" in out:
-            print("❌ Failed:", out["_error"])
-            failures.append({
-                "index": i,
-                "reason": out["_error"],
-                "recipe_text": recipe_text,
-                "raw": out.get("_raw", ""),
-                "json_str": out.get("_json_text", ""),
-            })
-            continue
-
-        results.append(out)
-        print("✅ OK:", out.get("title", ""))
-
-        # salva anche jsonl (comodo per debug)
-        with open(OUT_JSONL, "a", encoding="utf-8") as f:
-            f.write(json.dumps(
-                {"index": i, "input": recipe_text, "output": out},
-                ensure_ascii=False
-            ) + "\n")
-
-    return results, failures
-
-
-# -----------------------
-# MAIN
-# -----------------------
 if __name__ == "__main__":
+    if SPLIT:
+        if CACHE:
+            engine.use_generation_cache()
+        engine.run_extraction_stream(
+            PROFILE,
+            splits.records("inference", "test"),
+            SPLIT_JSONL,
+            os.path.join(OUT_DIR, "recipes_split_failures.jsonl"),
+            batch_size=BATCH_SIZE,
+            constrained=CONSTRAINED,
+            resume=RESUME,
+            stage="valutazione",
+        )
+        scoring.score_run(SPLIT_JSONL, None, report_path=os.path.join(OUT_DIR, "scores_split.csv"))
+        raise SystemExit(0)
+
     if not RECIPES:
-        print("RECIPES è vuoto.")
+        print("RECIPES è vuoto. Incolla la lista RECIPES nel file.")
         raise SystemExit(1)
 
-    # azzera il jsonl ad ogni run
-    if os.path.exists(OUT_JSONL):
-        os.remove(OUT_JSONL)
-
-    model, tokenizer = load_model_and_tokenizer()
-
-    results, failures = run_extraction(RECIPES, model, tokenizer)
-
-    with open(OUT_JSON, "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
-
-    with open(OUT_FAIL, "w", encoding="utf-8") as f:
-        json.dump(failures, f, ensure_ascii=False, indent=2)
-
-    print("\n=== DONE ===")
-    print("Extracted:", len(results), "/", len(RECIPES))
-    print("Failures:", len(failures))
-    print(f"Saved: {OUT_JSON} and {OUT_FAIL}")
+    # senza --resume il jsonl viene azzerato
+    if CACHE:
+        engine.use_generation_cache()
+
+    # RECIPES sono le ricette di inferenza (0-49) + test (900-1000) in ordine di id
+    ids = splits.ids_in("inference", "test")
+    results, failures = engine.run_extraction(
+        PROFILE,
+        RECIPES,
+        batch_size=BATCH_SIZE,
+        constrained=CONSTRAINED,
+        index_base=1,
+        jsonl_path=OUT_JSONL,
+        resume=RESUME,
+        ids=ids,
+        stage="valutazione",
+    )
+    engine.save_outputs(OUT_DIR, results, failures, len(RECIPES))
     print(f"Also saved JSONL: {OUT_JSONL}")
 
+    # SINTASSI / STRUTTURA / SEMANTICA contro D1, join per id sui record di OUT_JSONL
+    scoring.score_run(OUT_JSONL, ids, index_base=1)
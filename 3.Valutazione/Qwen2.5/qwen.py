@@ -2,169 +2,36 @@ import os
 os.environ["TRANSFORMERS_NO_TF"] = "1"
 os.environ["TRANSFORMERS_NO_FLAX"] = "1"
 
-import json
-import re
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from pipeline import engine, export, scoring, splits
+from pipeline.profiles import get_profile
 
 # =======================
 # CONFIG
 # =======================
-BASE_MODEL_ID = "Qwen/Qwen2.5-1.5B-Instruct"
-
-# cartella dove hai salvato adapter + tokenizer con save_pretrained(OUTPUT_DIR)
-ADAPTER_DIR = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\2.Addestramento\Qwen2.5\qwen-recipe-json-model"
+# modello base + adapter salvato da 2.Addestramento: pipeline/profiles.py.
+# Se c'e' il checkpoint unito (python -m pipeline.export --profile qwen2.5-ft) si carica
+# direttamente quello, senza PeftModel ne' offload; `--adapter` forza base + adapter
+PROFILE = get_profile("qwen2.5-ft") if "--adapter" in sys.argv else export.resolve(get_profile("qwen2.5-ft"))
 
-OUT_DIR = r"C:\Users\tomas\Desktop\universita\Magistrale\Secondo Anno\Primo Semestre\Deep Learning\Progetto\3.Valutazione\Qwen2.5"
-os.makedirs(OUT_DIR, exist_ok=True)
-
-OUT_JSON = os.path.join(OUT_DIR, "recipes_extracted.json")
-OUT_FAIL = os.path.join(OUT_DIR, "recipes_failures.json")
+OUT_DIR = os.path.dirname(os.path.abspath(__file__))
 OUT_JSONL = os.path.join(OUT_DIR, "recipes_extracted.jsonl")
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print("CUDA available:", torch.cuda.is_available())
-
-# =======================
-# TEXT HELPERS
-# =======================
-def strip_code_fences(s: str) -> str:
-    s = re.sub(r"```(?:json)?\s*", "", s, flags=re.IGNORECASE)
-    s = s.replace("```", "")
-    return s.strip()
-
-def extract_first_json_block(s: str):
-    """
-    Estrae il primo blocco JSON completo { ... }.
-    Gestisce correttamente { } dentro stringhe JSON (tra " ").
-    """
-    s = strip_code_fences(s)
-    start = s.find("{")
-    if start == -1:
-        return None
-
-    depth = 0
-    in_str = False
-    esc = False
-
-    for i in range(start, len(s)):
-        ch = s[i]
-
-        if in_str:
-            if esc:
-                esc = False
-            elif ch == "\\":
-                esc = True
-            elif ch == '"':
-                in_str = False
-        else:
-            if ch == '"':
-                in_str = True
-            elif ch == "{":
-                depth += 1
-            elif ch == "}":
-                depth -= 1
-                if depth == 0:
-                    return s[start : i + 1]
-
-    return None
-
-def try_parse(decoded: str):
-    json_str = extract_first_json_block(decoded)
-    if json_str is None:
-        return None, "no_json", None
-
-    try:
-        obj = json.loads(json_str)
-    except json.JSONDecodeError as e:
-        return None, f"invalid_json: {e}", json_str
-
-    # alias: directions -> steps
-    if "steps" not in obj and "directions" in obj:
-        obj["steps"] = obj.pop("directions")
-
-    # prendi SOLO le chiavi che ti servono (ignora eventuali extra)
-    obj = {
-        "title": obj.get("title", ""),
-        "ingredients": obj.get("ingredients", []),
-        "steps": obj.get("steps", []),
-    }
-
-    # sanity check tipi
-    if not isinstance(obj["title"], str) or not isinstance(obj["ingredients"], list) or not isinstance(obj["steps"], list):
-        return None, "bad_types", json_str
-
-    return obj, None, json_str
-
-# =======================
-# LOAD TOKENIZER + MODEL + ADAPTER
-# =======================
-tokenizer = AutoTokenizer.from_pretrained(ADAPTER_DIR, trust_remote_code=True)
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-tokenizer.pad_token_id = tokenizer.eos_token_id
-
-
-dtype = torch.float16 if device == "cuda" else torch.float32
-
-base_model = AutoModelForCausalLM.from_pretrained(
-    BASE_MODEL_ID,
-    trust_remote_code=True,
-    torch_dtype=dtype,
-    device_map="auto" if device == "cuda" else None,
-    attn_implementation="eager",
-)
-
-model = PeftModel.from_pretrained(base_model, ADAPTER_DIR)
-model.eval()
-
-if device == "cpu":
-    model = model.to(device)
-
-# =======================
-# PROMPT
-# =======================
-SYSTEM = (
-    "You are an information extraction engine.\n"
-    "Input: a raw recipe written in natural language.\n"
-    "Output: ONLY valid JSON with EXACTLY these keys: title, ingredients, steps.\n"
-    "No extra text.\n\n"
-    "Extraction rules:\n"
-    "- title: use an explicit title if present; otherwise infer a short, non-empty title from the recipe; if impossible use \"\".\n"
-    "- ingredients: list ONLY ingredients mentioned in the text. Keep quantities if present (e.g., \"200g spaghetti\").\n"
-    "- steps: ordered list of cooking actions derived from the text, split into multiple short imperative steps.\n"
-    "- Use double quotes for all strings. No trailing commas. Valid JSON.\n"
-    "- Do not add any keys besides title, ingredients, steps.\n"
-    "Start your answer with '{' and end with '}'.\n\n"
-    "Do NOT wrap the JSON in markdown code fences (no ```json and no ```).\n"
-    "Output must be plain JSON text only.\n\n"
-    "End the output immediately after the closing '}'.\n\n"
-    "JSON format:\n"
-    "{\n"
-    "  \"title\": \"...\",\n"
-    "  \"ingredients\": [\"...\"],\n"
-    "  \"steps\": [\"...\"]\n"
-    "}\n"
-)
-
-SYSTEM += (
-    "\nIMPORTANT:\n"
-    "- Output MUST start with '{' as the very first character.\n"
-    "- Output MUST be exactly one JSON object and nothing else.\n"
-    "Example (format only):\n"
-    "{\"title\":\"x\",\"ingredients\":[\"x\"],\"steps\":[\"x\"]}\n"
-)
-
-RETRY_SYSTEM = (
-    SYSTEM
-    + "\nIMPORTANT:\n"
-      "- Your previous output was invalid or cut off.\n"
-      "- Return ONLY ONE complete JSON object.\n"
-      "- Ensure it is valid JSON and fully closed.\n"
-      "- Do not add any extra commentary.\n"
-      "- End immediately after the final '}'.\n"
-)
+# quante ricette passano insieme in una chiamata a generate
+BATCH_SIZE = 8
+# decoding vincolato allo schema {title, ingredients, steps}: niente JSON rotto
+# né retry. False = generazione libera (come nelle misure della relazione)
+CONSTRAINED = True
+# `python <script> --resume` riprende un run interrotto: salta gli id gia' riusciti in OUT_JSONL
+RESUME = "--resume" in sys.argv
+# `--cache`: riusa gli output gia' generati (pipeline/gen_cache.py), es. dopo aver cambiato solo il parsing
+CACHE = "--cache" in sys.argv
+# `--split`: invece di RECIPES, le ricette di inferenza + test lette da D2.txt per id
+# secondo il manifest degli split (pipeline/splits.py); risultati per id in SPLIT_JSONL
+SPLIT = "--split" in sys.argv
+SPLIT_JSONL = os.path.join(OUT_DIR, "recipes_split.jsonl")
 
 # =======================
 # INCOLLA QUI LE TUE RICETTE
@@ -327,97 +194,46 @@ RECIPES = [
 ]
 
 
-# =======================
-# GENERATION
-# =======================
-def generate_once(recipe_text: str, max_new_tokens: int, system_text: str):
-    messages = [
-        {"role": "system", "content": system_text},
-        {"role": "user", "content": "Recipe text:\n" + recipe_text},
-    ]
-
-    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = tokenizer(prompt, return_tensors="pt")
-    if device == "cuda":
-        inputs = {k: v.to(model.device) for k, v in inputs.items()}
-    else:
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-
-
-    with torch.no_grad():
-        out = model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=False,                 # deterministico
-            temperature=None,
-            top_p=None,
-            top_k=None,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=tokenizer.pad_token_id,
-
+if __name__ == "__main__":
+    if SPLIT:
+        if CACHE:
+            engine.use_generation_cache()
+        engine.run_extraction_stream(
+            PROFILE,
+            splits.records("inference", "test"),
+            SPLIT_JSONL,
+            os.path.join(OUT_DIR, "recipes_split_failures.jsonl"),
+            batch_size=BATCH_SIZE,
+            constrained=CONSTRAINED,
+            resume=RESUME,
+            stage="valutazione",
         )
+        scoring.score_run(SPLIT_JSONL, None, report_path=os.path.join(OUT_DIR, "scores_split.csv"))
+        raise SystemExit(0)
 
-    gen_ids = out[0][inputs["input_ids"].shape[1]:]
-    return tokenizer.decode(gen_ids, skip_special_tokens=True)
-
-
-def run_extraction(recipes):
-    results = []
-    failures = []
-
-    for i, recipe_text in enumerate(recipes):
-        print(f"\n=== Processing recipe {i+1}/{len(recipes)} ===")
-
-        # 1) primo tentativo
-        decoded = generate_once(recipe_text, max_new_tokens=1200, system_text=SYSTEM)
-        obj, err, json_str = try_parse(decoded)
-
-        # 2) retry se serve
-        if obj is None:
-            decoded_retry = generate_once(recipe_text, max_new_tokens=2000, system_text=RETRY_SYSTEM)
-            decoded = decoded_retry
-            obj, err, json_str = try_parse(decoded)
-
-        if obj is None:
-            print("❌ Failed:", err)
-            failures.append({
-                "index": i + 1,
-                "reason": err,
-                "recipe_text": recipe_text,
-                "raw": decoded,
-                "json_str": json_str,
-            })
-            continue
-
-        results.append(obj)
-        print("✅ OK:", obj.get("title", ""))
-
-        # salva anche jsonl (comodo per debug)
-        with open(OUT_JSONL, "a", encoding="utf-8") as f:
-            f.write(json.dumps({"index": i + 1, "input": recipe_text, "output": obj}, ensure_ascii=False) + "\n")
-
-    return results, failures
-
-
-if __name__ == "__main__":
     if not RECIPES:
         print("RECIPES è vuoto. Incolla la lista RECIPES nel file.")
         raise SystemExit(1)
 
-    # azzera il jsonl ad ogni run
-    if os.path.exists(OUT_JSONL):
-        os.remove(OUT_JSONL)
-
-    results, failures = run_extraction(RECIPES)
-
-    with open(OUT_JSON, "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
-
-    with open(OUT_FAIL, "w", encoding="utf-8") as f:
-        json.dump(failures, f, ensure_ascii=False, indent=2)
-
-    print("\n=== DONE ===")
-    print("Extracted:", len(results), "/", len(RECIPES))
-    print("Failures:", len(failures))
-    print(f"Saved: {OUT_JSON} and {OUT_FAIL}")
+    # senza --resume il jsonl viene azzerato
+    if CACHE:
+        engine.use_generation_cache()
+
+    # RECIPES sono le ricette di inferenza (0-49) + test (900-1000) in ordine di id
+    ids = splits.ids_in("inference", "test")
+    results, failures = engine.run_extraction(
+        PROFILE,
+        RECIPES,
+        batch_size=BATCH_SIZE,
+        constrained=CONSTRAINED,
+        index_base=1,
+        jsonl_path=OUT_JSONL,
+        resume=RESUME,
+        ids=ids,
+        stage="valutazione",
+    )
+    engine.save_outputs(OUT_DIR, results, failures, len(RECIPES))
     print(f"Also saved JSONL: {OUT_JSONL}")
+
+    # SINTASSI / STRUTTURA / SEMANTICA contro D1, join per id sui record di OUT_JSONL
+    scoring.score_run(OUT_JSONL, ids, index_base=1)
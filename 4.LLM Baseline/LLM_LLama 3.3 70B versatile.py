@@ -1,28 +1,16 @@
-import os, json, time, re, random
-from openai import OpenAI
-from openai import RateLimitError, APIError, APITimeoutError
+import os, sys, json, asyncio
 
-client = OpenAI(
-    api_key=os.environ["GROQ_API_KEY"],
-    base_url="https://api.groq.com/openai/v1",
-)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from pipeline import baseline_client, prompts, results, splits
 
 MODEL = "llama-3.3-70b-versatile"
 
-SYSTEM = """You are an information extraction engine.
-Input: a raw recipe written in natural language.
-Output: ONLY valid JSON with EXACTLY these keys: title, ingredients, steps.
-No extra text.
+# richieste in volo insieme e rate iniziale (req/s): il rate poi si adatta ai 429 / retry-after
+CONCURRENCY = 8
+RATE = 0.5
 
-Extraction rules:
-- title: use an explicit title if present; otherwise infer a short, non-empty title; if impossible use "".
-- ingredients: list ONLY ingredients mentioned in the text. Keep quantities if present.
-- steps: ordered list of cooking actions derived from the text.
-- Use double quotes for all strings. No trailing commas.
-- Do not add any keys besides title, ingredients, steps.
-Start your answer with '{' and end with '}'.
-Do NOT wrap the JSON in markdown.
-"""
+# prompt condiviso con pipeline/benchmark.py
+SYSTEM = prompts.BASELINE_SYSTEM
 
 RECIPES = [
     "No-Bake Nut Cookies. In a heavy two-quart saucepan, combine 1 cup firmly packed brown sugar, 1/2 cup evaporated milk, 2 tablespoons butter or margarine, and 1/2 cup broken pecans. Cook over medium heat, stirring constantly, until the mixture bubbles across the surface. Continue boiling and stirring for 5 minutes. Remove from heat and stir in 1/2 teaspoon vanilla, then add 3 1/2 cups bite-size shredded rice biscuits and mix thoroughly. Using two teaspoons, drop the mixture onto wax paper to form about 30 clusters. Let stand for approximately 30 minutes, until firm.",
@@ -178,85 +166,19 @@ RECIPES = [
     "Hidden Valley Ranch Oyster Crackers. Mix 1 pkg. Hidden Valley Ranch salad dressing mix with 3/4 to 1 c. salad oil, add 1/4 tsp. lemon pepper, 1/2 to 1 tsp. dill weed, and 1/4 tsp. garlic powder, pour over 12 to 16 oz. plain oyster crackers and stir to coat, then warm in a very low oven for 15 to 20 minutes."
 ]
 
-def backoff_sleep(attempt: int, base: float = 2.0, cap: float = 60.0) -> None:
-    # exponential backoff + jitter
-    s = min(cap, base * (2 ** (attempt - 1)))
-    s = s * (0.7 + 0.6 * random.random())  # jitter 0.7x..1.3x
-    time.sleep(s)
-
-def extract_recipe(recipe_text: str) -> dict:
-    last_exc = None
-
-    for attempt in range(1, 6):
-        try:
-            resp = client.chat.completions.create(
-                model=MODEL,
-                temperature=0,
-                max_tokens=600,
-                messages=[
-                    {"role": "system", "content": SYSTEM},
-                    {"role": "user", "content": "RECIPE:\n" + recipe_text},
-                ],
-            )
-
-            text = (resp.choices[0].message.content or "").strip()
-            if not text:
-                raise ValueError("Risposta vuota")
-
-            # parse robusto
-            try:
-                data = json.loads(text)
-            except json.JSONDecodeError:
-                a, b = text.find("{"), text.rfind("}")
-                if a != -1 and b != -1 and b > a:
-                    data = json.loads(text[a:b+1])
-                else:
-                    raise ValueError(f"Output non-JSON (len={len(text)}): {text[:200]!r}")
-
-            return {
-                "title": str(data.get("title", "") or ""),
-                "ingredients": [str(x) for x in (data.get("ingredients") or [])],
-                "steps": [str(x) for x in (data.get("steps") or [])],
-            }
-
-        except (RateLimitError, APITimeoutError) as e:
-            last_exc = e
-            print(f"[Tentativo {attempt}/5] rate limit/timeout: {e}")
-            backoff_sleep(attempt)
-            continue
-
-        except APIError as e:
-            last_exc = e
-            msg = str(e).lower()
-            # 502/503/504 o overload vari
-            if any(x in msg for x in ["503", "504", "overloaded", "temporarily unavailable", "bad gateway", "502"]):
-                print(f"[Tentativo {attempt}/5] transient APIError: {e}")
-                backoff_sleep(attempt)
-                continue
-            raise
-
-        except Exception as e:
-            last_exc = e
-            print(f"[Tentativo {attempt}/5] errore: {type(e).__name__}: {e}")
-            backoff_sleep(attempt)
-            continue
-
-    raise RuntimeError(f"Estrazione fallita dopo 5 tentativi. Ultimo errore: {last_exc}")
-
-
 # ---- ESTRAZIONE ----
-all_recipes = []
-for i, r in enumerate(RECIPES):
-    try:
-        all_recipes.append(extract_recipe(r))
-    except Exception as e:
-        all_recipes.append({"title": "", "ingredients": [], "steps": [], "error": str(e), "index": i})
-        print(f"Ricetta {i} fallita: {e}")
-    time.sleep(0.8)  # 0.5–1.5s tipico sul free tier
+# RECIPES sono le ricette di inferenza (0-49) + test (900-1000) in ordine di id
+client = baseline_client.make_client(os.environ["GROQ_API_KEY"], baseline_client.GROQ_BASE_URL)
+records = []
+all_recipes = asyncio.run(baseline_client.extract_all(
+    client, RECIPES, SYSTEM, model=MODEL, concurrency=CONCURRENCY, rate=RATE,
+    ids=splits.ids_in("inference", "test"), records=records,
+))
 
 # ---- SALVATAGGIO ----
 with open("recipes.json", "w", encoding="utf-8") as f:
     json.dump(all_recipes, f, ensure_ascii=False, indent=2)
+# stesso schema dei modelli locali (pipeline/results.py): un record per ricetta con il suo id
+results.write_records("results.jsonl", records)
 
-print("File recipes.json creato con successo")
-
+print("File recipes.json e results.jsonl creati con successo")
@@ -0,0 +1,6 @@
+"""
+Codice condiviso tra gli script di Inferenza, Addestramento e Valutazione.
+
+Gli script vivono in cartelle non importabili (es. "1.Inferenza/Phi3"), quindi
+aggiungono la root del progetto a sys.path prima di importare `pipeline`.
+"""
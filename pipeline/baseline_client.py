@@ -0,0 +1,297 @@
+import asyncio
+import json
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from pipeline.results import ResultRecord
+
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+MODEL = "llama-3.3-70b-versatile"
+
+# 30 richieste/minuto: quota del free tier di Groq per llama-3.3-70b
+DEFAULT_RATE = 0.5
+DEFAULT_CONCURRENCY = 8
+MAX_ATTEMPTS = 5
+
+_TRANSIENT = ("503", "504", "overloaded", "temporarily unavailable", "bad gateway", "502")
+# finish_reason dell'API -> motivo dello stop come in pipeline/metrics.py
+_STOP = {"stop": "eos", "length": "budget"}
+
+
+# -----------------------
+# RATE LIMIT ADATTIVO
+# -----------------------
+class AdaptiveTokenBucket:
+    """
+    Token bucket con rate adattivo (AIMD): ogni risposta ok alza il rate di
+    `increase` fino a `max_rate`, ogni 429 lo dimezza e, se il server manda
+    retry-after, blocca tutte le richieste fino a quell'istante. Cosi' il
+    throughput segue la quota reale invece di una sleep fissa per ricetta.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, max_rate: float | None = None,
+                 min_rate: float = 0.05, increase: float = 0.02):
+        self.rate = rate
+        self.max_rate = max_rate or rate * 4
+        self.min_rate = min_rate
+        self.increase = increase
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.rate_limited = 0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:  # chi aspetta un token passa in ordine di arrivo
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_rate_limit(self, retry_after: float | None = None):
+        self.rate_limited += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0.0)
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+
+def _status_code(exc):
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        code = getattr(getattr(exc, "response", None), "status_code", None)
+    return code
+
+
+def retry_after_seconds(exc) -> float | None:
+    """Secondi da attendere secondo gli header retry-after-ms / retry-after della risposta (se ci sono)."""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt: int, base: float = 2.0, cap: float = 60.0) -> float:
+    # exponential backoff + jitter 0.7x..1.3x
+    return min(cap, base * (2 ** (attempt - 1))) * (0.7 + 0.6 * random.random())
+
+
+# -----------------------
+# ESTRAZIONE
+# -----------------------
+def parse_response(text: str) -> dict:
+    text = (text or "").strip()
+    if not text:
+        raise ValueError("Risposta vuota")
+
+    # parse robusto
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        a, b = text.find("{"), text.rfind("}")
+        if a != -1 and b != -1 and b > a:
+            data = json.loads(text[a:b+1])
+        else:
+            raise ValueError(f"Output non-JSON (len={len(text)}): {text[:200]!r}")
+
+    return {
+        "title": str(data.get("title", "") or ""),
+        "ingredients": [str(x) for x in (data.get("ingredients") or [])],
+        "steps": [str(x) for x in (data.get("steps") or [])],
+    }
+
+
+async def extract_recipe(client, bucket: AdaptiveTokenBucket, recipe_text: str, system: str,
+                         model: str = MODEL, max_tokens: int = 600, max_attempts: int = MAX_ATTEMPTS,
+                         meta: dict | None = None) -> dict:
+    """
+    {title, ingredients, steps} di una ricetta, con retry. `meta`, se dato,
+    riceve attempts, token di prompt / generati (usage della risposta),
+    secondi passati in attesa delle risposte, tempo di parsing e motivo dello
+    stop (finish_reason), anche se la ricetta fallisce.
+    """
+    last_exc = None
+    meta = meta if meta is not None else {}
+    meta.update(attempts=0, prompt_tokens=0, generated_tokens=0, seconds=0.0, parse_seconds=0.0, stop=None)
+
+    for attempt in range(1, max_attempts + 1):
+        await bucket.acquire()
+        meta["attempts"] = attempt
+        t0 = time.perf_counter()
+        t_parse = None
+        try:
+            resp = await client.chat.completions.create(
+                model=model,
+                temperature=0,
+                max_tokens=max_tokens,
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": "RECIPE:\n" + recipe_text},
+                ],
+            )
+            meta["seconds"] += time.perf_counter() - t0
+            usage = getattr(resp, "usage", None)
+            if usage is not None:
+                meta["prompt_tokens"] += usage.prompt_tokens or 0
+                meta["generated_tokens"] += usage.completion_tokens or 0
+            finish = getattr(resp.choices[0], "finish_reason", None)
+            meta["stop"] = _STOP.get(finish, finish)
+            bucket.on_success()
+            t_parse = time.perf_counter()
+            return parse_response(resp.choices[0].message.content)
+
+        except Exception as e:
+            if t_parse is None:  # la richiesta stessa e' fallita: conta anche il suo tempo
+                meta["seconds"] += time.perf_counter() - t0
+            last_exc = e
+            status = _status_code(e)
+            name = type(e).__name__
+            if status == 429 or name == "RateLimitError":
+                wait = retry_after_seconds(e)
+                print(f"[Tentativo {attempt}/{max_attempts}] rate limit (retry-after={wait}): {e}")
+                bucket.on_rate_limit(wait)
+                if wait is None:
+                    await asyncio.sleep(_backoff(attempt))
+                continue
+            if status is not None and status < 500 and name != "APITimeoutError":
+                if not any(x in str(e).lower() for x in _TRANSIENT):
+                    raise  # errore della richiesta: riprovare non serve
+            # timeout, 5xx / overload, output non-JSON: riprova solo questa ricetta
+            print(f"[Tentativo {attempt}/{max_attempts}] errore: {name}: {e}")
+            await asyncio.sleep(_backoff(attempt))
+
+        finally:
+            if t_parse is not None:
+                meta["parse_seconds"] += time.perf_counter() - t_parse
+
+    raise RuntimeError(f"Estrazione fallita dopo {max_attempts} tentativi. Ultimo errore: {last_exc}")
+
+
+async def extract_all(client, recipes, system: str, model: str = MODEL, concurrency: int = DEFAULT_CONCURRENCY,
+                      rate: float = DEFAULT_RATE, max_rate: float | None = None, max_tokens: int = 600,
+                      max_attempts: int = MAX_ATTEMPTS, ids=None, records: list | None = None):
+    """
+    Estrae tutte le ricette con al massimo `concurrency` richieste in volo e un
+    rate adattivo. I risultati sono nello stesso ordine di `recipes`; una
+    ricetta fallita diventa {"title": "", ..., "error", "index"} come nello script.
+    Con `records` (lista) vi aggiunge, nello stesso ordine, un
+    results.ResultRecord per ricetta con recipe id (`ids`, default la
+    posizione), tentativi, token e tempo, come gli script dei modelli locali.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    bucket = AdaptiveTokenBucket(rate, burst=1, max_rate=max_rate)
+    ids = list(range(len(recipes))) if ids is None else [int(rid) for rid in ids]
+    metas = [{} for _ in recipes]
+    done = 0
+
+    async def one(i, text):
+        nonlocal done
+        async with sem:
+            try:
+                out = await extract_recipe(client, bucket, text, system, model, max_tokens, max_attempts, metas[i])
+            except Exception as e:
+                out = {"title": "", "ingredients": [], "steps": [], "error": str(e), "index": i}
+                print(f"Ricetta {i} fallita: {e}")
+        done += 1
+        print(f"[{done}/{len(recipes)}] ricetta {i} ({bucket.rate:.2f} req/s)")
+        return out
+
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(one(i, t) for i, t in enumerate(recipes)))
+    if records is not None:
+        from pipeline import metrics   # torch serve solo qui, non per le richieste
+
+        timings = metrics.Timings()
+        for rid, out, meta in zip(ids, results, metas):
+            records.append(_record(rid, out, meta, model))
+            timings.add(records[-1])
+    elapsed = time.perf_counter() - t0
+    if recipes and elapsed > 0:
+        print(f"Throughput: {len(recipes) / elapsed:.2f} recipes/sec "
+              f"(concurrency={concurrency}, 429={bucket.rate_limited}, rate finale={bucket.rate:.2f} req/s)")
+    if records is not None and recipes:
+        metrics.print_summary(timings.summary())
+    return results
+
+
+def _record(rid, out, meta, model) -> dict:
+    failed = "error" in out
+    return ResultRecord(
+        id=rid,
+        model=model,
+        model_id=model,
+        stage="baseline",
+        output=None if failed else out,
+        error=out["error"] if failed else None,
+        attempts=meta.get("attempts", 0),
+        prompt_tokens=meta.get("prompt_tokens"),
+        generated_tokens=meta.get("generated_tokens"),
+        seconds=round(meta.get("seconds", 0.0), 4),
+        latency=round(meta.get("seconds", 0.0), 4),   # richieste in parallelo: attesa per ricetta = tempo di servizio
+        parse_seconds=round(meta.get("parse_seconds", 0.0), 6),
+        retried=meta.get("attempts", 0) > 1,
+        stop=meta.get("stop"),
+    ).to_dict()
+
+
+def make_client(api_key: str, base_url: str = GROQ_BASE_URL, timeout: float = 60.0):
+    from openai import AsyncOpenAI
+
+    # i retry li gestisce extract_recipe (con il bucket condiviso), non l'SDK
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from pipeline import fake_openai_server
+
+    parser = argparse.ArgumentParser(description="Client asincrono contro il server OpenAI-compatibile finto (latenza + 429)")
+    parser.add_argument("--recipes", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=5.0, help="rate iniziale (req/s)")
+    parser.add_argument("--server-rpm", type=int, default=600, help="quota del server finto (richieste/minuto)")
+    parser.add_argument("--latency", type=float, default=0.5, help="latenza media del server finto (s)")
+    args = parser.parse_args()
+
+    server, base_url = fake_openai_server.start_in_thread(rpm=args.server_rpm, latency=args.latency)
+    try:
+        texts = [f"Recipe {i}\nMix {i} cups of flour with water and bake." for i in range(args.recipes)]
+        records = []
+        out = asyncio.run(extract_all(
+            make_client("fake", base_url), texts, "system", concurrency=args.concurrency, rate=args.rate,
+            max_rate=args.server_rpm / 60 * 2, ids=range(1000, 1000 + len(texts)), records=records,
+        ))
+        in_order = all(r.get("title") == f"Recipe {i}" for i, r in enumerate(out))
+        by_id = all(rec["id"] == 1000 + i and (rec["output"] or {}).get("title") in (None, f"Recipe {i}")
+                    for i, rec in enumerate(records))
+        print(f"ok={sum('error' not in r for r in out)}/{len(out)} ordine stabile={in_order} record per id={by_id} "
+              f"tentativi={sum(rec['attempts'] for rec in records)} "
+              f"token={sum(rec['generated_tokens'] for rec in records)} 429 inviati dal server={server.rate_limited}")
+    finally:
+        server.shutdown()
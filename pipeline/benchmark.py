@@ -0,0 +1,274 @@
+"""
+Benchmark qualita' / costo tra modelli sullo stesso insieme fisso di ricette.
+
+Ogni profilo (base e con adapter) e la baseline LLaMA 3.3 70B estraggono le
+stesse ricette (di default inferenza + test del manifest, lette da D2.txt per
+id); per ognuno si misurano caricamento, throughput, latenze p50/p95/p99,
+memoria e i punteggi automatici di pipeline/scoring.py. Il risultato e' una
+tabella a schermo piu' un JSON, con i ResultRecord di ogni modello accanto.
+
+Con `--stand-in` ogni profilo gira su un checkpoint piccolo (stesso prompt,
+stop, parsing e budget; niente nf4 ne' offload, adapter LoRA finto creato al
+volo) e `--fake-baseline` usa pipeline/fake_openai_server.py: il benchmark
+completo gira su CPU in pochi secondi e le regressioni di costo si vedono
+anche senza GPU ne' quota.
+"""
+import asyncio
+import itertools
+import json
+import os
+import time
+from dataclasses import replace
+
+import torch
+
+from pipeline import baseline_client, engine, export, metrics, prompts, results, scoring, splits
+from pipeline.profiles import PROFILES, ModelProfile
+
+DEFAULT_PROFILES = ("phi3", "phi3-ft", "qwen2.5", "qwen2.5-ft", "mistral", "mistral-ft")
+DEFAULT_SPLITS = ("inference", "test")
+
+# colonne della tabella: (chiave nella riga, intestazione, formato)
+COLUMNS = (
+    ("model", "model", "{}"),
+    ("ok", "ok", "{}"),
+    ("load_seconds", "load s", "{:.1f}"),
+    ("recipes_per_s", "rec/s", "{:.2f}"),
+    ("tokens_per_s", "tok/s", "{:.0f}"),
+    ("latency_p50", "p50 s", "{:.2f}"),
+    ("latency_p95", "p95 s", "{:.2f}"),
+    ("latency_p99", "p99 s", "{:.2f}"),
+    ("ttft_p50", "ttft ms", "{:.0f}"),
+    ("model_mem_mb", "mem MB", "{:.0f}"),
+    ("syntax_ok_pct", "sintassi%", "{:.1f}"),
+    ("schema_ok_pct", "struttura%", "{:.1f}"),
+    ("semantic_ok_pct", "semantica%", "{:.1f}"),
+    ("ingredient_f1", "ingr F1", "{:.2f}"),
+    ("step_recall", "step rec", "{:.2f}"),
+)
+
+
+def fixed_records(names=DEFAULT_SPLITS, limit: int | None = None, d2_path: str | None = None) -> list:
+    """(id, testo) delle ricette del benchmark: le stesse per tutti i modelli, in ordine di id."""
+    return list(itertools.islice(splits.records(*names, d2_path=d2_path), limit))
+
+
+# -----------------------
+# CHECKPOINT DI PROVA (CPU / CI)
+# -----------------------
+def stand_in_adapter(model_dir: str, out_dir: str | None = None) -> str:
+    """
+    Adapter LoRA sul checkpoint di prova (pesi B a zero: output identico al
+    base), salvato una volta sola: serve a far passare i profili -ft per
+    PeftModel come i veri adapter di 2.Addestramento.
+    """
+    out_dir = out_dir or os.path.join(model_dir, "stand-in-adapter")
+    if os.path.exists(os.path.join(out_dir, "adapter_config.json")):
+        return out_dir
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(model_dir)
+    model = get_peft_model(model, LoraConfig(r=4, lora_alpha=8, target_modules="all-linear", task_type="CAUSAL_LM"))
+    model.save_pretrained(out_dir)
+    return out_dir
+
+
+def stand_in(profile: ModelProfile, model_dir: str, adapter_dir: str | None = None) -> ModelProfile:
+    """Lo stesso profilo su un checkpoint di prova: prompt, stop, parsing e budget restano quelli del modello."""
+    return replace(
+        profile,
+        model_id=model_dir,
+        adapter_dir=(adapter_dir or stand_in_adapter(model_dir)) if profile.adapter_dir else None,
+        tokenizer_from_adapter=False,
+        offload_dir=None,
+        quantization=None,
+        fix_rope_scaling=False,
+    )
+
+
+# -----------------------
+# MISURE
+# -----------------------
+def _row(name: str, model_id: str, adapter, records_path: str, seconds: float, timings: metrics.Timings,
+         gold, extra: dict) -> dict:
+    """Riga del confronto: costo dal Timings del run, qualita' da pipeline/scoring.py sui record per id."""
+    quality = scoring.summary(scoring.score(scoring.load_outputs(records_path), gold))
+    summary = timings.summary()
+    ok = sum(1 for row in results.read_records(records_path).values() if row.get("output") is not None)
+    generated = sum(timings.values["generated_tokens"])
+    return {
+        "model": name,
+        "model_id": model_id,
+        "adapter": adapter,
+        "recipes": summary["recipes"],
+        "ok": ok,
+        "seconds": round(seconds, 3),
+        "recipes_per_s": summary["recipes"] / seconds if seconds > 0 else None,
+        "generated_tokens": int(generated),
+        "tokens_per_s": generated / seconds if seconds > 0 else None,
+        **{f"latency_{k}": v for k, v in summary["latency"].items()},
+        **{f"ttft_{k}": None if v is None else v * 1000 for k, v in summary["ttft"].items()},
+        **{f"decode_tps_{k}": v for k, v in summary["decode_tps"].items()},
+        "peak_mem_mb": summary["peak_mem_mb"] or None,
+        "retried": summary["retried"],
+        "stops": summary["stops"],
+        **extra,
+        **{k: v for k, v in quality.items() if k != "recipes"},
+        "records": records_path,
+    }
+
+
+def bench_profile(profile: ModelProfile, records, out_dir: str, gold, batch_size: int = engine.BATCH_SIZE,
+                  constrained: bool = True) -> dict:
+    """Caricamento + estrazione di `records` con un profilo; il modello viene scaricato alla fine."""
+    engine.unload()
+    before = metrics.memory_mb()
+    t0 = time.perf_counter()
+    engine.load_model(profile)
+    load_seconds = time.perf_counter() - t0
+    after = metrics.memory_mb()
+    model_mem = None if before is None or after is None else after - before
+
+    path = os.path.join(out_dir, profile.name, "results.jsonl")
+    stats = engine.RunStats()
+    t0 = time.perf_counter()
+    engine.run_extraction_stream(profile, records, path, os.path.join(out_dir, profile.name, "failures.jsonl"),
+                                 batch_size, constrained, stats=stats, stage="benchmark")
+    seconds = time.perf_counter() - t0
+    engine.unload(profile)
+    adapter = results.profile_fields(profile)["adapter"]
+    return _row(profile.name, profile.model_id, adapter, path, seconds, stats.timings, gold, {
+        "load_seconds": load_seconds,
+        "model_mem_mb": model_mem,
+        "retry_rate": stats.summary()["retry_rate"],
+    })
+
+
+def bench_baseline(records, out_dir: str, gold, base_url: str = baseline_client.GROQ_BASE_URL,
+                   api_key: str | None = None, model: str = baseline_client.MODEL,
+                   concurrency: int = baseline_client.DEFAULT_CONCURRENCY, rate: float = baseline_client.DEFAULT_RATE,
+                   max_rate: float | None = None) -> dict:
+    """La baseline via API sulle stesse ricette (client e rate adattivo di pipeline/baseline_client.py)."""
+    client = baseline_client.make_client(api_key or os.environ.get("GROQ_API_KEY", ""), base_url)
+    collected = []
+    t0 = time.perf_counter()
+    asyncio.run(baseline_client.extract_all(
+        client, [text for _, text in records], prompts.BASELINE_SYSTEM, model=model, concurrency=concurrency,
+        rate=rate, max_rate=max_rate, ids=[rid for rid, _ in records], records=collected,
+    ))
+    seconds = time.perf_counter() - t0
+    path = os.path.join(out_dir, "baseline", "results.jsonl")
+    results.write_records(path, collected)
+    timings = metrics.Timings()
+    for record in collected:
+        timings.add(record)
+    return _row(model, model, None, path, seconds, timings, gold, {
+        "load_seconds": None,
+        "model_mem_mb": None,
+        "retry_rate": timings.retried / len(collected) if collected else 0.0,
+    })
+
+
+def run_benchmark(profile_names=DEFAULT_PROFILES, out_dir: str = "benchmark", limit: int | None = None,
+                  split_names=DEFAULT_SPLITS, batch_size: int = engine.BATCH_SIZE, constrained: bool = True,
+                  stand_in_dir: str | None = None, max_new_tokens: int | None = None,
+                  baseline: dict | None = None, gold: str = "d1", merged: bool = False) -> dict:
+    """
+    Confronto completo: ogni profilo e (con `baseline`, kwargs di
+    bench_baseline) la baseline sulle stesse ricette. Con `merged` i profili
+    con adapter girano anche sul checkpoint unito (pipeline/export.py, creato
+    al volo per lo stand-in), per confrontare PeftModel e pesi uniti.
+    Scrive <out_dir>/benchmark.json e restituisce lo stesso dict.
+    """
+    records = fixed_records(split_names, limit)
+    gold_frame = scoring.load_gold(gold)
+    rows = []
+    for name in profile_names:
+        profile = PROFILES[name]
+        if stand_in_dir:
+            profile = stand_in(profile, stand_in_dir)
+        if max_new_tokens:
+            profile = replace(profile, max_new_tokens=max_new_tokens,
+                              retry_max_new_tokens=profile.retry_max_new_tokens and max_new_tokens)
+        variants = [profile]
+        if merged and profile.adapter_dir:
+            if stand_in_dir and not export.is_fresh(profile, export.merged_dir(profile)):
+                export.merge_adapter(profile)
+            variants.append(export.resolve(profile))
+        for variant in dict.fromkeys(variants):   # senza checkpoint unito resolve restituisce lo stesso profilo
+            rows.append(bench_profile(variant, records, out_dir, gold_frame, batch_size, constrained))
+    if baseline is not None:
+        rows.append(bench_baseline(records, out_dir, gold_frame, **baseline))
+
+    report = {
+        "recipes": [rid for rid, _ in records],
+        "splits": list(split_names),
+        "constrained": constrained,
+        "batch_size": batch_size,
+        "stand_in": stand_in_dir,
+        "merged": merged,
+        "device": "cuda" if torch.cuda.is_available() else "cpu",
+        "rows": rows,
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "benchmark.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def format_table(rows) -> str:
+    cells = [[head for _, head, _ in COLUMNS]]
+    for row in rows:
+        cells.append(["-" if row.get(key) is None else fmt.format(row[key]) for key, _, fmt in COLUMNS])
+    widths = [max(len(line[i]) for line in cells) for i in range(len(COLUMNS))]
+    lines = ["  ".join(c.ljust(w) if i == 0 else c.rjust(w) for i, (c, w) in enumerate(zip(line, widths)))
+             for line in cells]
+    lines.insert(1, "  ".join("-" * w for w in widths))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Confronto qualita' / costo tra profili e baseline sulle stesse ricette")
+    parser.add_argument("--profile", action="append", default=None, choices=sorted(PROFILES),
+                        help="ripetibile (default: tutti i profili, base e con adapter)")
+    parser.add_argument("--split", action="append", default=None, choices=splits.SPLITS,
+                        help="ripetibile: ricette del benchmark (default inference + test)")
+    parser.add_argument("--limit", type=int, default=None, help="solo le prime N ricette")
+    parser.add_argument("--out-dir", default="benchmark")
+    parser.add_argument("--batch-size", type=int, default=engine.BATCH_SIZE)
+    parser.add_argument("--unconstrained", action="store_true", help="generazione libera + retry")
+    parser.add_argument("--max-new-tokens", type=int, default=None, help="tetto ai budget dei profili")
+    parser.add_argument("--stand-in", default=None, metavar="MODEL_DIR",
+                        help="checkpoint piccolo al posto dei modelli (CPU / CI), es. /tmp/tiny/model")
+    parser.add_argument("--baseline", action="store_true", help="anche la baseline LLaMA 3.3 70B (GROQ_API_KEY)")
+    parser.add_argument("--fake-baseline", action="store_true",
+                        help="baseline contro pipeline/fake_openai_server.py invece dell'API")
+    parser.add_argument("--gold", choices=("d1", "d3"), default="d1")
+    parser.add_argument("--merged", action="store_true",
+                        help="i profili con adapter anche sul checkpoint unito (pipeline/export.py)")
+    args = parser.parse_args()
+
+    server = baseline = None
+    if args.fake_baseline:
+        from pipeline import fake_openai_server
+
+        server, url = fake_openai_server.start_in_thread(rpm=6000, latency=0.05)
+        baseline = {"base_url": url, "api_key": "fake", "rate": 50.0}
+    elif args.baseline:
+        baseline = {}
+
+    try:
+        report = run_benchmark(args.profile or DEFAULT_PROFILES, args.out_dir, args.limit,
+                               tuple(args.split or DEFAULT_SPLITS), args.batch_size, not args.unconstrained,
+                               args.stand_in, args.max_new_tokens, baseline, args.gold, args.merged)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    print(f"\n=== BENCHMARK ({len(report['recipes'])} ricette, {report['device']}"
+          f"{', stand-in ' + args.stand_in if args.stand_in else ''}) ===")
+    print(format_table(report["rows"]))
+    print(f"JSON: {os.path.join(args.out_dir, 'benchmark.json')}")
@@ -0,0 +1,88 @@
+import math
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from pipeline import columnar
+from pipeline.profiles import ROOT
+
+D3_PATH = os.path.join(ROOT, "2.Addestramento", "D3.csv")
+MIN_BUDGET = 64
+
+# un modello di budget per (tokenizer, dataset, quantile)
+_BUDGETS = {}
+
+
+@dataclass(frozen=True)
+class BudgetModel:
+    """
+    Budget di token in uscita in funzione dei token della ricetta in ingresso:
+    retta output ~ slope * input + intercept stimata su D3, piu' il quantile
+    `quantile` dei residui (cosi' una frazione ~quantile delle ricette ci sta).
+    """
+
+    slope: float
+    intercept: float
+    residual: float
+    quantile: float
+    n: int
+
+    def __call__(self, input_tokens: int) -> int:
+        return max(MIN_BUDGET, int(math.ceil(self.slope * input_tokens + self.intercept + self.residual)))
+
+
+def _load_pairs(dataset_path: str):
+    table = columnar.load_d3(dataset_path)
+    return list(zip(table.column("text").to_pylist(), table.column("json").to_pylist()))
+
+
+def fit_budget(tokenizer, dataset_path: str = D3_PATH, quantile: float = 0.95) -> BudgetModel:
+    """Stima (una volta per tokenizer) il BudgetModel dalle coppie text -> json di D3."""
+    key = (tokenizer.name_or_path, len(tokenizer), os.path.abspath(dataset_path), quantile)
+    model = _BUDGETS.get(key)
+    if model is not None:
+        return model
+
+    pairs = _load_pairs(dataset_path)
+    x = np.array([len(ids) for ids in tokenizer([t for t, _ in pairs], add_special_tokens=False)["input_ids"]])
+    y = np.array([len(ids) for ids in tokenizer([j for _, j in pairs], add_special_tokens=False)["input_ids"]])
+    slope, intercept = np.polyfit(x, y, 1)
+    residual = float(np.quantile(y - (slope * x + intercept), quantile))
+
+    model = BudgetModel(float(slope), float(intercept), residual, quantile, len(pairs))
+    _BUDGETS[key] = model
+    return model
+
+
+def coverage(model: BudgetModel, tokenizer, dataset_path: str = D3_PATH) -> dict:
+    """Quota di ricette di D3 il cui JSON sta nel budget, e token riservati rispetto a un budget fisso."""
+    pairs = _load_pairs(dataset_path)
+    x = [len(ids) for ids in tokenizer([t for t, _ in pairs], add_special_tokens=False)["input_ids"]]
+    y = [len(ids) for ids in tokenizer([j for _, j in pairs], add_special_tokens=False)["input_ids"]]
+    budgets = [model(n) for n in x]
+    return {
+        "recipes": len(pairs),
+        "covered": sum(b >= o for b, o in zip(budgets, y)) / len(pairs),
+        "mean_budget": sum(budgets) / len(budgets),
+        "mean_output": sum(y) / len(y),
+        "max_output": max(y),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Stima del budget max_new_tokens da D3 per un tokenizer")
+    parser.add_argument("tokenizer", help="id HF o cartella locale del tokenizer")
+    parser.add_argument("--d3", default=D3_PATH)
+    parser.add_argument("--quantile", type=float, default=0.95)
+    args = parser.parse_args()
+
+    tok = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    bm = fit_budget(tok, args.d3, args.quantile)
+    print(bm)
+    print(json.dumps(coverage(bm, tok, args.d3), indent=2))
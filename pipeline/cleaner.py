@@ -0,0 +1,109 @@
+"""
+Pulizia a blocchi di RecipeNLG_dataset.csv (~2.2 GB): si leggono solo le
+colonne che servono (usecols, parser C) e si scrive blocco per blocco in
+CSV e Parquet, quindi la memoria non dipende dalla dimensione del file.
+"""
+import os
+import time
+
+import pandas as pd
+
+COLUMNS = ["id", "title", "ingredients", "directions"]
+CHUNKSIZE = 100_000
+
+
+def peak_rss_mb() -> float | None:
+    """Picco di memoria residente del processo in MB (None se non misurabile)."""
+    try:
+        import resource
+        import sys
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if sys.platform == "darwin" else peak / 1024  # byte su macOS, KB su Linux
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 1024**2  # Windows: peak working set
+    except ImportError:
+        return None
+
+
+def clean_recipes(input_path: str, csv_path: str | None = None, parquet_path: str | None = None,
+                  columns=COLUMNS, chunksize: int = CHUNKSIZE) -> dict:
+    """
+    Copia le colonne `columns` (l'indice senza nome "Unnamed: 0" diventa id)
+    in csv_path e/o parquet_path, un blocco alla volta. Restituisce righe,
+    tempo, righe/s e picco di RSS.
+    """
+    wanted = set(columns)
+    reader = pd.read_csv(
+        input_path,
+        engine="c",
+        sep=",",
+        quotechar='"',
+        doublequote=True,
+        on_bad_lines="skip",
+        dtype=str,
+        keep_default_na=False,
+        usecols=lambda c: c in wanted or c == "Unnamed: 0",
+        chunksize=chunksize,
+    )
+
+    parquet_writer = None
+    rows, cols = 0, []
+    t0 = time.perf_counter()
+    try:
+        for n, chunk in enumerate(reader):
+            if "Unnamed: 0" in chunk.columns:
+                chunk = chunk.rename(columns={"Unnamed: 0": "id"})
+            cols = [c for c in columns if c in chunk.columns]  # evita errori se una colonna manca
+            chunk = chunk[cols]
+
+            if csv_path:
+                chunk.to_csv(csv_path, index=False, mode="w" if n == 0 else "a", header=(n == 0))
+            if parquet_path:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(parquet_path, table.schema, compression="zstd")
+                parquet_writer.write_table(table)  # un row group per blocco
+
+            rows += len(chunk)
+            elapsed = time.perf_counter() - t0
+            print(f"[blocco {n}] {rows} righe ({rows / elapsed:.0f} righe/s)")
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+    elapsed = time.perf_counter() - t0
+    return {
+        "rows": rows,
+        "columns": cols,
+        "seconds": round(elapsed, 2),
+        "rows_per_sec": round(rows / elapsed) if elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Pulizia a blocchi di RecipeNLG (solo le colonne utili)")
+    parser.add_argument("input")
+    parser.add_argument("--csv", default=None, help="CSV di uscita")
+    parser.add_argument("--parquet", default=None, help="Parquet di uscita")
+    parser.add_argument("--chunksize", type=int, default=CHUNKSIZE)
+    args = parser.parse_args()
+    if not args.csv and not args.parquet:
+        parser.error("indicare almeno --csv o --parquet")
+
+    for path in (args.csv, args.parquet):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    print(json.dumps(clean_recipes(args.input, args.csv, args.parquet, chunksize=args.chunksize), indent=2))
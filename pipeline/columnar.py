@@ -0,0 +1,159 @@
+"""
+Formato colonnare (Parquet) per D1/D2/D3, ordinato per id di ricetta.
+
+Nei CSV ingredients/directions sono stringhe con liste Python (D1) o un
+JSON serializzato dentro una colonna (D3), che ogni consumatore riparsa riga
+per riga. Qui vengono parsate una volta sola, in fase di conversione, in
+colonne list<string> native; i loader restituiscono tabelle Arrow lette in
+memory map (nessun parsing Python per riga). Il Parquet sta accanto al CSV
+e viene rigenerato quando il CSV/TXT sorgente e' piu' recente.
+"""
+import ast
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pipeline.profiles import ROOT
+
+D1_PATH = os.path.join(ROOT, "0.Dataset", "D1.csv")
+D2_PATH = os.path.join(ROOT, "0.Dataset", "D2.txt")
+D3_PATH = os.path.join(ROOT, "2.Addestramento", "D3.csv")
+
+_LIST = pa.list_(pa.string())
+
+D1_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("title", pa.string()),
+    ("ingredients", _LIST),   # null se la lista nel CSV non e' parsabile
+    ("directions", _LIST),
+])
+D2_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("text", pa.string()),
+])
+D3_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("text", pa.string()),
+    ("json", pa.string()),    # target di addestramento, identico alla colonna di D3.csv
+    ("title", pa.string()),
+    ("ingredients", _LIST),
+    ("directions", _LIST),
+])
+
+
+def parquet_path(source: str) -> str:
+    return os.path.splitext(source)[0] + ".parquet"
+
+
+def _string_list(value):
+    """Lista di stringhe da un literal Python, None se non parsabile."""
+    try:
+        items = ast.literal_eval(value)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    if not isinstance(items, (list, tuple)):
+        return None
+    return [str(x) for x in items]
+
+
+def _write(columns: dict, schema: pa.Schema, out_path: str):
+    table = pa.Table.from_pydict(columns, schema=schema).sort_by("id")
+    tmp = out_path + ".tmp"
+    pq.write_table(table, tmp, compression="zstd")
+    os.replace(tmp, out_path)
+    return out_path
+
+
+# -----------------------
+# CONVERSIONE (una volta, dai file sorgente)
+# -----------------------
+def convert_d1(csv_path: str = D1_PATH, out_path: str | None = None) -> str:
+    import pandas as pd
+
+    df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    if "Unnamed: 0" in df.columns:
+        df = df.rename(columns={"Unnamed: 0": "id"})
+    return _write({
+        "id": df["id"].astype(int).tolist(),
+        "title": df["title"].tolist(),
+        "ingredients": [_string_list(v) for v in df["ingredients"]],
+        "directions": [_string_list(v) for v in df["directions"]],
+    }, D1_SCHEMA, out_path or parquet_path(csv_path))
+
+
+def convert_d2(txt_path: str = D2_PATH, out_path: str | None = None) -> str:
+    from pipeline.recipe_io import iter_d2
+
+    # id ripetuti in D2.txt: vince l'ultima occorrenza, come nel builder di D3
+    texts = dict(iter_d2(txt_path, normalize=False))
+    return _write({"id": list(texts), "text": list(texts.values())}, D2_SCHEMA, out_path or parquet_path(txt_path))
+
+
+def convert_d3(csv_path: str = D3_PATH, out_path: str | None = None) -> str:
+    import pandas as pd
+
+    df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    parsed = [json.loads(j) if j else {} for j in df["json"]]
+    return _write({
+        "id": df["id"].astype(int).tolist(),
+        "text": df["text"].tolist(),
+        "json": df["json"].tolist(),
+        "title": [str(p.get("title", "")) for p in parsed],
+        "ingredients": [[str(x) for x in p.get("ingredients") or []] for p in parsed],
+        "directions": [[str(x) for x in p.get("directions") or []] for p in parsed],
+    }, D3_SCHEMA, out_path or parquet_path(csv_path))
+
+
+_CONVERTERS = {"d1": convert_d1, "d2": convert_d2, "d3": convert_d3}
+
+
+# -----------------------
+# LOADER (Arrow, memory map)
+# -----------------------
+def load_table(kind: str, source: str) -> pa.Table:
+    """
+    Tabella Arrow di D1/D2/D3 (kind "d1" | "d2" | "d3") dal Parquet accanto
+    a `source`, convertendo prima se manca o se il sorgente e' piu' recente.
+    """
+    path = parquet_path(source)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source):
+        _CONVERTERS[kind](source, path)
+    return pq.read_table(path, memory_map=True)
+
+
+def load_d1(source: str = D1_PATH) -> pa.Table:
+    return load_table("d1", source)
+
+
+def load_d2(source: str = D2_PATH) -> pa.Table:
+    return load_table("d2", source)
+
+
+def load_d3(source: str = D3_PATH) -> pa.Table:
+    return load_table("d3", source)
+
+
+def to_dataset(table: pa.Table, columns=None):
+    """datasets.Dataset sopra la tabella Arrow (nessuna copia ne' parsing per riga)."""
+    from datasets import Dataset
+
+    return Dataset(table.select(columns) if columns else table)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Conversione di D1/D2/D3 in Parquet (liste native, ordinati per id)")
+    parser.add_argument("--d1", default=D1_PATH)
+    parser.add_argument("--d2", default=D2_PATH)
+    parser.add_argument("--d3", default=D3_PATH)
+    args = parser.parse_args()
+
+    for kind, source in (("d1", args.d1), ("d2", args.d2), ("d3", args.d3)):
+        print(f"{kind}: {_CONVERTERS[kind](source)}")
+        t0 = time.perf_counter()
+        table = load_table(kind, source)
+        print(f"  {table.num_rows} righe, {table.schema.names}, caricata in {(time.perf_counter() - t0) * 1000:.1f} ms")
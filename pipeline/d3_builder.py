@@ -0,0 +1,227 @@
+"""
+Costruzione in streaming di D3 (coppie testo D2 -> JSON strutturato D1).
+
+Il CSV strutturato (RecipeNLG, fino a ~2M righe) si legge a blocchi con il
+parser C di pandas, D2.txt si scorre riga per riga in parallelo: entrambi
+sono ordinati per id, quindi basta tenere in memoria le ricette di D2 di una
+finestra di id attorno al blocco corrente. Il parsing delle colonne lista
+(ast.literal_eval) e la scrittura degli shard CSV avvengono in un pool di
+processi; alla fine gli shard vengono concatenati nel CSV finale.
+"""
+import ast
+import collections
+import glob
+import json
+import multiprocessing
+import os
+import time
+
+import pandas as pd
+
+from pipeline import validation
+from pipeline.recipe_io import iter_d2
+
+CHUNKSIZE = 20_000
+# D2.txt non e' perfettamente ordinato (es. il blocco 546-580 compare due
+# volte): si legge avanti di WINDOW id oltre il blocco, e a parita' di id
+# vince l'ultima occorrenza come con la regex su tutto il file
+WINDOW = 1_000
+
+
+def _parse_chunk(task):
+    """
+    Worker: (n, righe) -> scrive lo shard n; restituisce (n, righe scritte,
+    liste non parsabili, conteggio dei flag di pipeline/validation.py).
+    """
+    n, rows, shard_dir, validate, conflicts = task
+    parsed, broken = [], 0
+    for rid, title, ingredients, directions, text in rows:
+        try:
+            ing = ast.literal_eval(ingredients)
+            steps = ast.literal_eval(directions)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            broken += 1  # formato lista rotto nel sorgente
+            continue
+        parsed.append((rid, title, ing, steps, text))
+
+    flags = collections.Counter()
+    if validate and parsed:
+        frame = pd.DataFrame(parsed, columns=["id", "title", "ingredients", "directions", "text"])
+        report = validation.check(frame, conflicts=conflicts)
+        bad = validation.corrupt(report)
+        flags.update({flag: int(report[flag].sum()) for flag in validation.FLAGS})
+        flags["corrupt"] = int(bad.sum())
+        parsed = [row for row, drop in zip(parsed, bad) if not drop]
+
+    final_data = [{
+        "id": rid,
+        "text": text,
+        "json": json.dumps({"title": title.strip(), "ingredients": ing, "directions": steps}, ensure_ascii=False),
+    } for rid, title, ing, steps, text in parsed]
+    pd.DataFrame(final_data, columns=["id", "text", "json"]).to_csv(
+        os.path.join(shard_dir, f"part-{n:05d}.csv"), index=False, encoding="utf-8"
+    )
+    return n, len(final_data), broken, flags
+
+
+def _iter_chunks(csv_path: str, chunksize: int, start: int, stop: int | None):
+    """Blocchi del CSV strutturato limitati alle righe [start, stop) (posizioni, come iloc)."""
+    reader = pd.read_csv(
+        csv_path, engine="c", chunksize=chunksize, dtype=str, keep_default_na=False, on_bad_lines="skip",
+    )
+    pos = 0
+    for chunk in reader:
+        if "Unnamed: 0" in chunk.columns:
+            chunk = chunk.rename(columns={"Unnamed: 0": "id"})
+        lo, hi = max(start - pos, 0), len(chunk) if stop is None else min(stop - pos, len(chunk))
+        pos += len(chunk)
+        if hi > lo:
+            yield chunk.iloc[lo:hi]
+        if stop is not None and pos >= stop:
+            break
+
+
+class _D2Window:
+    """Testi di D2.txt per id, letti in avanti solo quanto serve (finestra di WINDOW id)."""
+
+    def __init__(self, txt_path: str, window: int = WINDOW):
+        self._it = iter_d2(txt_path, normalize=False)
+        self.window = window
+        self.texts = {}
+        self.last_id = -1
+        self.exhausted = False
+        self.late = 0   # ricette arrivate dopo che il loro id era gia' stato abbinato
+        self.conflicts = set()  # id ripetuti nella finestra con un titolo diverso
+
+    def advance(self, max_id: int, released: int):
+        while not self.exhausted and self.last_id <= max_id + self.window:
+            try:
+                rid, text = next(self._it)
+            except StopIteration:
+                self.exhausted = True
+                break
+            if rid <= released:
+                self.late += 1
+                continue
+            if rid in self.texts and validation.title_key(self.texts[rid]) != validation.title_key(text):
+                self.conflicts.add(rid)
+            self.texts[rid] = text
+            self.last_id = max(self.last_id, rid)
+
+    def release(self, max_id: int):
+        """Dimentica gli id gia' abbinati (memoria limitata alla finestra)."""
+        for rid in [r for r in self.texts if r <= max_id]:
+            del self.texts[rid]
+
+
+def build_d3(csv_path: str, txt_path: str, out_csv: str, shard_dir: str | None = None,
+             start: int = 0, stop: int | None = None, exclude=(), chunksize: int = CHUNKSIZE,
+             workers: int | None = None, window: int = WINDOW, splits=None, spec=None,
+             validate: bool = False) -> dict:
+    """
+    Costruisce D3 (id, text, json) dalle righe [start, stop) del CSV
+    strutturato, con il testo della stessa ricetta in D2.txt. Salta gli id in
+    `exclude`, quelli senza testo in D2 e quelli con liste non parsabili.
+    Con `splits` (es. ("train", "validation")) tiene solo gli id che il
+    manifest (pipeline/splits.py) assegna a quegli split; con `validate`
+    scarta le coppie che pipeline/validation.py segnala come corrotte
+    (conteggi per flag in stats["corrupt_<flag>"]).
+    Memoria limitata a un blocco per worker + la finestra di D2.
+    """
+    out_csv = os.path.abspath(out_csv)
+    shard_dir = shard_dir or out_csv + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(shard_dir, "part-*.csv")):
+        os.remove(old)
+
+    exclude = set(exclude)
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    d2 = _D2Window(txt_path, window)
+    stats = collections.Counter(rows=0, written=0, other_split=0, excluded=0, missing_text=0, broken_lists=0)
+    if validate:
+        stats.update({"corrupt": 0, **{f"corrupt_{flag}": 0 for flag in validation.FLAGS}})
+    if splits is not None:
+        from pipeline import splits as split_manifest
+
+        spec = spec or split_manifest.DEFAULT_SPEC
+    t0 = time.perf_counter()
+
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        pending = collections.deque()
+        released = -1
+        for n, chunk in enumerate(_iter_chunks(csv_path, chunksize, start, stop)):
+            ids = chunk["id"].astype(int).tolist()
+            d2.advance(max(ids), released)
+            wanted = [True] * len(ids) if splits is None else \
+                [name in splits for name in split_manifest.assign(ids, spec)]
+            rows = []
+            for rid, keep, title, ingredients, directions in zip(
+                ids, wanted, chunk["title"], chunk["ingredients"], chunk["directions"]
+            ):
+                stats["rows"] += 1
+                if not keep:
+                    stats["other_split"] += 1
+                elif rid in exclude:
+                    stats["excluded"] += 1
+                elif rid not in d2.texts:
+                    stats["missing_text"] += 1
+                else:
+                    rows.append((rid, title, ingredients, directions, d2.texts[rid]))
+            released = max(released, max(ids))
+            d2.release(released)
+
+            # al piu' 2 blocchi in coda per worker: la lettura non corre avanti senza limite
+            conflicts = d2.conflicts.intersection(ids)
+            pending.append(pool.apply_async(_parse_chunk, ((n, rows, shard_dir, validate, conflicts),)))
+            while len(pending) > 2 * workers:
+                _collect(pending.popleft().get(), stats, t0)
+        while pending:
+            _collect(pending.popleft().get(), stats, t0)
+
+    stats["late_d2"] = d2.late
+    merge_shards(shard_dir, out_csv)
+    stats["seconds"] = round(time.perf_counter() - t0, 1)
+    return dict(stats)
+
+
+def _collect(result, stats, t0):
+    n, written, broken, flags = result
+    stats["written"] += written
+    stats["broken_lists"] += broken
+    for flag, count in flags.items():
+        stats[flag if flag == "corrupt" else f"corrupt_{flag}"] += count
+    elapsed = time.perf_counter() - t0
+    print(f"[shard {n}] {stats['rows']} righe lette, {stats['written']} scritte ({stats['rows'] / elapsed:.0f} righe/s)")
+
+
+def merge_shards(shard_dir: str, out_csv: str):
+    """Concatena gli shard in ordine (intestazione una volta sola), a blocchi."""
+    parts = sorted(glob.glob(os.path.join(shard_dir, "part-*.csv")))
+    tmp = out_csv + ".tmp"
+    with open(tmp, "wb") as out:
+        for i, part in enumerate(parts):
+            with open(part, "rb") as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                while block := f.read(1 << 20):
+                    out.write(block)
+    os.replace(tmp, out_csv)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Costruzione in streaming di D3 da CSV strutturato + D2.txt")
+    parser.add_argument("csv", help="CSV strutturato (RecipeNLG / D1.csv)")
+    parser.add_argument("txt", help="D2.txt (blocchi 'ID n — titolo')")
+    parser.add_argument("out", help="CSV di uscita (id,text,json)")
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--stop", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=CHUNKSIZE)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--validate", action="store_true", help="scarta le coppie corrotte (pipeline/validation.py)")
+    args = parser.parse_args()
+
+    print(json.dumps(build_d3(args.csv, args.txt, args.out, start=args.start, stop=args.stop,
+                              chunksize=args.chunksize, workers=args.workers, validate=args.validate), indent=2))
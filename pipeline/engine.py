@@ -0,0 +1,700 @@
+import json
+import os
+import time
+from dataclasses import dataclass, field
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+from pipeline import budget, gen_cache, generation, grammar, metrics, parsing, prompts, recipe_io, results, stopping
+from pipeline.prefix_cache import PrefixKVCache
+from pipeline.profiles import ModelProfile, get_profile
+
+# quante ricette passano insieme in una chiamata a generate
+BATCH_SIZE = 8
+
+# tokenizer e modelli restano in memoria finche' il processo vive (o fino a unload):
+# lo stesso processo puo' passare da un profilo all'altro senza ricaricare nulla
+_TOKENIZERS = {}   # sorgente del tokenizer -> tokenizer
+_MODELS = {}       # nome profilo -> (model, PrefixKVCache)
+_CONFIGS = {}      # model_id -> config (serve per il budget dinamico senza caricare il modello)
+
+# cache su disco delle generazioni (gen_cache.GenerationCache), attivata con use_generation_cache
+_GEN_CACHE = None
+
+
+# -----------------------
+# CARICAMENTO (lazy, in cache)
+# -----------------------
+def load_tokenizer(profile: ModelProfile):
+    source = profile.tokenizer_source
+    tokenizer = _TOKENIZERS.get(source)
+    if tokenizer is None:
+        tokenizer = AutoTokenizer.from_pretrained(source, trust_remote_code=True)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        if profile.adapter_dir:
+            # in addestramento il pad era eos: stesso pad anche in valutazione
+            tokenizer.pad_token_id = tokenizer.eos_token_id
+        _TOKENIZERS[source] = tokenizer
+    return tokenizer
+
+
+def torch_dtype(profile: ModelProfile):
+    if not torch.cuda.is_available():
+        return torch.float32
+    if profile.dtype == "bf16" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
+def quantization_config(profile: ModelProfile, mode: str | None = None):
+    """BitsAndBytesConfig per `mode` (default profile.quantization); None se non quantizzato."""
+    mode = mode or profile.quantization
+    if mode is None:
+        return None
+    if mode != "nf4":
+        raise ValueError(f"Quantizzazione non supportata: {mode!r}")
+    from transformers import BitsAndBytesConfig
+
+    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.bfloat16 if use_bf16 else torch.float16,
+    )
+
+
+def load_config(profile: ModelProfile):
+    config = _CONFIGS.get((profile.model_id, profile.fix_rope_scaling))
+    if config is not None:
+        return config
+    config = AutoConfig.from_pretrained(profile.model_id, trust_remote_code=True)
+    if profile.fix_rope_scaling:
+        # Fix rope_scaling edge-cases that can break loading in some environments
+        # (con transformers >= 5 rope_scaling e' un alias di rope_parameters, che serve: non si tocca)
+        rs = getattr(config, "rope_scaling", None)
+        if isinstance(rs, dict) and not hasattr(config, "rope_parameters"):
+            if "type" not in rs and "rope_type" in rs:
+                rs["type"] = rs["rope_type"]
+            if rs.get("type") in (None, "default", "linear", "dynamic"):
+                config.rope_scaling = None
+    _CONFIGS[(profile.model_id, profile.fix_rope_scaling)] = config
+    return config
+
+
+def load_model(profile: ModelProfile):
+    """Restituisce (model, prefix_cache); il modello viene caricato alla prima richiesta."""
+    entry = _MODELS.get(profile.name)
+    if entry is not None:
+        return entry
+
+    tokenizer = load_tokenizer(profile)
+    cuda = torch.cuda.is_available()
+    if cuda:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+
+    bnb_config = quantization_config(profile)
+    kwargs = {"torch_dtype": torch_dtype(profile)}
+    if bnb_config is not None:
+        kwargs = {"quantization_config": bnb_config}
+
+    model = AutoModelForCausalLM.from_pretrained(
+        profile.model_id,
+        config=load_config(profile),
+        trust_remote_code=True,
+        device_map="auto" if cuda or bnb_config is not None else None,
+        attn_implementation=profile.attn_implementation,
+        **kwargs,
+    )
+
+    if profile.adapter_dir:
+        from peft import PeftModel  # serve solo per i profili con adapter
+
+        peft_kwargs = {}
+        if profile.offload_dir:
+            os.makedirs(profile.offload_dir, exist_ok=True)
+            peft_kwargs["offload_dir"] = profile.offload_dir
+        model = PeftModel.from_pretrained(model, profile.adapter_dir, **peft_kwargs)
+
+    model.eval()
+    if not cuda:
+        model = model.to("cpu")
+
+    # KV cache del prefisso (template + SYSTEM): prefill una volta sola per system prompt
+    entry = (model, PrefixKVCache(model, tokenizer))
+    _MODELS[profile.name] = entry
+    return entry
+
+
+def use_generation_cache(path: str | None = gen_cache.DEFAULT_PATH, max_bytes: int = gen_cache.DEFAULT_MAX_BYTES):
+    """
+    Attiva (o con path=None disattiva) la cache su disco degli output di generate:
+    rilanciare un run cambiando solo parsing / scoring non rigenera nulla.
+    """
+    global _GEN_CACHE
+    if _GEN_CACHE is not None:
+        _GEN_CACHE.close()
+    _GEN_CACHE = gen_cache.GenerationCache(path, max_bytes) if path else None
+    return _GEN_CACHE
+
+
+def unload(profile: ModelProfile | None = None):
+    """Libera il modello di `profile` (o tutti). I tokenizer restano in cache."""
+    names = [profile.name] if profile is not None else list(_MODELS)
+    for name in names:
+        _MODELS.pop(name, None)
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+# -----------------------
+# GENERAZIONE
+# -----------------------
+def prompt_builder(profile: ModelProfile):
+    """`build_prompt(recipe_text, system_text) -> str` per il profilo (usato anche dalla cache del prefisso)."""
+    tokenizer = load_tokenizer(profile)
+
+    def build_prompt(recipe_text: str, system_text: str) -> str:
+        return prompts.build_prompt(tokenizer, recipe_text, system_text, profile.user_template)
+
+    return build_prompt
+
+
+def force_lbrace_kwargs(tokenizer):
+    """kwargs_factory che forza "{" come primo token (alternativa leggera alla grammatica)."""
+    lbrace_id = tokenizer.encode("{", add_special_tokens=False)[0]
+
+    def factory(prompt_len):
+        def prefix_allowed_tokens_fn(batch_id, input_ids):
+            # input_ids può essere (seq_len,) oppure (batch, seq_len)
+            cur_len = input_ids.shape[-1]
+            if cur_len == prompt_len:
+                return [lbrace_id]
+            return list(range(tokenizer.vocab_size))
+
+        return {"prefix_allowed_tokens_fn": prefix_allowed_tokens_fn}
+
+    return factory
+
+
+def token_budget(profile: ModelProfile, prompts_, max_new_tokens: int) -> int:
+    if not profile.dynamic_budget:
+        return max_new_tokens
+    # il budget dipende dal prompt più lungo del micro-batch (padding a sinistra)
+    input_len = max(len(ids) for ids in load_tokenizer(profile)(prompts_)["input_ids"])
+    max_total = getattr(load_config(profile), "max_position_embeddings", 2048)
+    return max(min(256, max_new_tokens), min(max_new_tokens, max_total - input_len - 8))
+
+
+def decoding_params(profile: ModelProfile, max_new_tokens: int, constrained: bool) -> dict:
+    """Tutto cio' che, oltre al prompt, cambia l'output di generate (parte della chiave di cache)."""
+    params = {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": False,
+        "constrained": constrained,
+        "stop": profile.stop,
+        "force_lbrace": profile.force_lbrace and not constrained,
+        "skip_special_tokens": profile.skip_special_tokens,
+        "dtype": profile.dtype,
+        "quantization": profile.quantization,
+    }
+    if constrained and profile.lenient_parse:
+        params["step_keys"] = list(grammar.LENIENT_STEP_KEYS)   # grammatica con l'alias "directions"
+    return params
+
+
+@dataclass
+class RunStats:
+    """Contatori di un run: quante ricette hanno richiesto una seconda generazione e quanti token si sono generati."""
+
+    recipes: int = 0
+    regenerated: int = 0        # ricette generate piu' di una volta (escalation e/o retry)
+    escalations: int = 0        # righe rigenerate con budget piu' alto perche' troncate
+    retries: int = 0            # righe rigenerate con RETRY_SYSTEM
+    generated_tokens: int = 0   # token prodotti da model.generate (le hit di cache non contano)
+    cache_hits: int = 0
+    timings: metrics.Timings = field(default_factory=metrics.Timings)   # misure per ricetta -> p50/p95/p99
+
+    def summary(self) -> dict:
+        return {
+            **self.timings.summary(),
+            "recipes": self.recipes,
+            "retry_rate": self.regenerated / self.recipes if self.recipes else 0.0,
+            "escalations": self.escalations,
+            "retries": self.retries,
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_recipe": self.generated_tokens / self.recipes if self.recipes else 0.0,
+            "cache_hits": self.cache_hits,
+        }
+
+
+def first_budget(profile: ModelProfile, recipe_texts) -> int:
+    """
+    Budget del primo tentativo: con profile.budget_quantile e' il budget
+    stimato su D3 (pipeline/budget.py) per la ricetta piu' lunga del
+    micro-batch, mai oltre profile.max_new_tokens; altrimenti il budget fisso.
+    """
+    if profile.budget_quantile is None:
+        return profile.max_new_tokens
+    tokenizer = load_tokenizer(profile)
+    model = budget.fit_budget(tokenizer, quantile=profile.budget_quantile)
+    lengths = [len(ids) for ids in tokenizer(list(recipe_texts), add_special_tokens=False)["input_ids"]]
+    return min(profile.max_new_tokens, max(model(n) for n in lengths))
+
+
+def generate(
+    profile: ModelProfile,
+    recipe_texts,
+    max_new_tokens: int,
+    system_text: str,
+    constrained: bool = True,
+    stats: RunStats | None = None,
+    usage=None,
+):
+    """
+    Testi generati per `recipe_texts`, nello stesso ordine. `usage`, se dato,
+    e' una lista di dict (uno per ricetta, vedi _new_usage) in cui si
+    accumulano le misure di questa chiamata (_add_usage); le hit di cache
+    contano come tentativo ma senza token ne' tempo (stop = "cache").
+    """
+    tokenizer = load_tokenizer(profile)
+    build_prompt = prompt_builder(profile)
+    batch_prompts = [build_prompt(t, system_text) for t in recipe_texts]
+    max_new_tokens = token_budget(profile, batch_prompts, max_new_tokens)
+    if usage is not None:
+        for u in usage:
+            u["attempts"] += 1
+            u["stop"] = "cache"
+
+    texts = [None] * len(batch_prompts)
+    keys = None
+    if _GEN_CACHE is not None:
+        params = decoding_params(profile, max_new_tokens, constrained)
+        weights = gen_cache.weights_digest(profile)
+        keys = [_GEN_CACHE.make_key(profile.model_id, weights, p, params) for p in batch_prompts]
+        cached = _GEN_CACHE.get_many(keys)
+        texts = [cached.get(k) for k in keys]
+
+    missing = [j for j, t in enumerate(texts) if t is None]
+    if stats is not None:
+        stats.cache_hits += len(texts) - len(missing)
+    if not missing:
+        return texts  # tutto in cache: il modello non viene nemmeno caricato
+
+    model, prefix_cache = load_model(profile)
+    t0 = time.perf_counter()
+    timings = [] if usage is not None else None
+    factories = []
+    if profile.stop == "json":
+        factories.append(stopping.json_stop_kwargs(tokenizer))   # stop appena il JSON è chiuso
+    if constrained:
+        factories.append(grammar.schema_kwargs(tokenizer, profile.lenient_parse))
+    elif profile.force_lbrace:
+        factories.append(force_lbrace_kwargs(tokenizer))
+
+    generated, lengths = generation.generate_batch(
+        model,
+        tokenizer,
+        [batch_prompts[j] for j in missing],
+        max_new_tokens=max_new_tokens,
+        kwargs_factory=generation.combine_kwargs(*factories),
+        skip_special_tokens=profile.skip_special_tokens,
+        prefix=prefix_cache.get(system_text, build_prompt),
+        return_lengths=True,
+        timings=timings,
+        temperature=None,                # deterministico
+        top_p=None,
+        top_k=None,
+    )
+    if stats is not None:
+        stats.generated_tokens += sum(lengths)
+    if usage is not None:
+        # una sola chiamata a generate per il micro-batch: il tempo si divide tra le righe generate
+        seconds = (time.perf_counter() - t0) / len(missing)
+        for j, timing in zip(missing, timings):
+            _add_usage(usage[j], timing, seconds)
+    for j, text in zip(missing, generated):
+        texts[j] = text
+    if keys is not None:
+        _GEN_CACHE.put_many({keys[j]: texts[j] for j in missing})
+    return texts
+
+
+def _truncated(raw: str) -> bool:
+    # il JSON e' iniziato ma non e' stato chiuso: generazione finita per budget
+    return "{" in raw and parsing.extract_first_json_block(raw) is None
+
+
+def _new_usage() -> dict:
+    return {"attempts": 0, "prompt_tokens": 0, "generated_tokens": 0, "seconds": 0.0, "latency": 0.0,
+            "ttft": None, "decode_tokens": 0, "decode_seconds": 0.0, "tokenize_seconds": 0.0,
+            "parse_seconds": 0.0, "peak_mem_mb": None, "stop": None}
+
+
+def _add_usage(usage: dict, timing: dict, seconds: float):
+    """Somma a `usage` le misure di una riga di generation.generate_batch (timings)."""
+    usage["prompt_tokens"] += timing["prompt_tokens"]
+    usage["generated_tokens"] += timing["generated_tokens"]
+    usage["seconds"] += seconds
+    usage["latency"] += timing["latency"]
+    usage["tokenize_seconds"] += timing["tokenize_seconds"]
+    if usage["ttft"] is None:
+        usage["ttft"] = timing["ttft"]
+    usage["decode_tokens"] += max(timing["generated_tokens"] - 1, 0)
+    usage["decode_seconds"] += timing["decode_seconds"]
+    if timing["peak_mem_mb"] is not None:
+        usage["peak_mem_mb"] = max(usage["peak_mem_mb"] or 0.0, timing["peak_mem_mb"])
+    usage["stop"] = timing["stop"]
+
+
+def extract_batch(profile: ModelProfile, batch, constrained: bool = True, stats: RunStats | None = None,
+                  usage=None):
+    """
+    Estrae {title, ingredients, steps} da un micro-batch di testi.
+    Restituisce, nell'ordine di `batch`, tuple (obj, errore, json_str, raw).
+    Con `usage` (lista vuota) vi aggiunge, per ogni riga, le misure di
+    generate sommate su primo tentativo, escalation e retry, piu' il tempo di parsing.
+    """
+    rows = None
+    if usage is not None:
+        rows = [_new_usage() for _ in batch]
+        usage.extend(rows)
+
+    def sub(idx):
+        return None if rows is None else [rows[j] for j in idx]
+
+    def parse(j, text):
+        t0 = time.perf_counter()
+        out = parsing.try_parse(text, profile.lenient_parse)
+        if rows is not None:
+            rows[j]["parse_seconds"] += time.perf_counter() - t0
+        return out
+
+    # 1) primo tentativo, tutto il micro-batch insieme, con il budget piu' stretto possibile
+    budget_now = first_budget(profile, batch)
+    decoded = generate(profile, batch, budget_now, profile.system, constrained, stats, rows)
+    parsed = [parse(j, d) for j, d in enumerate(decoded)]
+    regenerated = set()
+
+    # 2) escalation: solo le righe troncate ripartono con budget doppio (fino a max_new_tokens)
+    while budget_now < profile.max_new_tokens:
+        truncated = [j for j, (obj, _, _) in enumerate(parsed) if obj is None and _truncated(decoded[j])]
+        if not truncated:
+            break
+        budget_now = min(profile.max_new_tokens, budget_now * 2)
+        redo = generate(profile, [batch[j] for j in truncated], budget_now, profile.system, constrained, stats,
+                        sub(truncated))
+        for j, d in zip(truncated, redo):
+            decoded[j] = d
+            parsed[j] = parse(j, d)
+        regenerated.update(truncated)
+        if stats is not None:
+            stats.escalations += len(truncated)
+
+    # 3) retry solo per le ricette fallite, sempre in batch
+    #    (con constrained il JSON è valido per costruzione: niente seconda generazione)
+    retry = [j for j, (obj, _, _) in enumerate(parsed) if obj is None]
+    if retry and not constrained and profile.retry_max_new_tokens:
+        decoded_retry = generate(
+            profile, [batch[j] for j in retry], profile.retry_max_new_tokens, profile.retry_system, constrained, stats,
+            sub(retry),
+        )
+        for j, d in zip(retry, decoded_retry):
+            decoded[j] = d
+            parsed[j] = parse(j, d)
+        regenerated.update(retry)
+        if stats is not None:
+            stats.retries += len(retry)
+
+    if stats is not None:
+        stats.recipes += len(batch)
+        stats.regenerated += len(regenerated)
+    return [(obj, err, json_str, raw) for (obj, err, json_str), raw in zip(parsed, decoded)]
+
+
+def _banner(profile: ModelProfile):
+    print(f"\n##### {profile.name} ({profile.model_id}{' + adapter' if profile.adapter_dir else ''}) #####")
+
+
+def _record(profile: ModelProfile, rid, stage, obj, err, raw, usage, stats: RunStats) -> dict:
+    generated = usage["ttft"] is not None   # None = tutto dalla cache di generazione
+    record = results.ResultRecord(
+        id=int(rid),
+        stage=stage,
+        output=obj,
+        error=None if obj is not None else err,
+        raw=None if obj is not None else raw,
+        attempts=usage["attempts"],
+        prompt_tokens=usage["prompt_tokens"],
+        generated_tokens=usage["generated_tokens"],
+        seconds=round(usage["seconds"], 4),
+        latency=round(usage["latency"], 4) if generated else None,
+        ttft=None if usage["ttft"] is None else round(usage["ttft"], 4),
+        decode_tps=round(usage["decode_tokens"] / usage["decode_seconds"], 2) if usage["decode_seconds"] > 0 else None,
+        tokenize_seconds=round(usage["tokenize_seconds"], 6),
+        parse_seconds=round(usage["parse_seconds"], 6),
+        peak_mem_mb=None if usage["peak_mem_mb"] is None else round(usage["peak_mem_mb"], 1),
+        retried=usage["attempts"] > 1,
+        stop=usage["stop"],
+        **results.profile_fields(profile),
+    ).to_dict()
+    stats.timings.add(record)
+    return record
+
+
+def run_extraction(
+    profile: ModelProfile,
+    recipes,
+    batch_size: int = BATCH_SIZE,
+    constrained: bool = True,
+    index_base: int = 0,
+    jsonl_path: str | None = None,
+    resume: bool = False,
+    stats: RunStats | None = None,
+    ids=None,
+    stage: str | None = None,
+):
+    """
+    Estrae {title, ingredients, steps} da ogni ricetta con il modello del profilo.
+
+    - `constrained`: decoding vincolato allo schema (niente JSON rotto né retry);
+      False = generazione libera con retry (come nelle misure della relazione)
+    - `index_base`: 0 in Inferenza, 1 in Valutazione (indice salvato nei failures)
+    - `ids`: recipe id di ogni ricetta (es. splits.ids_in("inference")); di
+      default index_base + posizione
+    - `jsonl_path`: se dato, ogni ricetta (riuscita o no) viene aggiunta subito
+      come results.ResultRecord: fa da checkpoint del run e si unisce al gold per id
+    - `resume`: riparte dal JSONL esistente, saltando gli id che hanno gia'
+      un risultato; si rigenerano solo le ricette fallite o mancanti
+    - `stats`: RunStats da riempire (retry rate, token generati), stampato a fine run
+    Restituisce (results, failures), con results nell'ordine delle ricette.
+    """
+    indices = range(index_base, index_base + len(recipes))
+    ids = list(indices) if ids is None else [int(rid) for rid in ids]
+    if len(ids) != len(recipes):
+        raise ValueError(f"{len(ids)} id per {len(recipes)} ricette")
+    id_of = dict(zip(indices, ids))
+    done = {}
+    if resume and jsonl_path:
+        recipe_io.repair_jsonl_tail(jsonl_path)
+        by_id = {rid: i for i, rid in id_of.items()}
+        done = {by_id[rid]: row["output"] for rid, row in results.read_records(jsonl_path).items()
+                if rid in by_id and row.get("output") is not None}
+    pending = [(i, text) for i, text in zip(indices, recipes) if i not in done]
+    if done:
+        print(f"Resume: {len(done)} ricette già estratte, {len(pending)} da fare")
+
+    extracted = dict(done)
+    failures = []
+    stats = stats if stats is not None else RunStats()
+    writer = recipe_io.JsonlWriter(jsonl_path, append=resume) if jsonl_path else None
+
+    def process_batch(offset, batch):
+        texts = [text for _, text in batch]
+        usage = []
+        outcome = extract_batch(profile, texts, constrained, stats, usage)
+        for (i, text), (obj, err, json_str, raw), u in zip(batch, outcome, usage):
+            n = i - index_base + 1
+            record = _record(profile, id_of[i], stage, obj, err, raw, u, stats)
+            if writer is not None:
+                writer.write(record)
+            if obj is None:
+                print(f"[{n}/{len(recipes)}] ❌ Failed:", err)
+                failures.append({
+                    "index": i,
+                    "id": id_of[i],
+                    "reason": err,
+                    "recipe_text": text,
+                    "raw": raw,
+                    "json_str": json_str,
+                })
+                continue
+
+            extracted[i] = obj
+            print(f"[{n}/{len(recipes)}] ✅ OK:", obj.get("title", ""))
+
+    _banner(profile)
+    try:
+        generation.for_each_batch(pending, process_batch, batch_size)
+    finally:
+        if writer is not None:
+            writer.close()
+    _print_run_stats(stats)
+    return [extracted[i] for i in indices if i in extracted], failures
+
+
+def run_extraction_stream(
+    profile: ModelProfile,
+    records,
+    out_path: str,
+    fail_path: str,
+    batch_size: int = BATCH_SIZE,
+    constrained: bool = True,
+    resume: bool = False,
+    stats: RunStats | None = None,
+    stage: str | None = "stream",
+):
+    """
+    Versione in streaming di run_extraction per corpus grandi (es. tutto D2 o RecipeNLG).
+
+    `records` e' un iterabile di (recipe_id, testo), ad es. recipe_io.iter_recipes(path):
+    viene consumato un micro-batch alla volta e ogni ricetta e' scritta subito in
+    out_path come results.ResultRecord (anche le fallite, con error e raw), quindi
+    la memoria resta costante e un crash non perde le righe gia' scritte.
+    fail_path raccoglie in piu' testo e json_str delle fallite, per il debug.
+    Con `resume` gli id che hanno gia' un record riuscito in out_path vengono
+    saltati; il file dei failures si riscrive (quelle ricette si ritentano).
+    Restituisce (n_ok, n_failed).
+    """
+    skip = set()
+    if resume:
+        recipe_io.repair_jsonl_tail(out_path)
+        skip = results.done_ids(out_path)
+        print(f"Resume: {len(skip)} ricette già estratte in {out_path}")
+        records = ((rid, text) for rid, text in records if rid not in skip)
+
+    n_ok = n_failed = 0
+    stats = stats if stats is not None else RunStats()
+    _banner(profile)
+    t0 = time.perf_counter()
+    with recipe_io.JsonlWriter(out_path, append=resume) as out, recipe_io.JsonlWriter(fail_path, append=False) as fail:
+        for offset, batch in generation.ichunked(records, batch_size):
+            print(f"\n=== Processing recipes {offset + 1}-{offset + len(batch)} ===")
+            ids = [rid for rid, _ in batch]
+            texts = [text for _, text in batch]
+            usage = []
+            outcome = extract_batch(profile, texts, constrained, stats, usage)
+            for rid, text, (obj, err, json_str, raw), u in zip(ids, texts, outcome, usage):
+                record = _record(profile, rid, stage, obj, err, raw, u, stats)
+                out.write(record)
+                if obj is None:
+                    print(f"[id {rid}] ❌ Failed:", err)
+                    fail.write({**record, "recipe_text": text, "json_str": json_str})
+                    n_failed += 1
+                    continue
+
+                print(f"[id {rid}] ✅ OK:", obj.get("title", ""))
+                n_ok += 1
+
+    elapsed = time.perf_counter() - t0
+    total = n_ok + n_failed
+    if total and elapsed > 0:
+        print(f"Throughput: {total / elapsed:.2f} recipes/sec (batch_size={batch_size})")
+    print(f"Extracted: {n_ok} / {total}  ->  {out_path}")
+    print(f"Failures: {n_failed}  ->  {fail_path}")
+    _print_run_stats(stats)
+    _print_cache_stats()
+    return n_ok, n_failed
+
+
+def save_outputs(out_dir: str, results, failures, total: int):
+    os.makedirs(out_dir, exist_ok=True)
+    out_json = os.path.join(out_dir, "recipes_extracted.json")
+    out_fail = os.path.join(out_dir, "recipes_failures.json")
+
+    with open(out_json, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    with open(out_fail, "w", encoding="utf-8") as f:
+        json.dump(failures, f, ensure_ascii=False, indent=2)
+
+    print("\n=== DONE ===")
+    print("Extracted:", len(results), "/", total)
+    print("Failures:", len(failures))
+    print(f"Saved: {out_json} and {out_fail}")
+    _print_cache_stats()
+
+
+def _print_run_stats(stats: RunStats):
+    summary = stats.summary()
+    print(
+        f"Retry rate: {summary['retry_rate']:.1%} "
+        f"(escalations={stats.escalations}, retries={stats.retries}) | "
+        f"generated tokens: {stats.generated_tokens} ({summary['tokens_per_recipe']:.0f}/recipe)"
+    )
+    if stats.timings.recipes:
+        metrics.print_summary(summary)
+
+
+def _print_cache_stats():
+    if _GEN_CACHE is not None:
+        print("Generation cache:", json.dumps(_GEN_CACHE.stats()))
+
+
+if __name__ == "__main__":
+    import argparse
+    import itertools
+
+    from pipeline import splits
+    from pipeline.profiles import PROFILES
+
+    parser = argparse.ArgumentParser(
+        description="Estrazione JSON con uno o piu' profili nello stesso processo (tokenizer caricati una volta)"
+    )
+    parser.add_argument("--profile", action="append", required=True, choices=sorted(PROFILES),
+                        help="ripetibile: i profili girano uno dopo l'altro")
+    parser.add_argument("--recipes", default=None,
+                        help="D2.txt, JSONL o CSV (colonne id/text), oppure JSON con la lista dei testi")
+    parser.add_argument("--split", action="append", default=None, choices=splits.SPLITS,
+                        help="ripetibile: le ricette di D2.txt di questi split del manifest (pipeline/splits.py)")
+    parser.add_argument("--out-dir", required=True, help="per ogni profilo scrive <out-dir>/<profilo>/")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--unconstrained", action="store_true", help="generazione libera + retry")
+    parser.add_argument("--stream", action="store_true",
+                        help="legge le ricette una alla volta e scrive ogni risultato subito in JSONL")
+    parser.add_argument("--limit", type=int, default=None, help="solo le prime N ricette")
+    parser.add_argument("--ids", default=None, metavar="START-STOP",
+                        help="solo gli id in [START, STOP) di D2.txt, letti con l'indice (recipe_io.D2Index)")
+    parser.add_argument("--cache", nargs="?", const=gen_cache.DEFAULT_PATH, default=None,
+                        help="cache su disco delle generazioni (SQLite); senza valore usa .cache/generations.sqlite")
+    parser.add_argument("--cache-max-gb", type=float, default=gen_cache.DEFAULT_MAX_BYTES / 1024**3)
+    parser.add_argument("--resume", action="store_true",
+                        help="riprende un run interrotto: salta le ricette che hanno già un risultato")
+    args = parser.parse_args()
+
+    if args.cache:
+        use_generation_cache(args.cache, int(args.cache_max_gb * 1024**3))
+
+    if not args.recipes and not args.split:
+        parser.error("indicare --recipes oppure --split")
+
+    def records():
+        if args.split:
+            return itertools.islice(splits.records(*args.split, d2_path=args.recipes), args.limit)
+        if args.ids:
+            if not args.recipes.lower().endswith(".txt"):
+                parser.error("--ids richiede --recipes D2.txt")
+            start, stop = (int(x) for x in args.ids.split("-"))
+            return itertools.islice(recipe_io.D2Index(args.recipes).iter_range(start, stop), args.limit)
+        return itertools.islice(recipe_io.iter_recipes(args.recipes), args.limit)
+
+    for name in args.profile:
+        prof = get_profile(name)
+        out_dir = os.path.join(args.out_dir, prof.name)
+        if args.stream:
+            run_extraction_stream(
+                prof,
+                records(),
+                os.path.join(out_dir, "recipes_extracted.jsonl"),
+                os.path.join(out_dir, "recipes_failures.jsonl"),
+                args.batch_size,
+                not args.unconstrained,
+                args.resume,
+            )
+        else:
+            pairs = list(records())
+            recipe_texts = [text for _, text in pairs]
+            res, fail = run_extraction(
+                prof,
+                recipe_texts,
+                args.batch_size,
+                not args.unconstrained,
+                jsonl_path=os.path.join(out_dir, "recipes_extracted.jsonl"),
+                resume=args.resume,
+                ids=[rid for rid, _ in pairs],
+            )
+            save_outputs(out_dir, res, fail, len(recipe_texts))
+        unload(prof)  # un modello alla volta in GPU
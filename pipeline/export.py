@@ -0,0 +1,182 @@
+"""
+Export degli adapter LoRA di 2.Addestramento in checkpoint unici.
+
+In valutazione un profilo -ft carica il modello base e lo avvolge in
+PeftModel (Phi-3 anche con offload_dir): ogni forward passa per i rami LoRA
+e a volte per il disco. Qui i pesi LoRA vengono sommati una volta sola nei
+pesi del base (merge_and_unload) e il risultato e' salvato in safetensors
+accanto all'adapter, piu' una variante nf4 gia' quantizzata; resolve()
+restituisce il profilo che carica direttamente il checkpoint unito, se c'e'
+ed e' aggiornato rispetto all'adapter.
+"""
+import json
+import os
+import time
+from dataclasses import replace
+
+import torch
+
+from pipeline import engine, gen_cache
+from pipeline.profiles import ModelProfile, get_profile
+
+INFO_FILE = "merge_info.json"
+
+
+def merged_dir(profile: ModelProfile, quantized: bool = False) -> str:
+    """Cartella del checkpoint unito: accanto all'adapter, con suffisso -merged / -merged-nf4."""
+    if not profile.adapter_dir:
+        raise ValueError(f"Il profilo {profile.name!r} non ha un adapter da unire")
+    return os.path.normpath(profile.adapter_dir) + ("-merged-nf4" if quantized else "-merged")
+
+
+def _export_dtype(profile: ModelProfile):
+    # il checkpoint si salva nella precisione del profilo anche se il merge gira su CPU
+    return torch.bfloat16 if profile.dtype == "bf16" else torch.float16
+
+
+def merge_adapter(profile: ModelProfile, out_dir: str | None = None, quantize: bool = False) -> str:
+    """
+    Unisce l'adapter del profilo al modello base e salva il checkpoint
+    (safetensors + tokenizer + merge_info.json). Per i profili addestrati in
+    QLoRA (base nf4) il merge si fa sul base in fp16, come d'uso: la variante
+    nf4 si ottiene poi con `quantize`, che riquantizza il checkpoint unito
+    (serve bitsandbytes con CUDA).
+    """
+    out_dir = out_dir or merged_dir(profile)
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM
+
+    t0 = time.perf_counter()
+    tokenizer = engine.load_tokenizer(profile)   # pad = eos come in valutazione: resta salvato nel checkpoint
+    base = AutoModelForCausalLM.from_pretrained(
+        profile.model_id,
+        config=engine.load_config(profile),
+        trust_remote_code=True,
+        torch_dtype=_export_dtype(profile),
+        low_cpu_mem_usage=True,
+    )
+    model = PeftModel.from_pretrained(base, profile.adapter_dir).merge_and_unload()
+    model.save_pretrained(out_dir, safe_serialization=True)
+    tokenizer.save_pretrained(out_dir)
+    _write_info(out_dir, profile, None)
+    print(f"[{profile.name}] checkpoint unito in {out_dir} ({time.perf_counter() - t0:.1f}s)")
+    del model, base
+
+    if quantize:
+        quantize_merged(profile, out_dir)
+    return out_dir
+
+
+def quantize_merged(profile: ModelProfile, src_dir: str | None = None, out_dir: str | None = None) -> str:
+    """Variante nf4 del checkpoint unito (la config di quantizzazione resta nel checkpoint)."""
+    src_dir = src_dir or merged_dir(profile)
+    out_dir = out_dir or merged_dir(profile, quantized=True)
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    t0 = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(
+        src_dir,
+        trust_remote_code=True,
+        quantization_config=engine.quantization_config(profile, "nf4"),
+        device_map="auto",
+    )
+    model.save_pretrained(out_dir, safe_serialization=True)
+    AutoTokenizer.from_pretrained(src_dir, trust_remote_code=True).save_pretrained(out_dir)
+    _write_info(out_dir, profile, "nf4")
+    print(f"[{profile.name}] variante nf4 in {out_dir} ({time.perf_counter() - t0:.1f}s)")
+    return out_dir
+
+
+def _write_info(out_dir: str, profile: ModelProfile, quantization: str | None):
+    info = {
+        "profile": profile.name,
+        "base": profile.model_id,
+        "adapter": os.path.abspath(profile.adapter_dir),
+        "adapter_digest": gen_cache.adapter_digest(profile.adapter_dir),
+        "dtype": str(_export_dtype(profile)).replace("torch.", ""),
+        "quantization": quantization,
+    }
+    with open(os.path.join(out_dir, INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+
+
+def _read_info(out_dir: str) -> dict:
+    path = os.path.join(out_dir, INFO_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def is_fresh(profile: ModelProfile, out_dir: str) -> bool:
+    """True se in out_dir c'e' un checkpoint unito dall'adapter attuale del profilo."""
+    if not os.path.isdir(profile.adapter_dir or ""):
+        return False
+    return _read_info(out_dir).get("adapter_digest") == gen_cache.adapter_digest(profile.adapter_dir)
+
+
+def merged_profile(profile: ModelProfile, quantized: bool = False, out_dir: str | None = None) -> ModelProfile:
+    """
+    Lo stesso profilo sul checkpoint unito: niente adapter, offload ne'
+    quantizzazione al caricamento. Il digest dell'adapter sorgente
+    (merge_info.json) resta nel profilo: un checkpoint riesportato nella stessa
+    cartella da un adapter riaddestrato non riusa le generazioni in cache.
+    """
+    out_dir = out_dir or merged_dir(profile, quantized)
+    return replace(
+        profile,
+        name=profile.name + ("-merged-nf4" if quantized else "-merged"),
+        model_id=out_dir,
+        adapter_dir=None,
+        merged_adapter_digest=_read_info(out_dir).get("adapter_digest"),
+        tokenizer_from_adapter=False,
+        offload_dir=None,
+        quantization=None,          # la variante nf4 porta la sua quantization_config
+        fix_rope_scaling=False,
+    )
+
+
+def resolve(profile: ModelProfile, verbose: bool = True) -> ModelProfile:
+    """
+    Profilo da usare in valutazione: il checkpoint unito se esiste ed e'
+    aggiornato (nf4 per i profili quantizzati, se la GPU c'e'), altrimenti il
+    profilo con adapter cosi' com'e'.
+    """
+    if not profile.adapter_dir:
+        return profile
+    candidates = [False]
+    if profile.quantization == "nf4" and torch.cuda.is_available():
+        candidates.insert(0, True)
+    for quantized in candidates:
+        out_dir = merged_dir(profile, quantized)
+        if is_fresh(profile, out_dir):
+            if verbose:
+                print(f"Checkpoint unito: {out_dir}")
+            return merged_profile(profile, quantized)
+    if verbose:
+        print(f"Nessun checkpoint unito aggiornato per {profile.name}: base + adapter (python -m pipeline.export --profile {profile.name})")
+    return profile
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from pipeline.profiles import PROFILES
+
+    parser = argparse.ArgumentParser(description="Unisce gli adapter LoRA ai modelli base (safetensors) per la valutazione")
+    parser.add_argument("--profile", action="append", required=True,
+                        choices=sorted(name for name, p in PROFILES.items() if p.adapter_dir),
+                        help="ripetibile: profili con adapter (es. qwen2.5-ft)")
+    parser.add_argument("--nf4", action="store_true", help="anche la variante quantizzata nf4 (bitsandbytes + CUDA)")
+    parser.add_argument("--force", action="store_true", help="riesporta anche se il checkpoint e' aggiornato")
+    args = parser.parse_args()
+
+    for name in args.profile:
+        prof = get_profile(name)
+        target = merged_dir(prof)
+        if args.force or not is_fresh(prof, target):
+            merge_adapter(prof, target)
+        else:
+            print(f"[{name}] {target} gia' aggiornato")
+        if args.nf4 and (args.force or not is_fresh(prof, merged_dir(prof, quantized=True))):
+            quantize_merged(prof)
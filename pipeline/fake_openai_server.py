@@ -0,0 +1,113 @@
+"""
+Server finto compatibile con /v1/chat/completions di OpenAI, per provare il
+client della baseline (pipeline/baseline_client.py) senza quota ne' rete:
+latenza casuale e 429 con retry-after quando si supera `rpm` (richieste per
+`window` secondi, 60 di default; i test usano una finestra corta).
+"""
+import collections
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, rpm: int = 60, latency: float = 0.5, p_error: float = 0.0, window: float = 60.0):
+        super().__init__(address, _Handler)
+        self.rpm = rpm
+        self.window = window
+        self.latency = latency
+        self.p_error = p_error    # probabilita' di un 503 (errore transitorio)
+        self.requests = 0
+        self.rate_limited = 0
+        self._window = collections.deque()  # istanti delle richieste accettate nell'ultima finestra
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """None se la richiesta e' accettata, altrimenti i secondi di retry-after."""
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= self.window:
+                self._window.popleft()
+            if len(self._window) >= self.rpm:
+                self.rate_limited += 1
+                return self.window - (now - self._window[0])
+            self._window.append(now)
+            return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: dict, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send(404, {"error": {"message": "not found"}})
+            return
+
+        wait = server.admit()
+        if wait is not None:
+            self._send(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                       {"retry-after": f"{wait:.2f}"})
+            return
+
+        time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if random.random() < server.p_error:
+            self._send(503, {"error": {"message": "Service temporarily unavailable"}})
+            return
+
+        # titolo = prima riga della ricetta: permette di controllare l'ordine dei risultati
+        user = next((m["content"] for m in payload.get("messages", []) if m.get("role") == "user"), "")
+        lines = [line for line in user.splitlines() if line.strip() and line.strip() != "RECIPE:"]
+        content = json.dumps({
+            "title": lines[0].strip() if lines else "",
+            "ingredients": ["flour", "water"],
+            "steps": lines[1:] or ["Mix."],
+        })
+        self._send(200, {
+            "id": f"chatcmpl-{server.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(user.split()), "completion_tokens": len(content.split()),
+                      "total_tokens": len(user.split()) + len(content.split())},
+        })
+
+
+def start_in_thread(host: str = "127.0.0.1", port: int = 0, **kwargs):
+    """Avvia il server in un thread; restituisce (server, base_url). Fermarlo con server.shutdown()."""
+    server = FakeOpenAIServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Server OpenAI-compatibile finto (latenza + 429)")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rpm", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--p-error", type=float, default=0.0)
+    args = parser.parse_args()
+
+    srv = FakeOpenAIServer(("127.0.0.1", args.port), rpm=args.rpm, latency=args.latency, p_error=args.p_error)
+    print(f"Fake OpenAI server su http://127.0.0.1:{args.port}/v1")
+    srv.serve_forever()
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from pipeline.profiles import ROOT
+
+DEFAULT_PATH = os.path.join(ROOT, ".cache", "generations.sqlite")
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+# digest dei pesi dell'adapter, calcolato una volta per (cartella, mtime)
+_ADAPTER_DIGESTS = {}
+
+
+def adapter_digest(adapter_dir: str | None) -> str:
+    """
+    sha256 dei file dell'adapter (pesi + config). Se l'adapter viene
+    riaddestrato nella stessa cartella il digest cambia e la cache non viene
+    riusata per errore.
+    """
+    if not adapter_dir:
+        return ""
+    files = sorted(
+        name for name in os.listdir(adapter_dir)
+        if name.startswith("adapter_") and os.path.isfile(os.path.join(adapter_dir, name))
+    )
+    stamp = tuple((name, os.path.getmtime(os.path.join(adapter_dir, name))) for name in files)
+    key = (os.path.abspath(adapter_dir), stamp)
+    digest = _ADAPTER_DIGESTS.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        for name in files:
+            h.update(name.encode("utf-8"))
+            with open(os.path.join(adapter_dir, name), "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+        digest = h.hexdigest()
+        _ADAPTER_DIGESTS[key] = digest
+    return digest
+
+
+def weights_digest(profile) -> str:
+    """Parte della chiave che distingue i pesi oltre a model_id: l'adapter caricato o quello gia' unito."""
+    return adapter_digest(profile.adapter_dir) or profile.merged_adapter_digest or ""
+
+
+class GenerationCache:
+    """
+    Cache su disco (SQLite) degli output grezzi di model.generate.
+
+    La chiave e' lo sha256 di (modello base, digest dell'adapter, prompt
+    renderizzato, parametri di decoding): cambiare solo il parsing o lo
+    scoring non richiede nuove generazioni. Quando il contenuto supera
+    `max_bytes` si eliminano le voci usate meno di recente.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            " key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS generations_lru ON generations (last_used)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM generations").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_id: str, adapter: str, prompt: str, params: dict) -> str:
+        payload = json.dumps([model_id, adapter, prompt, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys) -> dict:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(keys), 500):  # limite di parametri di SQLite
+            chunk = keys[start : start + 500]
+            marks = ",".join("?" * len(chunk))
+            found.update(self._db.execute(f"SELECT key, text FROM generations WHERE key IN ({marks})", chunk))
+        if found:
+            now = time.time()
+            self._db.executemany("UPDATE generations SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+            self._db.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: dict):
+        now = time.time()
+        for key, text in items.items():
+            size = len(text.encode("utf-8"))
+            old = self._db.execute("SELECT size FROM generations WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO generations (key, text, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, text, size, now),
+            )
+            self._size += size - (old[0] if old else 0)
+        self._db.commit()
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self, target_bytes: int | None = None):
+        """Elimina le voci meno usate di recente finche' la cache sta sotto target (default 90% di max_bytes)."""
+        target = int(self.max_bytes * 0.9) if target_bytes is None else target_bytes
+        rows = self._db.execute("SELECT key, size FROM generations ORDER BY last_used").fetchall()
+        drop = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            drop.append((key,))
+            self._size -= size
+        self._db.executemany("DELETE FROM generations WHERE key = ?", drop)
+        self._db.commit()
+        self.evicted += len(drop)
+
+    def stats(self) -> dict:
+        entries = self._db.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+        }
+
+    def clear(self):
+        self._db.execute("DELETE FROM generations")
+        self._db.commit()
+        self._size = 0
+
+    def close(self):
+        self._db.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Statistiche / pulizia della cache delle generazioni")
+    parser.add_argument("command", choices=["stats", "clear"])
+    parser.add_argument("--path", default=DEFAULT_PATH)
+    args = parser.parse_args()
+
+    cache = GenerationCache(args.path)
+    if args.command == "clear":
+        cache.clear()
+    print(json.dumps(cache.stats(), indent=2))
+    cache.close()
@@ -0,0 +1,198 @@
+import itertools
+import time
+
+import torch
+from transformers import StoppingCriteriaList
+
+from pipeline import metrics, stopping
+from pipeline.prefix_cache import expand_prefix
+
+
+def chunked(items, size: int):
+    """
+    Divide `items` in micro-batch consecutivi di al massimo `size` elementi.
+    Restituisce coppie (offset, batch) cosi' i risultati si possono rimettere
+    nell'ordine originale.
+    """
+    size = max(1, int(size))
+    for start in range(0, len(items), size):
+        yield start, items[start : start + size]
+
+
+def ichunked(iterable, size: int):
+    """
+    Come chunked ma per iterabili di lunghezza ignota (file letti in streaming):
+    tiene in memoria un solo micro-batch alla volta.
+    """
+    size = max(1, int(size))
+    it = iter(iterable)
+    offset = 0
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield offset, batch
+        offset += len(batch)
+
+
+def model_input_device(model):
+    # con device_map="auto" il primo parametro sta sul device degli embedding
+    return next(model.parameters()).device
+
+
+def combine_kwargs(*factories):
+    """Unisce piu' kwargs_factory (es. stop su JSON + grammatica) in una sola."""
+    def factory(prompt_len):
+        kwargs = {}
+        for f in factories:
+            kwargs.update(f(prompt_len))
+        return kwargs
+
+    return factory
+
+
+def generate_batch(
+    model,
+    tokenizer,
+    prompts,
+    max_new_tokens: int,
+    kwargs_factory=None,
+    skip_special_tokens: bool = True,
+    prefix=None,
+    return_lengths: bool = False,
+    timings: list | None = None,
+    **generate_kwargs,
+):
+    """
+    Genera in un'unica chiamata a model.generate per una lista di prompt.
+
+    - i prompt vengono paddati a SINISTRA (obbligatorio per i decoder-only)
+    - `kwargs_factory(prompt_len)` restituisce gli argomenti di generate che
+      dipendono dalla lunghezza del prompt paddato (stopping_criteria,
+      prefix_allowed_tokens_fn, ...). Gli stopping criteria devono restituire
+      uno stato PER RIGA: una sequenza finita non ferma le altre
+    - `prefix` = (prefix_ids, cache) da prefix_cache.PrefixKVCache: se tutti i
+      prompt iniziano con prefix_ids, il prefisso non viene ricalcolato e il
+      padding va tra prefisso e resto del prompt (le posizioni restano giuste
+      perche' generate le ricava dall'attention_mask)
+    - restituisce i testi generati nello stesso ordine di `prompts`
+      (con `return_lengths` anche il numero di token generati per riga)
+    - `timings` (lista) riceve un dict per riga: token di prompt e generati,
+      quota della tokenizzazione del micro-batch, TTFT, latenza fino
+      all'ultimo token della riga, secondi e token/s di decode, motivo dello
+      stop e picco di memoria (pipeline/metrics.py)
+    """
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    t_start = time.perf_counter()
+
+    inputs = None
+    if prefix is not None:
+        inputs = _inputs_after_prefix(tokenizer, prompts, prefix[0])
+        if inputs is not None:
+            generate_kwargs["past_key_values"] = expand_prefix(prefix, len(prompts))
+
+    if inputs is None:
+        old_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            inputs = tokenizer(list(prompts), return_tensors="pt", padding=True)
+        finally:
+            tokenizer.padding_side = old_side
+
+    device = model_input_device(model)
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    prompt_len = inputs["input_ids"].shape[1]
+    t_tokenized = time.perf_counter()
+
+    if kwargs_factory is not None:
+        generate_kwargs.update(kwargs_factory(prompt_len))
+
+    timer = None
+    if timings is not None:
+        timer = metrics.StepTimer()
+        criteria = generate_kwargs.get("stopping_criteria") or []
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList([*criteria, timer])
+        metrics.reset_peak_memory()
+
+    generate_kwargs.setdefault("eos_token_id", tokenizer.eos_token_id)
+    generate_kwargs.setdefault("pad_token_id", tokenizer.pad_token_id)
+
+    t_generate = time.perf_counter()
+    with torch.inference_mode():
+        out = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            **generate_kwargs,
+        )
+
+    pad_id = generate_kwargs["pad_token_id"]
+    texts = []
+    lengths = []
+    rows = out[:, prompt_len:].tolist()
+    for row in rows:
+        ids = list(row)
+        # le righe finite prima delle altre vengono riempite con pad: li togliamo
+        while ids and ids[-1] == pad_id:
+            ids.pop()
+        texts.append(tokenizer.decode(ids, skip_special_tokens=skip_special_tokens))
+        lengths.append(len(ids))
+    if timer is not None:
+        _add_timings(timings, timer, inputs, rows, lengths, generate_kwargs, (t_start, t_tokenized, t_generate))
+    if return_lengths:
+        return texts, lengths
+    return texts
+
+
+def _add_timings(timings, timer, inputs, rows, lengths, generate_kwargs, marks):
+    t_start, t_tokenized, t_generate = marks
+    steps = timer.steps or [time.perf_counter()]
+    json_stopper = next((c for c in generate_kwargs["stopping_criteria"] if isinstance(c, stopping.StopOnJsonEnd)), None)
+    reasons = metrics.stop_reasons(rows, lengths, generate_kwargs["eos_token_id"], json_stopper)
+    peak = metrics.peak_memory_mb()
+    for n, reason, prompt_tokens in zip(lengths, reasons, inputs["attention_mask"].sum(dim=1).tolist()):
+        # la riga finisce allo step n (uno in piu' se l'eos e' stato tolto insieme al padding)
+        last = steps[min(max(n, 1), len(steps)) - 1]
+        decode = last - steps[0]
+        timings.append({
+            "prompt_tokens": int(prompt_tokens),
+            "generated_tokens": n,
+            "tokenize_seconds": (t_tokenized - t_start) / len(rows),
+            "ttft": steps[0] - t_generate,
+            "latency": last - t_start,
+            "decode_seconds": decode,
+            "decode_tps": (n - 1) / decode if n > 1 and decode > 0 else None,
+            "stop": reason,
+            "peak_mem_mb": peak,
+        })
+
+
+def _inputs_after_prefix(tokenizer, prompts, prefix_ids):
+    # [prefisso][pad...][resto del prompt]; None se un prompt non inizia col prefisso
+    encoded = tokenizer(list(prompts))["input_ids"]
+    n = len(prefix_ids)
+    if not n or not all(len(ids) > n and ids[:n] == prefix_ids for ids in encoded):
+        return None
+
+    tails = [ids[n:] for ids in encoded]
+    width = max(len(t) for t in tails)
+    pad_id = tokenizer.pad_token_id
+    input_ids = [prefix_ids + [pad_id] * (width - len(t)) + t for t in tails]
+    attention = [[1] * n + [0] * (width - len(t)) + [1] * len(t) for t in tails]
+    return {"input_ids": torch.tensor(input_ids), "attention_mask": torch.tensor(attention)}
+
+
+def for_each_batch(items, process_batch, batch_size: int):
+    """
+    Chiama `process_batch(offset, batch)` su micro-batch consecutivi di `items`
+    (quindi nell'ordine originale) e stampa il throughput a fine run.
+    """
+    t0 = time.perf_counter()
+    for offset, batch in chunked(items, batch_size):
+        print(f"\n=== Processing recipes {offset + 1}-{offset + len(batch)}/{len(items)} ===")
+        process_batch(offset, batch)
+    elapsed = time.perf_counter() - t0
+    if items and elapsed > 0:
+        print(f"Throughput: {len(items) / elapsed:.2f} recipes/sec (batch_size={batch_size})")
+    return elapsed
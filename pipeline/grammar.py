@@ -0,0 +1,313 @@
+import re
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+
+# -----------------------
+# AUTOMA SULLO SCHEMA (a livello di byte)
+# -----------------------
+# Accetta esattamente:
+#   {"title": STRING, "ingredients": [STRING, ...], "steps": [STRING, ...]}
+# con spazi/a capo opzionali tra i simboli (al massimo _MAX_WS di fila, cosi'
+# il modello non puo' perdersi in una sequenza infinita di spazi).
+# Con lenient (profili -ft, addestrati sui target di D3) la terza chiave puo'
+# essere anche "directions": e' l'alias che try_parse(lenient=True) accetta.
+# Lavorare sui byte UTF-8 invece che sui caratteri rende l'automa indipendente
+# da come il tokenizer spezza i caratteri multi-byte: i byte >= 0x80 sono
+# sempre contenuto di stringa.
+_WS = frozenset(b" \t\n\r")
+_MAX_WS = 8
+_ESCAPES = frozenset(b'"\\/bfnrt')
+_HEX = frozenset(b"0123456789abcdefABCDEF")
+
+WS, STR, LIST = "ws", "str", "list"
+STEP_KEYS = ("steps",)
+LENIENT_STEP_KEYS = ("steps", "directions")
+
+
+def _lit(s: str):
+    return [("lit", b) for b in s.encode("utf-8")]
+
+
+def _alt(*keys: str):
+    # una tra piu' chiavi: nessuna e' prefisso di un'altra (finiscono tutte con '"')
+    return [("alt", tuple(f'"{k}"'.encode("utf-8") for k in keys))]
+
+
+def schema_items(step_keys=STEP_KEYS) -> tuple:
+    """Sequenza di elementi dell'automa; `step_keys` = nomi ammessi per la lista dei passi."""
+    steps_key = _lit(f'"{step_keys[0]}"') if len(step_keys) == 1 else _alt(*step_keys)
+    return tuple(
+        # spazio iniziale ammesso: con SentencePiece il primo token e' spesso "▁{"
+        [WS] + _lit("{") + [WS]
+        + _lit('"title"') + [WS] + _lit(":") + [WS] + [STR] + [WS] + _lit(",") + [WS]
+        + _lit('"ingredients"') + [WS] + _lit(":") + [WS] + [LIST] + [WS] + _lit(",") + [WS]
+        + steps_key + [WS] + _lit(":") + [WS] + [LIST] + [WS]
+        + _lit("}")
+    )
+
+
+ITEMS = schema_items()
+START = (0, 0)
+END = (len(ITEMS), 0)
+
+# sotto-stati di STRING: 0 attende '"', 1 corpo, 2 dopo '\', 3..6 cifre di \uXXXX
+_S_DONE = -1
+# sotto-stati di LIST: 0 attende '[', poi (fase, spazi letti) con fase
+# 1 dopo '[', 2 dopo una stringa, 3 dopo ','; ("s", s) = dentro una stringa
+_L_DONE = -1
+
+
+def _string_step(sub: int, b: int):
+    if sub == 0:
+        return 1 if b == 0x22 else None
+    if sub == 1:
+        if b == 0x22:
+            return _S_DONE
+        if b == 0x5C:
+            return 2
+        return None if b < 0x20 else 1
+    if sub == 2:
+        if b in _ESCAPES:
+            return 1
+        return 3 if b == 0x75 else None
+    # \uXXXX
+    if b not in _HEX:
+        return None
+    return 1 if sub == 6 else sub + 1
+
+
+def _list_step(sub, b: int):
+    if sub == 0:
+        return (1, 0) if b == 0x5B else None
+    phase, n = sub
+    if phase == "s":
+        nxt = _string_step(n, b)
+        if nxt is None:
+            return None
+        return (2, 0) if nxt == _S_DONE else ("s", nxt)
+    if b in _WS:
+        return (phase, n + 1) if n < _MAX_WS else None
+    if b == 0x22 and phase in (1, 3):
+        return ("s", 1)
+    if b == 0x5D and phase in (1, 2):
+        return _L_DONE
+    if b == 0x2C and phase == 2:
+        return (3, 0)
+    return None
+
+
+def step(state, b: int, items=ITEMS):
+    """Consuma un byte; restituisce il nuovo stato o None se il byte viola lo schema."""
+    i, sub = state
+    while i < len(items):
+        item = items[i]
+        if item == WS:
+            if b in _WS:
+                return (i, sub + 1) if sub < _MAX_WS else None
+            i, sub = i + 1, 0  # spazi opzionali: passa all'elemento successivo
+            continue
+        if item == STR:
+            nxt = _string_step(sub, b)
+            if nxt is None:
+                return None
+            return (i + 1, 0) if nxt == _S_DONE else (i, nxt)
+        if item == LIST:
+            nxt = _list_step(sub, b)
+            if nxt is None:
+                return None
+            return (i + 1, 0) if nxt == _L_DONE else (i, nxt)
+        if item[0] == "alt":
+            # sub = byte della chiave letti finora (0 all'ingresso)
+            prefix = (sub or b"") + bytes([b])
+            if prefix in item[1]:
+                return (i + 1, 0)
+            return (i, prefix) if any(k.startswith(prefix) for k in item[1]) else None
+        return (i + 1, 0) if b == item[1] else None
+    return None  # dopo la '}' finale non si accetta altro
+
+
+def _is_string_body(state, items=ITEMS) -> bool:
+    i, sub = state
+    if i >= len(items):
+        return False
+    return (items[i] == STR and sub == 1) or (items[i] == LIST and sub == ("s", 1))
+
+
+# -----------------------
+# DAL TOKENIZER AI BYTE
+# -----------------------
+_BYTE_FALLBACK = re.compile(r"<0x([0-9A-Fa-f]{2})>")
+
+
+def _bytes_to_unicode():
+    # stessa tabella di GPT-2: byte -> carattere stampabile usato dai BPE byte-level
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+def token_bytes(tokenizer):
+    """
+    Byte prodotti da ciascun token del vocabolario (None per token speciali/aggiunti).
+    Gestisce sia SentencePiece ("▁" e byte-fallback <0xNN>, Phi-3 / Mistral)
+    sia BPE byte-level (Qwen).
+    """
+    added = set(getattr(tokenizer, "added_tokens_decoder", {}) or {}) | set(tokenizer.all_special_ids)
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    byte_level = backend is not None and "ByteLevel" in repr(backend.decoder)
+    byte_decoder = {c: b for b, c in _bytes_to_unicode().items()}
+
+    out = []
+    for i, tok in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if tok is None or i in added:
+            out.append(None)
+            continue
+        m = _BYTE_FALLBACK.fullmatch(tok)
+        if m:
+            out.append(bytes([int(m.group(1), 16)]))
+        elif byte_level and all(c in byte_decoder for c in tok):
+            out.append(bytes(byte_decoder[c] for c in tok))
+        else:
+            out.append(tok.replace("▁", " ").encode("utf-8"))
+    return [b if b else None for b in out]
+
+
+# -----------------------
+# AUTOMA A LIVELLO DI TOKEN (maschere precompilate per tokenizer)
+# -----------------------
+class TokenSchemaAutomaton:
+    """
+    Per ogni stato dell'automa calcola (una volta, alla prima visita) quali token
+    sono ammessi e in che stato portano. Le maschere sul vocabolario restano in
+    cache, quindi durante la generazione ogni step costa un lookup per riga.
+    `step_keys`: nomi ammessi per la lista dei passi (vedi schema_items).
+    """
+
+    def __init__(self, tokenizer, step_keys=STEP_KEYS):
+        self.tok_bytes = token_bytes(tokenizer)
+        self.eos_id = tokenizer.eos_token_id
+        self.items = schema_items(step_keys)
+        self.end = (len(self.items), 0)
+
+        # token "semplici": solo contenuto di stringa (niente '"', '\', controlli)
+        self.plain = [
+            tb is not None and all(b >= 0x20 and b not in (0x22, 0x5C) for b in tb)
+            for tb in self.tok_bytes
+        ]
+        self.by_first = {}
+        for t, tb in enumerate(self.tok_bytes):
+            if tb is not None:
+                self.by_first.setdefault(tb[0], []).append(t)
+
+        self._trans = {}
+        self._masks = {}
+
+    def _transitions(self, state):
+        trans = self._trans.get(state)
+        if trans is not None:
+            return trans
+
+        if _is_string_body(state, self.items):
+            # i token semplici restano nel corpo della stringa: basta simulare gli altri
+            candidates = [t for t, tb in enumerate(self.tok_bytes) if tb is not None and not self.plain[t]]
+        else:
+            candidates = [t for b, ids in self.by_first.items() if step(state, b, self.items) is not None for t in ids]
+
+        trans = {}
+        for t in candidates:
+            s = state
+            for b in self.tok_bytes[t]:
+                s = step(s, b, self.items)
+                if s is None:
+                    break
+            if s is not None:
+                trans[t] = s
+        self._trans[state] = trans
+        return trans
+
+    def advance(self, state, token_id: int):
+        if state is None:
+            return None
+        nxt = self._transitions(state).get(token_id)
+        if nxt is None and _is_string_body(state, self.items) and token_id < len(self.plain) and self.plain[token_id]:
+            return state
+        return nxt
+
+    def mask(self, state, vocab_size: int, device):
+        key = (state, vocab_size, str(device))
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = torch.zeros(vocab_size, dtype=torch.bool)
+            if state == self.end:
+                mask[self.eos_id] = True
+            else:
+                allowed = [t for t in self._transitions(state) if t < vocab_size]
+                mask[allowed] = True
+                if _is_string_body(state, self.items):
+                    n = min(vocab_size, len(self.plain))
+                    mask[:n] |= torch.tensor(self.plain[:n], dtype=torch.bool)
+                if not mask.any():
+                    mask[self.eos_id] = True  # non dovrebbe succedere: meglio chiudere che generare a caso
+            mask = mask.to(device)
+            self._masks[key] = mask
+        return mask
+
+
+_AUTOMATA = {}
+
+
+def schema_automaton(tokenizer, step_keys=STEP_KEYS):
+    key = (tokenizer.name_or_path, len(tokenizer), tuple(step_keys))
+    automaton = _AUTOMATA.get(key)
+    if automaton is None:
+        automaton = TokenSchemaAutomaton(tokenizer, step_keys)
+        _AUTOMATA[key] = automaton
+    return automaton
+
+
+class SchemaLogitsProcessor(LogitsProcessor):
+    """
+    Vincola ogni riga del batch a produrre solo JSON valido per lo schema
+    {title, ingredients, steps} (o directions, con lenient): niente code fences,
+    chiavi sbagliate o JSON rotto.
+    """
+
+    def __init__(self, automaton, prompt_len: int):
+        self.automaton = automaton
+        self.prompt_len = prompt_len
+        self.states = None
+
+    def __call__(self, input_ids, scores):
+        if self.states is None:
+            self.states = [START] * input_ids.shape[0]
+        elif input_ids.shape[1] > self.prompt_len:
+            last = input_ids[:, -1].tolist()
+            self.states = [self.automaton.advance(s, t) for s, t in zip(self.states, last)]
+
+        for row, state in enumerate(self.states):
+            if state is None:
+                continue  # riga gia' chiusa (ora riceve solo pad)
+            mask = self.automaton.mask(state, scores.shape[-1], scores.device)
+            scores[row] = scores[row].masked_fill(~mask, float("-inf"))
+        return scores
+
+
+def schema_kwargs(tokenizer, lenient: bool = False):
+    """
+    kwargs_factory per generation.generate_batch: aggiunge SchemaLogitsProcessor.
+    `lenient` come in parsing.try_parse (profile.lenient_parse): i modelli -ft
+    sono addestrati su target con "directions" e possono restare su quella chiave.
+    """
+    automaton = schema_automaton(tokenizer, LENIENT_STEP_KEYS if lenient else STEP_KEYS)
+
+    def factory(prompt_len):
+        return {"logits_processor": LogitsProcessorList([SchemaLogitsProcessor(automaton, prompt_len)])}
+
+    return factory
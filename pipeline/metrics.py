@@ -0,0 +1,179 @@
+"""
+Misure per ricetta di tokenizzazione, prefill, decode e parsing.
+
+generation.generate_batch aggiunge StepTimer agli stopping criteria: la
+prima chiamata arriva appena il prefill ha prodotto il primo token (TTFT),
+le successive danno l'istante in cui ogni riga ha generato il suo ultimo
+token, quindi latenza e token/s di decode sono per riga anche dentro un
+micro-batch. Il motivo dello stop (EOS, JSON chiuso da StopOnJsonEnd o
+budget esaurito) si ricava dagli stessi id generati. Timings raccoglie i
+valori di un run e ne fa il riepilogo con p50/p95/p99.
+"""
+import array
+import collections
+import sys
+import time
+
+import numpy as np
+import torch
+from transformers import StoppingCriteria
+
+# motivi di stop di una riga ("cache" = output preso da gen_cache, nessuna generazione)
+STOP_REASONS = ("eos", "json", "budget", "cache")
+PERCENTILES = (50, 95, 99)
+
+
+class StepTimer(StoppingCriteria):
+    """Non ferma nulla: annota l'istante di ogni step di decode (step k = k token generati)."""
+
+    def __init__(self):
+        self.steps = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.steps.append(time.perf_counter())
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+def stop_reasons(rows, lengths, eos_ids, json_stopper=None) -> list:
+    """
+    Motivo dello stop per riga: "json" se StopOnJsonEnd l'ha chiusa, "eos" se
+    ha finito prima delle altre righe o con un token di fine sequenza,
+    altrimenti "budget" (max_new_tokens esaurito). `rows` sono gli id
+    generati con il padding finale, `lengths` i token utili (senza padding).
+    """
+    eos_ids = set(eos_ids) if isinstance(eos_ids, (list, tuple, set)) else {eos_ids}
+    done = json_stopper.rows if json_stopper is not None and json_stopper.rows else None
+    reasons = []
+    for i, (ids, n) in enumerate(zip(rows, lengths)):
+        if done is not None and done[i][4]:
+            reasons.append("json")
+        elif n < len(ids) or (n and ids[n - 1] in eos_ids):
+            reasons.append("eos")   # le righe finite vengono riempite di pad (con pad == eos l'eos sparisce da n)
+        else:
+            reasons.append("budget")
+    return reasons
+
+
+def reset_peak_memory():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory_mb() -> float | None:
+    """
+    Picco di memoria: allocata su GPU dall'ultimo reset_peak_memory,
+    altrimenti RSS massimo del processo (None se non misurabile).
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    try:
+        import resource   # solo Unix
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024   # byte su macOS, KiB su Linux
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 2**20   # Windows: peak working set
+    except ImportError:
+        return None
+
+
+def memory_mb() -> float | None:
+    """
+    Memoria occupata adesso: allocata su GPU, altrimenti RSS del processo
+    (serve per misurare il peso di un modello caricato; None se non misurabile).
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.memory_allocated() / 2**20
+    try:
+        import resource
+
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except (ImportError, OSError):
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        return peak_memory_mb()
+
+
+def percentiles(values, qs=PERCENTILES) -> dict:
+    values = np.asarray([v for v in values if v is not None], dtype=np.float64)
+    if not len(values):
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": float(np.percentile(values, q)) for q in qs}
+
+
+# -----------------------
+# RIEPILOGO DI UN RUN
+# -----------------------
+class Timings:
+    """Valori per ricetta di un run (array compatti: vale anche per run in streaming lunghi)."""
+
+    FIELDS = ("latency", "ttft", "decode_tps", "tokenize_seconds", "parse_seconds", "prompt_tokens", "generated_tokens")
+
+    def __init__(self):
+        self.values = {name: array.array("d") for name in self.FIELDS}
+        self.stops = collections.Counter()
+        self.retried = 0
+        self.recipes = 0
+        self.peak_mem_mb = 0.0
+
+    def add(self, record: dict):
+        """Aggiunge un record (results.ResultRecord.to_dict() o dict con gli stessi campi)."""
+        self.recipes += 1
+        for name in self.FIELDS:
+            if record.get(name) is not None:
+                self.values[name].append(record[name])
+        self.stops[record.get("stop") or "unknown"] += 1
+        self.retried += bool(record.get("retried"))
+        self.peak_mem_mb = max(self.peak_mem_mb, record.get("peak_mem_mb") or 0.0)
+
+    def summary(self) -> dict:
+        out = {"recipes": self.recipes, "retried": self.retried, "stops": dict(self.stops),
+               "peak_mem_mb": round(self.peak_mem_mb, 1)}
+        for name in ("latency", "ttft", "decode_tps"):
+            out[name] = {k: None if v is None else round(v, 4) for k, v in percentiles(self.values[name]).items()}
+        for name in ("tokenize_seconds", "parse_seconds", "prompt_tokens", "generated_tokens"):
+            vals = self.values[name]
+            out[f"mean_{name}"] = round(sum(vals) / len(vals), 4) if len(vals) else None
+        return out
+
+
+def print_summary(summary: dict):
+    def fmt(stat, unit="s", scale=1.0):
+        return " ".join(f"{k}={'-' if v is None else f'{v * scale:.1f}{unit}'}" for k, v in stat.items())
+
+    print(f"Latency per recipe: {fmt(summary['latency'], 'ms', 1000)} | TTFT: {fmt(summary['ttft'], 'ms', 1000)}")
+    peak = f"{summary['peak_mem_mb']:.0f} MB" if summary["peak_mem_mb"] else "-"
+    print(f"Decode tok/s: {fmt(summary['decode_tps'], '')} | stop: {summary['stops']} | "
+          f"retried: {summary['retried']}/{summary['recipes']} | peak memory: {peak}")
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from pipeline import results
+
+    parser = argparse.ArgumentParser(description="Riepilogo p50/p95/p99 di un file di risultati (pipeline/results.py)")
+    parser.add_argument("records", nargs="+", help="JSONL di ResultRecord (es. recipes_extracted.jsonl)")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    for path in args.records:
+        timings = Timings()
+        for row in results.read_records(path).values():
+            timings.add(row)
+        if args.json:
+            print(json.dumps({"path": path, **timings.summary()}, indent=2))
+        else:
+            print(f"\n=== {path} ===")
+            print_summary(timings.summary())
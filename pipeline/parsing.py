@@ -0,0 +1,83 @@
+import json
+import re
+
+
+def strip_code_fences(s: str) -> str:
+    # rimuove eventuali ```json ... ``` che il modello a volte aggiunge
+    s = re.sub(r"```(?:json)?\s*", "", s, flags=re.IGNORECASE)
+    s = s.replace("```", "")
+    return s.strip()
+
+def extract_first_json_block(s: str):
+    """
+    Estrae il primo blocco JSON completo { ... }.
+    Gestisce correttamente { } dentro stringhe JSON (tra " ").
+    """
+    s = strip_code_fences(s)
+    start = s.find("{")
+    if start == -1:
+        return None
+
+    depth = 0
+    in_str = False
+    esc = False
+
+    for i in range(start, len(s)):
+        ch = s[i]
+
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+        else:
+            if ch == '"':
+                in_str = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    return s[start : i + 1]
+
+    return None
+
+def try_parse(decoded: str, lenient: bool = False):
+    """
+    Restituisce (obj, errore, json_str).
+
+    - lenient=False (Inferenza): le chiavi devono essere ESATTAMENTE title, ingredients, steps
+    - lenient=True (Valutazione): accetta l'alias directions -> steps, ignora
+      chiavi extra e controlla solo i tipi
+    """
+    json_str = extract_first_json_block(decoded)
+    if json_str is None:
+        return None, "no_json", None
+
+    try:
+        obj = json.loads(json_str)
+    except json.JSONDecodeError as e:
+        return None, (f"invalid_json: {e}" if lenient else "invalid_json"), json_str
+
+    if not lenient:
+        if not isinstance(obj, dict) or set(obj.keys()) != {"title", "ingredients", "steps"}:
+            return None, "bad_keys", json_str
+        return obj, None, json_str
+
+    # alias: directions -> steps (nel caso raro)
+    if "steps" not in obj and "directions" in obj:
+        obj["steps"] = obj.pop("directions")
+
+    # tieni SOLO le chiavi richieste
+    obj = {
+        "title": obj.get("title", ""),
+        "ingredients": obj.get("ingredients", []),
+        "steps": obj.get("steps", []),
+    }
+
+    if not isinstance(obj["title"], str) or not isinstance(obj["ingredients"], list) or not isinstance(obj["steps"], list):
+        return None, "bad_types", json_str
+
+    return obj, None, json_str
@@ -0,0 +1,121 @@
+import copy
+import hashlib
+import time
+
+import torch
+from transformers import DynamicCache
+
+
+def common_prefix_ids(tokenizer, render) -> list:
+    """
+    Token comuni a tutti i prompt: template + SYSTEM (+ "Recipe text:\\n").
+    Si rendono due prompt con ricette diverse e si prende il prefisso comune
+    degli id, togliendo l'ultimo token: al confine il tokenizer potrebbe
+    fondere il prefisso con l'inizio della ricetta.
+    """
+    a = tokenizer(render("A"))["input_ids"]
+    b = tokenizer(render("Z"))["input_ids"]
+    n = 0
+    while n < min(len(a), len(b)) and a[n] == b[n]:
+        n += 1
+    return a[: max(0, n - 1)]
+
+
+class PrefixKVCache:
+    """
+    KV cache del prefisso costante dei prompt, calcolato UNA volta per modello
+    e per system prompt (chiave = hash del testo di sistema). Ogni chiamata a
+    generate parte da una copia della cache, quindi il prefill riguarda solo
+    la parte del prompt che dipende dalla ricetta, anche per i retry con
+    RETRY_SYSTEM (che hanno la loro voce in cache).
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self._entries = {}
+
+    def get(self, system_text: str, build_prompt):
+        """
+        `build_prompt(recipe_text, system_text) -> str` e' la stessa funzione
+        usata dallo script per costruire i prompt.
+        Restituisce (prefix_ids, cache) da passare a generation.generate_batch.
+        """
+        key = hashlib.sha256(system_text.encode("utf-8")).hexdigest()
+        entry = self._entries.get(key)
+        if entry is None:
+            ids = common_prefix_ids(self.tokenizer, lambda text: build_prompt(text, system_text))
+            cache = DynamicCache()
+            if ids:
+                device = next(self.model.parameters()).device
+                with torch.no_grad():
+                    out = self.model(
+                        input_ids=torch.tensor([ids], device=device),
+                        past_key_values=cache,
+                        use_cache=True,
+                    )
+                cache = out.past_key_values
+            entry = (ids, cache)
+            self._entries[key] = entry
+        return entry
+
+
+def expand_prefix(prefix, batch_size: int):
+    """Copia della cache del prefisso replicata per `batch_size` righe."""
+    prefix_ids, cache = prefix
+    cache = copy.deepcopy(cache)
+    if batch_size > 1:
+        cache.batch_repeat_interleave(batch_size)
+    return cache
+
+
+# -----------------------
+# BENCHMARK: time-to-first-token con e senza cache del prefisso
+# -----------------------
+def bench_ttft(model, tokenizer, recipes, system_text: str, build_prompt, repeats: int = 3):
+    from pipeline import generation
+
+    prefix_cache = PrefixKVCache(model, tokenizer)
+    prefix_cache.get(system_text, build_prompt)  # prefill una tantum, escluso dalla misura
+
+    def ttft(use_cache: bool) -> float:
+        times = []
+        for recipe in recipes:
+            prompt = build_prompt(recipe, system_text)
+            prefix = prefix_cache.get(system_text, build_prompt) if use_cache else None
+            best = float("inf")
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                generation.generate_batch(model, tokenizer, [prompt], max_new_tokens=1, prefix=prefix)
+                best = min(best, time.perf_counter() - t0)
+            times.append(best)
+        return sum(times) / len(times)
+
+    n_prefix = len(prefix_cache.get(system_text, build_prompt)[0])
+    n_total = sum(len(tokenizer(build_prompt(r, system_text))["input_ids"]) for r in recipes) / len(recipes)
+    without, with_cache = ttft(False), ttft(True)
+    print(f"prefix tokens: {n_prefix} / avg prompt tokens: {n_total:.0f} ({n_prefix / n_total:.0%})")
+    print(f"TTFT without cache: {without * 1000:8.1f} ms")
+    print(f"TTFT with cache:    {with_cache * 1000:8.1f} ms  (x{without / with_cache:.2f})")
+    return {"prefix_tokens": n_prefix, "prompt_tokens": n_total, "ttft_no_cache": without, "ttft_cache": with_cache}
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    from pipeline import prompts
+
+    parser = argparse.ArgumentParser(description="TTFT con e senza KV cache del prefisso SYSTEM")
+    parser.add_argument("model", help="id HF o cartella locale del modello")
+    parser.add_argument("--d2", default=os.path.join(os.path.dirname(__file__), "..", "0.Dataset", "D2.txt"))
+    parser.add_argument("--recipes", type=int, default=10)
+    args = parser.parse_args()
+
+    tok = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    mdl = AutoModelForCausalLM.from_pretrained(args.model, trust_remote_code=True).eval()
+    with open(args.d2, encoding="utf-8") as f:
+        blocks = [b.strip() for b in f.read().split("\n\n") if b.strip()][: args.recipes]
+
+    bench_ttft(mdl, tok, blocks, prompts.SYSTEM, lambda text, system: prompts.build_prompt(tok, text, system))
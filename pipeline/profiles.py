@@ -0,0 +1,158 @@
+import os
+from dataclasses import dataclass, replace
+
+from pipeline import prompts
+
+# root del progetto: i percorsi di adapter / offload / dataset sono relativi a questa
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+@dataclass(frozen=True)
+class ModelProfile:
+    """
+    Tutto cio' che distingue un modello (o un modello + adapter) dagli altri.
+    Il codice di caricamento, generazione, parsing e addestramento e' unico:
+    qui ci sono solo i parametri.
+    """
+
+    name: str
+    model_id: str
+
+    # caricamento
+    dtype: str = "fp16"                 # "fp16" | "bf16" (bf16 se la GPU lo supporta); su CPU sempre fp32
+    attn_implementation: str = "eager"
+    quantization: str | None = None     # "nf4" = 4 bit (bitsandbytes)
+    fix_rope_scaling: bool = False      # workaround per rope_scaling che rompe il caricamento
+    adapter_dir: str | None = None      # adapter LoRA da 2.Addestramento
+    tokenizer_from_adapter: bool = False
+    offload_dir: str | None = None
+    # digest dell'adapter gia' sommato nei pesi (checkpoint di pipeline/export.py):
+    # al posto di adapter_dir nella chiave della cache delle generazioni
+    merged_adapter_digest: str | None = None
+
+    # prompt
+    system: str = prompts.SYSTEM
+    user_template: str = prompts.USER_TEMPLATE
+
+    # generazione
+    stop: str | None = "json"           # "json" = StopOnJsonEnd, None = solo EOS
+    force_lbrace: bool = False          # primo token forzato a "{" (se non si usa la grammatica)
+    max_new_tokens: int = 700
+    retry_max_new_tokens: int | None = 1200   # None = nessun retry con RETRY_SYSTEM
+    # budget del primo tentativo stimato su D3 (pipeline/budget.py) al quantile dato,
+    # raddoppiato solo per le righe troncate fino a max_new_tokens; None = sempre max_new_tokens.
+    # La stima usa i JSON di D3 (compatti, con "directions"): e' l'output dei modelli
+    # addestrati su D3, non dei modelli base (chiavi "steps", formattazione libera),
+    # quindi e' attiva solo nei profili -ft. Richiede 2.Addestramento/D3.csv.
+    budget_quantile: float | None = None
+    dynamic_budget: bool = False        # max(256, min(max_new_tokens, contesto - prompt - 8))
+    skip_special_tokens: bool = True
+
+    # parsing
+    lenient_parse: bool = False
+
+    # addestramento
+    max_length: int | None = 512    # None = scelto dall'audit delle lunghezze di D3
+    train_quantization: str | None = None   # "nf4" = QLoRA
+    optim: str = "adamw_torch"
+    group_by_length: bool = False
+    padding: str = "pack"   # "pack" | "dynamic" | "max_length" (vedi training.prepare_for_training)
+
+    @property
+    def retry_system(self) -> str:
+        return self.system + prompts.RETRY_SUFFIX
+
+    @property
+    def tokenizer_source(self) -> str:
+        return self.adapter_dir if self.tokenizer_from_adapter and self.adapter_dir else self.model_id
+
+
+def _adapter(folder: str, name: str) -> str:
+    return os.path.join(ROOT, "2.Addestramento", folder, f"{name}-recipe-json-model")
+
+
+def _offload(folder: str) -> str:
+    return os.path.join(ROOT, "3.Valutazione", folder, "offload")
+
+
+PHI3 = ModelProfile(
+    name="phi3",
+    model_id="microsoft/Phi-3-mini-4k-instruct",
+    fix_rope_scaling=True,
+)
+
+QWEN = ModelProfile(
+    name="qwen2.5",
+    model_id="Qwen/Qwen2.5-1.5B-Instruct",
+    dtype="bf16",
+    system=prompts.SYSTEM_STRICT,
+    force_lbrace=True,
+)
+
+MISTRAL = ModelProfile(
+    name="mistral",
+    model_id="mistralai/Mistral-7B-Instruct-v0.3",
+    attn_implementation="sdpa",
+    fix_rope_scaling=True,
+    max_new_tokens=300,
+    retry_max_new_tokens=600,
+    # 192 mascherava per intero quasi tutte le righe (il prefisso da solo e'
+    # piu' lungo): lunghezza scelta dall'audit, righe senza loss scartate
+    max_length=None,
+    train_quantization="nf4",
+    optim="paged_adamw_8bit",
+    group_by_length=True,
+)
+
+# modelli base + adapter LoRA addestrati (3.Valutazione)
+PHI3_FT = replace(
+    PHI3,
+    name="phi3-ft",
+    fix_rope_scaling=False,
+    adapter_dir=_adapter("Phi3", "phi3"),
+    tokenizer_from_adapter=True,
+    offload_dir=_offload("Phi3"),
+    system=prompts.SYSTEM_STRICT,
+    max_new_tokens=1200,
+    retry_max_new_tokens=2000,
+    lenient_parse=True,
+    budget_quantile=0.95,
+)
+
+QWEN_FT = replace(
+    QWEN,
+    name="qwen2.5-ft",
+    dtype="fp16",
+    force_lbrace=False,
+    adapter_dir=_adapter("Qwen2.5", "qwen"),
+    tokenizer_from_adapter=True,
+    max_new_tokens=1200,
+    retry_max_new_tokens=2000,
+    lenient_parse=True,
+    budget_quantile=0.95,
+)
+
+MISTRAL_FT = replace(
+    MISTRAL,
+    name="mistral-ft",
+    quantization="nf4",
+    fix_rope_scaling=False,
+    adapter_dir=_adapter("Mistral", "mistral"),
+    offload_dir=_offload("Mistral"),
+    user_template="{recipe}\n\nReturn ONLY JSON. Start now:\n",
+    max_new_tokens=1200,
+    retry_max_new_tokens=None,
+    dynamic_budget=True,
+    skip_special_tokens=False,
+    lenient_parse=True,
+    budget_quantile=0.95,
+)
+
+PROFILES = {p.name: p for p in (PHI3, QWEN, MISTRAL, PHI3_FT, QWEN_FT, MISTRAL_FT)}
+
+
+def get_profile(name: str) -> ModelProfile:
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise KeyError(f"Profilo sconosciuto: {name!r}. Disponibili: {', '.join(PROFILES)}") from None
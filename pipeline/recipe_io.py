@@ -0,0 +1,263 @@
+import bisect
+import csv
+import json
+import mmap
+import os
+import re
+import sys
+
+# "ID 12 — Title" (il corpo segue sulle righe successive, oppure sulla stessa riga)
+_D2_HEADER = re.compile(r"^ID\s+(\d+)\s*[—–-]\s*(.*)$")
+# la stessa intestazione sui byte grezzi (— e – in UTF-8), per l'indice di D2
+_D2_HEADER_BYTES = re.compile(rb"^ID\s+(\d+)\s*(?:\xe2\x80\x94|\xe2\x80\x93|-)")
+
+
+# -----------------------
+# LETTURA (lazy: una ricetta alla volta)
+# -----------------------
+def _d2_text(lines, normalize: bool) -> str:
+    """Testo di un blocco di D2 dalle sue righe (la prima e' l'intestazione "ID n — ...")."""
+    m = _D2_HEADER.match(lines[0])
+    if normalize:
+        parts = [m.group(2).strip()] + [line.strip() for line in lines[1:] if line.strip()]
+        return "\n".join(parts).strip()
+    return "".join([m.group(2) + "\n"] + lines[1:]).strip()
+
+
+def iter_d2(path: str, normalize: bool = True):
+    """
+    Ricette di D2.txt come coppie (id, testo), lette riga per riga.
+    Il testo e' "titolo\ncorpo" come nella colonna text di D3; per i blocchi
+    scritti su una riga sola e' la riga intera dopo "ID n — ".
+    Con normalize=False il blocco resta com'e' (solo strip agli estremi),
+    come lo estraeva training_dataset.py con la regex su tutto il file.
+    """
+    rid, lines = None, []
+    with open(path, encoding="utf-8", errors="strict" if normalize else "replace") as f:
+        for line in f:
+            m = _D2_HEADER.match(line)
+            if m:
+                if rid is not None:
+                    yield rid, _d2_text(lines, normalize)
+                rid, lines = int(m.group(1)), [line]
+            elif rid is not None:
+                lines.append(line)
+    if rid is not None:
+        yield rid, _d2_text(lines, normalize)
+
+
+def recipe_id(value, n: int, path: str) -> int:
+    """
+    Id intero di una riga: numero o stringa di cifre; se manca, la posizione
+    `n`. Un id non numerico e' un errore (ValueError con file e riga): i
+    ResultRecord e il gold di D1 si uniscono per id intero.
+    """
+    if value is None or value == "":
+        return n
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    raise ValueError(f"{path}: riga {n + 1}: id non numerico {value!r}")
+
+
+def iter_jsonl(path: str, id_key: str = "id", text_key: str = "text"):
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            line = line.strip()
+            if line:
+                row = json.loads(line)
+                yield recipe_id(row.get(id_key), n, path), row[text_key]
+
+
+def iter_csv(path: str, id_key: str = "id", text_key: str = "text"):
+    csv.field_size_limit(min(sys.maxsize, 2**31 - 1))  # ricette lunghe su piu' righe
+    with open(path, encoding="utf-8", newline="") as f:
+        for n, row in enumerate(csv.DictReader(f)):
+            yield recipe_id(row.get(id_key), n, path), row[text_key] or ""
+
+
+def iter_recipes(path: str, id_key: str = "id", text_key: str = "text"):
+    """
+    (id, testo) da D2.txt, JSONL o CSV secondo l'estensione.
+    Un .json (lista di testi, come RECIPES negli script) usa la posizione come id.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".txt":
+        return iter_d2(path)
+    if ext == ".jsonl":
+        return iter_jsonl(path, id_key, text_key)
+    if ext == ".csv":
+        return iter_csv(path, id_key, text_key)
+    if ext == ".json":
+        with open(path, encoding="utf-8") as f:
+            return iter(list(enumerate(json.load(f))))
+    raise ValueError(f"Formato non supportato: {path!r} (attesi .txt, .jsonl, .csv, .json)")
+
+
+# -----------------------
+# INDICE DI D2.txt (id -> offset, lunghezza)
+# -----------------------
+class D2Index:
+    """
+    Accesso diretto alle ricette di D2.txt per id. L'indice (id, offset,
+    lunghezza in byte di ogni blocco) sta in un file accanto, <D2>.idx.npz,
+    costruito una volta e ricostruito solo se D2.txt cambia (dimensione o
+    mtime). Il file si legge in mmap: get(id) tocca solo i byte del blocco.
+    A parita' di id vale l'ultima occorrenza, come in iter_d2 + dict.
+    """
+
+    def __init__(self, path: str, index_path: str | None = None):
+        self.path = path
+        self.index_path = index_path or path + ".idx.npz"
+        entries = self._load() if self._fresh() else self._build()
+        self._where = {int(rid): (int(off), int(length)) for rid, off, length in entries}
+        self.ids = sorted(self._where)
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+
+    def _stamp(self):
+        st = os.stat(self.path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _fresh(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        import numpy as np
+
+        with np.load(self.index_path) as data:
+            return data["stamp"].tolist() == self._stamp()
+
+    def _load(self):
+        import numpy as np
+
+        with np.load(self.index_path) as data:
+            return data["entries"].tolist()
+
+    def _build(self):
+        """Una passata sui byte del file: offset di ogni intestazione "ID n — "."""
+        import numpy as np
+
+        entries, rid, start, pos = [], None, 0, 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                m = _D2_HEADER_BYTES.match(line)
+                if m:
+                    if rid is not None:
+                        entries.append((rid, start, pos - start))
+                    rid, start = int(m.group(1)), pos
+                pos += len(line)
+        if rid is not None:
+            entries.append((rid, start, pos - start))
+
+        tmp = self.index_path + ".tmp.npz"
+        np.savez(tmp, entries=np.array(entries, dtype=np.int64).reshape(-1, 3), stamp=np.array(self._stamp()))
+        os.replace(tmp, self.index_path)
+        return entries
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, rid) -> bool:
+        return rid in self._where
+
+    def get(self, rid: int, normalize: bool = True) -> str:
+        """Testo della ricetta `rid` (KeyError se non c'e'), come lo restituirebbe iter_d2."""
+        offset, length = self._where[rid]
+        block = self._mm[offset : offset + length].decode("utf-8", errors="replace").replace("\r\n", "\n")
+        return _d2_text(block.splitlines(keepends=True), normalize)
+
+    def iter_range(self, start: int, stop: int, normalize: bool = True):
+        """(id, testo) per gli id in [start, stop), in ordine di id, leggendo solo quei blocchi."""
+        lo, hi = bisect.bisect_left(self.ids, start), bisect.bisect_left(self.ids, stop)
+        for rid in self.ids[lo:hi]:
+            yield rid, self.get(rid, normalize)
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# -----------------------
+# SCRITTURA (una riga JSON per record, subito su disco)
+# -----------------------
+class JsonlWriter:
+    """
+    Appende un record per riga. Ogni riga va su disco con una sola write su un
+    file aperto in O_APPEND, quindi o c'e' tutta o (se il processo muore a meta')
+    resta un frammento senza "\n" finale, che read_jsonl ignora e
+    repair_jsonl_tail elimina prima di riprendere.
+    """
+
+    def __init__(self, path: str, append: bool = True, fsync: bool = False):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.fsync = fsync
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if append else os.O_TRUNC)
+        self._fd = os.open(path, flags, 0o644)
+
+    def write(self, record: dict):
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        written = os.write(self._fd, data)
+        while written < len(data):  # write parziale (raro): completa la stessa riga
+            written += os.write(self._fd, data[written:])
+        if self.fsync:
+            os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_jsonl(path: str):
+    """Record delle righe COMPLETE di un JSONL (una riga troncata non conta)."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # ultima riga scritta a meta'
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def repair_jsonl_tail(path: str) -> int:
+    """Tronca l'eventuale riga incompleta in fondo al file; restituisce i byte tolti."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        pos = size
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            nl = chunk.rfind(b"\n")
+            if nl != -1:
+                pos = pos - step + nl + 1
+                break
+            pos -= step
+        if pos < size:
+            f.truncate(pos)
+        return size - pos
+
+
+def done_ids(path: str, key: str = "id") -> set:
+    """Id gia' presenti (con una riga completa) in un JSONL di risultati."""
+    return {row[key] for row in read_jsonl(path) if key in row}
@@ -0,0 +1,133 @@
+"""
+Schema unico dei risultati: un record per ricetta (riuscita o fallita),
+scritto allo stesso modo da Inferenza, Valutazione, run in streaming e
+baseline. Ogni record porta il recipe id, quindi il confronto con il gold
+(pipeline/scoring.py) o tra modelli e' un join per id, senza indovinare
+l'allineamento da titoli o da indici 0/1-based.
+"""
+import os
+from dataclasses import asdict, dataclass, field
+
+from pipeline import recipe_io
+
+
+@dataclass
+class ResultRecord:
+    id: int
+    model: str                      # profilo (es. "qwen2.5-ft") o modello API della baseline
+    model_id: str | None = None     # checkpoint / nome del modello
+    adapter: str | None = None      # adapter LoRA (nome della cartella), None = modello base
+    stage: str | None = None        # "inferenza" | "valutazione" | "stream" | "baseline"
+    output: dict | None = None      # {title, ingredients, steps}; None se fallita
+    error: str | None = None        # motivo del fallimento (no_json, invalid_json, errore API...)
+    attempts: int = 1               # generazioni / richieste fatte per questa ricetta
+    prompt_tokens: int | None = None
+    generated_tokens: int | None = None
+    seconds: float | None = None    # tempo di generazione attribuito alla ricetta
+    raw: str | None = None          # testo generato, solo per i fallimenti
+    # misure per ricetta (pipeline/metrics.py); None dove lo stadio non le ha
+    latency: float | None = None    # dall'inizio del micro-batch all'ultimo token, sommata sui tentativi
+    ttft: float | None = None       # prefill fino al primo token, primo tentativo
+    decode_tps: float | None = None
+    tokenize_seconds: float | None = None
+    parse_seconds: float | None = None
+    peak_mem_mb: float | None = None
+    retried: bool = False           # piu' di un tentativo (escalation, retry, richiesta ripetuta)
+    stop: str | None = None         # "eos" | "json" | "budget" | "cache", ultimo tentativo
+    extra: dict = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return self.output is not None
+
+    def to_dict(self) -> dict:
+        row = asdict(self)
+        row["ok"] = self.ok
+        if not row["extra"]:
+            del row["extra"]
+        return row
+
+
+def profile_fields(profile) -> dict:
+    """model / model_id / adapter di un ModelProfile, come vanno nel record."""
+    adapter = os.path.basename(os.path.normpath(profile.adapter_dir)) if profile.adapter_dir else None
+    return {"model": profile.name, "model_id": profile.model_id, "adapter": adapter}
+
+
+def write_records(path: str, records, append: bool = False):
+    """Scrive i record (ResultRecord o dict) come JSONL, uno per riga."""
+    with recipe_io.JsonlWriter(path, append=append) as writer:
+        for record in records:
+            writer.write(record.to_dict() if isinstance(record, ResultRecord) else record)
+
+
+def read_records(path: str) -> dict:
+    """Ultimo record per id (un resume o un retry sovrascrivono i precedenti)."""
+    return {row["id"]: row for row in recipe_io.read_jsonl(path) if "id" in row}
+
+
+class IdSet:
+    """
+    Insieme di recipe id come bitmap numpy (un byte per id fino al massimo
+    visto): per i ~2M id di RecipeNLG pochi MB invece di un set di int.
+    Gli id negativi o enormi finiscono in un set a parte.
+    """
+
+    LIMIT = 1 << 28
+
+    def __init__(self, ids=()):
+        import numpy as np
+
+        self._np = np
+        self._bits = np.zeros(0, dtype=bool)
+        self._other = set()
+        for rid in ids:
+            self.add(rid)
+
+    def _inside(self, rid) -> bool:
+        return isinstance(rid, int) and 0 <= rid < self.LIMIT
+
+    def add(self, rid):
+        if not self._inside(rid):
+            self._other.add(rid)
+            return
+        if rid >= len(self._bits):
+            grown = self._np.zeros(max(rid + 1, 2 * len(self._bits), 1024), dtype=bool)
+            grown[: len(self._bits)] = self._bits
+            self._bits = grown
+        self._bits[rid] = True
+
+    def discard(self, rid):
+        if not self._inside(rid):
+            self._other.discard(rid)
+        elif rid < len(self._bits):
+            self._bits[rid] = False
+
+    def __contains__(self, rid) -> bool:
+        if not self._inside(rid):
+            return rid in self._other
+        return rid < len(self._bits) and bool(self._bits[rid])
+
+    def __len__(self):
+        return int(self._bits.sum()) + len(self._other)
+
+    def __iter__(self):
+        yield from (int(rid) for rid in self._np.flatnonzero(self._bits))
+        yield from self._other
+
+
+def done_ids(path: str) -> IdSet:
+    """
+    Id che hanno gia' un record riuscito: un resume salta solo questi, le
+    fallite si ritentano. Il JSONL si legge in streaming tenendo solo l'esito
+    dell'ultimo record per id, quindi la memoria non cresce con output e testi.
+    """
+    done = IdSet()
+    for row in recipe_io.read_jsonl(path):
+        if "id" not in row:
+            continue
+        if row.get("output") is not None:
+            done.add(row["id"])
+        else:
+            done.discard(row["id"])
+    return done
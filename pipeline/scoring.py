@@ -0,0 +1,343 @@
+"""
+Valutazione automatica degli output dei modelli contro il gold (D1) per id
+di ricetta, al posto del conteggio a mano in "ricette errate nel conteggio.txt".
+
+Classi di errore (una per ricetta, la prima che scatta):
+- SINTASSI: nell'output non c'e' un JSON valido
+- STRUTTURA: JSON valido ma fuori schema (chiavi diverse da title/ingredients/
+  steps, tipi sbagliati, liste vuote)
+- SEMANTICA: schema corretto ma contenuto diverso dal gold: titolo,
+  ingredienti (precision/recall con match fuzzy) o passi (allineamento)
+
+Le similarita' si calcolano su coppie (id, elemento, parola) con join e
+groupby (validation.word_pairs), per tutte le ricette insieme: migliaia di
+output per modello si valutano in pochi secondi.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from pipeline import parsing
+from pipeline.validation import explode_list, word_pairs
+
+CLASSES = ("SINTASSI", "STRUTTURA", "SEMANTICA")
+
+TITLE_MIN = 0.5          # Dice minimo tra le parole del titolo e quelle del gold
+INGREDIENT_MATCH = 0.6   # Dice minimo perche' due ingredienti siano "lo stesso"
+INGREDIENT_F1_MIN = 0.75
+STEP_MATCH = 0.5         # quota minima di parole di una frase coperte dall'altro lato
+STEP_RECALL_MIN = 0.25   # basso: D2 riassume D1, i passi del modello seguono D2
+
+
+# -----------------------
+# OUTPUT (allineati per id)
+# -----------------------
+def _read(path: str) -> list:
+    if path.endswith(".jsonl"):
+        from pipeline.recipe_io import read_jsonl
+
+        return list(read_jsonl(path))
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_outputs(path: str, failures_path: str | None = None, recipe_ids=None, index_base: int = 0) -> pd.DataFrame:
+    """
+    Output di un run come DataFrame (id, output, raw, reason): output e' il
+    dict estratto (None se fallito), raw il testo generato dei fallimenti.
+
+    Formati letti:
+    - JSONL di results.ResultRecord (run_extraction, run_extraction_stream,
+      baseline): un record per ricetta con il suo id, join diretto sul gold;
+    - JSONL dei checkpoint vecchi con "index" (`index_base` 0 in Inferenza,
+      1 in Valutazione);
+    - recipes_extracted.json (solo gli oggetti riusciti, nell'ordine delle
+      ricette) + recipes_failures.json: gli id sono `recipe_ids` meno le
+      posizioni dei fallimenti;
+    - recipes.json della baseline: un elemento per ricetta, {"error": ...}
+      per quelle fallite.
+    `recipe_ids`: id delle ricette nell'ordine dello script (es.
+    splits.ids_in("inference", "test") per 3.Valutazione).
+    """
+    rows = _read(path)
+    failures = _read(failures_path) if failures_path and os.path.exists(failures_path) else []
+    ids = None if recipe_ids is None else [int(i) for i in recipe_ids]
+
+    def to_id(row, pos=None):
+        if "id" in row:
+            return int(row["id"])
+        if ids is None:
+            raise ValueError(f"{path}: record senza id, servono recipe_ids")
+        return ids[(row["index"] - index_base) if pos is None else pos]
+
+    records = []
+    for row in failures:
+        records.append({"id": to_id(row), "output": None, "raw": row.get("raw") or "", "reason": row.get("reason")})
+
+    if rows and all(isinstance(r, dict) and ("output" in r or "index" in r) for r in rows):
+        for row in rows:   # JSONL con id/index (results.ResultRecord: anche le fallite, con error e raw)
+            failed = row.get("output") is None
+            records.append({"id": to_id(row), "output": row.get("output"),
+                            "raw": (row.get("raw") or "") if failed else None,
+                            "reason": row.get("error") if failed else None})
+    elif ids is not None and len(rows) == len(ids):
+        for pos, row in enumerate(rows):   # un elemento per ricetta (baseline)
+            failed = isinstance(row, dict) and "error" in row
+            records.append({"id": ids[pos], "output": None if failed else row,
+                            "raw": str(row.get("raw", "")) if failed else None,
+                            "reason": str(row["error"]) if failed else None})
+    else:
+        if ids is None:
+            raise ValueError(f"{path}: output senza id, servono recipe_ids")
+        failed = {r["index"] - index_base for r in failures if "index" in r}
+        remaining = [rid for pos, rid in enumerate(ids) if pos not in failed]
+        if len(remaining) != len(rows):
+            raise ValueError(f"{path}: {len(rows)} output per {len(remaining)} ricette riuscite, allineamento impossibile")
+        records.extend({"id": rid, "output": row, "raw": None, "reason": None} for rid, row in zip(remaining, rows))
+
+    frame = pd.DataFrame(records, columns=["id", "output", "raw", "reason"])
+    # a parita' di id (resume, retry) vale l'ultimo record
+    return frame.drop_duplicates("id", keep="last").sort_values("id", ignore_index=True)
+
+
+def load_gold(source: str = "d1") -> pd.DataFrame:
+    """Gold per id (id, title, ingredients, directions) da D1 o da D3 ("d1" | "d3")."""
+    from pipeline import columnar
+
+    table = columnar.load_d1() if source == "d1" else columnar.load_d3()
+    return table.select(["id", "title", "ingredients", "directions"]).to_pandas()
+
+
+# -----------------------
+# SINTASSI / STRUTTURA
+# -----------------------
+def _schema_error(obj) -> bool:
+    if not isinstance(obj, dict) or set(obj) != {"title", "ingredients", "steps"}:
+        return True
+    if not isinstance(obj["title"], str) or not obj["title"].strip():
+        return True
+    return not all(
+        isinstance(obj[key], list) and obj[key] and all(isinstance(x, str) and x.strip() for x in obj[key])
+        for key in ("ingredients", "steps")
+    )
+
+
+def error_class(output, raw) -> str | None:
+    """SINTASSI / STRUTTURA per un record (None se il JSON e' valido e nello schema)."""
+    if output is None:
+        obj, err, _ = parsing.try_parse(raw or "", lenient=False)
+        if err in ("no_json", "invalid_json"):
+            return "SINTASSI"
+        return "STRUTTURA"
+    return "STRUTTURA" if _schema_error(output) else None
+
+
+# -----------------------
+# SIMILARITA' (vettoriali)
+# -----------------------
+def _items(ids, lists: pd.Series, numbers: bool, sentences: bool = False) -> tuple:
+    """
+    (elementi, parole): elementi (id, item, pos) e coppie (id, item, word)
+    uniche. Con `sentences` ogni elemento e' prima diviso in frasi (un passo
+    di D1 spesso ne contiene diverse, il modello le separa).
+    """
+    items = explode_list(ids, lists)
+    if sentences and len(items):
+        items["value"] = pc.split_pattern_regex(pa.array(items["value"].astype(str), pa.string()), r"[.!?;]\s+").to_pylist()
+        items = items.explode("value")
+        items = items[items["value"].str.strip() != ""]
+        items["item"] = np.arange(len(items))
+    items["pos"] = items.groupby("id").cumcount()
+    words = word_pairs(items["id"], items["value"].astype(str), items["item"], numbers=numbers)
+    words = words.drop_duplicates(["item", "word"])
+    return items, words
+
+
+def _coverage(words: pd.DataFrame, other: pd.DataFrame) -> pd.Series:
+    """Per elemento: quota delle sue parole presenti in un qualsiasi elemento di `other` della stessa ricetta."""
+    pool = pd.MultiIndex.from_frame(other[["id", "word"]].drop_duplicates())
+    hit = pd.MultiIndex.from_frame(words[["id", "word"]]).isin(pool)
+    return pd.Series(hit, index=words["item"].to_numpy()).groupby(level=0).mean()
+
+
+def _overlap(pred_words: pd.DataFrame, gold_words: pd.DataFrame) -> pd.DataFrame:
+    """Parole in comune per ogni coppia (elemento predetto, elemento gold) della stessa ricetta."""
+    pairs = pred_words.merge(gold_words, on=["id", "word"], suffixes=("_pred", "_gold"))
+    pairs = pairs.groupby(["id", "item_pred", "item_gold"]).size().rename("common").reset_index()
+    pairs["n_pred"] = pairs["item_pred"].map(pred_words.groupby("item").size())
+    pairs["n_gold"] = pairs["item_gold"].map(gold_words.groupby("item").size())
+    return pairs
+
+
+def _best(pairs: pd.DataFrame, score: str, by: str, other: str) -> pd.DataFrame:
+    """Per ogni elemento di `by`, l'abbinamento con il punteggio piu' alto."""
+    return pairs.sort_values([by, score], ascending=[True, False]).drop_duplicates(by)[["id", by, other, score]]
+
+
+def _rate(hit: pd.Series, items: pd.DataFrame, ids) -> pd.Series:
+    """Quota di elementi abbinati per ricetta (NaN se la ricetta non ha elementi)."""
+    hits = pd.Series(items["item"].isin(hit.index[hit]).to_numpy(), index=items["id"].to_numpy())
+    return hits.groupby(level=0).mean().reindex(ids)
+
+
+def _title_score(ids, pred: pd.Series, gold: pd.Series) -> pd.Series:
+    p = word_pairs(ids, pred).drop_duplicates()
+    g = word_pairs(ids, gold).drop_duplicates()
+    common = p.merge(g, on=["id", "word"]).groupby("id").size().reindex(ids, fill_value=0)
+    sizes = p.groupby("id").size().reindex(ids, fill_value=0) + g.groupby("id").size().reindex(ids, fill_value=0)
+    return pd.Series(np.where(sizes > 0, 2 * common / sizes.where(sizes > 0, 1), 1.0), index=ids)
+
+
+def _ingredient_scores(ids, pred: pd.Series, gold: pd.Series) -> pd.DataFrame:
+    p_items, p_words = _items(ids, pred, numbers=True)
+    g_items, g_words = _items(ids, gold, numbers=True)
+    pairs = _overlap(p_words, g_words)
+    pairs["dice"] = 2 * pairs["common"] / (pairs["n_pred"] + pairs["n_gold"])
+    best_p = _best(pairs, "dice", "item_pred", "item_gold").set_index("item_pred")["dice"] >= INGREDIENT_MATCH
+    best_g = _best(pairs, "dice", "item_gold", "item_pred").set_index("item_gold")["dice"] >= INGREDIENT_MATCH
+    precision = _rate(best_p, p_items, ids).fillna(0.0)
+    recall = _rate(best_g, g_items, ids).fillna(0.0)
+    f1 = (2 * precision * recall / (precision + recall)).where(precision + recall > 0, 0.0)
+    return pd.DataFrame({"ingredient_precision": precision, "ingredient_recall": recall, "ingredient_f1": f1})
+
+
+def _step_scores(ids, pred: pd.Series, gold: pd.Series) -> pd.DataFrame:
+    """
+    Passi, frase per frase: una frase gold e' coperta se almeno STEP_MATCH
+    delle sue parole compare nei passi predetti (in qualunque passo: il
+    modello puo' unire o dividere i passi di D1); step_precision e' lo stesso
+    nel verso opposto. step_order e' la quota di frasi gold consecutive il cui
+    passo predetto piu' simile non torna indietro.
+    """
+    p_items, p_words = _items(ids, pred, numbers=False, sentences=True)
+    g_items, g_words = _items(ids, gold, numbers=False, sentences=True)
+    recall = _rate(_coverage(g_words, p_words) >= STEP_MATCH, g_items, ids).fillna(0.0)
+    precision = _rate(_coverage(p_words, g_words) >= STEP_MATCH, p_items, ids).fillna(0.0)
+
+    matched = _best(_overlap(p_words, g_words), "common", "item_gold", "item_pred")
+    matched["gold_pos"] = matched["item_gold"].map(g_items.set_index("item")["pos"])
+    matched["pred_pos"] = matched["item_pred"].map(p_items.set_index("item")["pos"])
+    matched = matched.sort_values(["id", "gold_pos"])
+    step = matched.groupby("id")["pred_pos"].diff()
+    order = (step.dropna() >= 0).groupby(matched.loc[step.notna(), "id"]).mean().reindex(ids).fillna(1.0)
+    return pd.DataFrame({"step_precision": precision, "step_recall": recall, "step_order": order})
+
+
+# -----------------------
+# PUNTEGGIO
+# -----------------------
+def score(outputs: pd.DataFrame, gold: pd.DataFrame) -> pd.DataFrame:
+    """
+    Report per id: classe di errore (SINTASSI/STRUTTURA/SEMANTICA o None) e
+    metriche per campo. `outputs` come da load_outputs, `gold` come da
+    load_gold; gli id senza gold restano fuori (in "missing_gold" del summary).
+    """
+    frame = outputs.merge(gold, on="id", how="inner")
+    ids = frame["id"].to_numpy()
+    classes = [error_class(o, r) for o, r in zip(frame["output"], frame["raw"])]
+    ok = np.array([c is None for c in classes])
+    field = lambda key: pd.Series([o.get(key) if c is None else None for o, c in zip(frame["output"], classes)])
+
+    report = pd.DataFrame({"id": ids})
+    titles = field("title").fillna("")
+    report["title_score"] = np.where(ok, _title_score(ids, titles, frame["title"]).to_numpy(), np.nan)
+    ing = _ingredient_scores(ids, field("ingredients"), frame["ingredients"])
+    steps = _step_scores(ids, field("steps"), frame["directions"])
+    for col in ing:
+        report[col] = np.where(ok, ing[col].to_numpy(), np.nan)
+    for col in steps:
+        report[col] = np.where(ok, steps[col].to_numpy(), np.nan)
+
+    semantic = ok & ((report["title_score"] < TITLE_MIN) | (report["ingredient_f1"] < INGREDIENT_F1_MIN)
+                     | (report["step_recall"] < STEP_RECALL_MIN)).to_numpy()
+    report["title_match"] = ok & (report["title_score"] >= TITLE_MIN).to_numpy()
+    report["error"] = [c if c is not None else ("SEMANTICA" if s else None) for c, s in zip(classes, semantic)]
+    report["title"] = frame["title"].to_numpy()
+    report.attrs["missing_gold"] = int(len(outputs) - len(frame))
+    return report
+
+
+def summary(report: pd.DataFrame) -> dict:
+    """Percentuali delle metriche della relazione (JSON valido, nello schema, semanticamente corretto) e medie per campo."""
+    n = len(report)
+    counts = report["error"].value_counts()
+    pct = lambda x: round(100 * float(x) / n, 2) if n else 0.0
+    syntax_ok = n - int(counts.get("SINTASSI", 0))
+    schema_ok = syntax_ok - int(counts.get("STRUTTURA", 0))
+    out = {
+        "recipes": n,
+        "missing_gold": report.attrs.get("missing_gold", 0),
+        **{name: int(counts.get(name, 0)) for name in CLASSES},
+        "syntax_ok_pct": pct(syntax_ok),
+        "schema_ok_pct": pct(schema_ok),
+        "semantic_ok_pct": pct(schema_ok - counts.get("SEMANTICA", 0)),
+    }
+    for col in ("title_score", "ingredient_precision", "ingredient_recall", "ingredient_f1",
+                "step_precision", "step_recall", "step_order"):
+        out[col] = round(float(report[col].mean()), 4) if report[col].notna().any() else None
+    return out
+
+
+def print_report(report: pd.DataFrame, result: dict):
+    """Summary + titoli per classe di errore, nello stesso formato di "ricette errate nel conteggio.txt"."""
+    for key, value in result.items():
+        print(f"{key:<22} {value}")
+    for name in CLASSES:
+        titles = report.loc[report["error"] == name, "title"].str.strip().tolist()
+        print(f"\n{name} ({len(titles)}):")
+        print("\n".join(f"- {t}" for t in titles) or "- nessuna")
+
+
+def score_run(outputs_path: str, recipe_ids, index_base: int = 0, failures_path: str | None = None,
+              gold: str = "d1", report_path: str | None = None) -> dict:
+    """Punteggio di un run finito (per gli script di 1.Inferenza / 3.Valutazione): stampa e salva il report per ricetta."""
+    report = score(load_outputs(outputs_path, failures_path, recipe_ids, index_base), load_gold(gold))
+    result = summary(report)
+    report_path = report_path or os.path.join(os.path.dirname(os.path.abspath(outputs_path)), "scores.csv")
+    report.to_csv(report_path, index=False)
+    print("\n=== SCORING (pipeline/scoring.py) ===")
+    print_report(report, result)
+    print(f"Report per ricetta: {report_path}")
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from pipeline import splits
+
+    parser = argparse.ArgumentParser(description="Punteggio automatico (SINTASSI/STRUTTURA/SEMANTICA) contro il gold per id")
+    parser.add_argument("outputs", help="recipes_extracted.json / .jsonl, oppure recipes.json della baseline")
+    parser.add_argument("--failures", default=None, help="recipes_failures.json / .jsonl (default: accanto agli output)")
+    parser.add_argument("--split", action="append", default=None, choices=splits.SPLITS,
+                        help="ripetibile: id delle ricette nell'ordine dello script "
+                             "(default dal percorso: inference in 1.Inferenza, inference + test altrove)")
+    parser.add_argument("--index-base", type=int, default=None, help="0 in 1.Inferenza, 1 in 3.Valutazione (default: dal percorso)")
+    parser.add_argument("--gold", choices=("d1", "d3"), default="d1")
+    parser.add_argument("--report", default=None, help="CSV per ricetta")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    out_dir, name = os.path.split(os.path.abspath(args.outputs))
+    failures = args.failures
+    if failures is None and "extracted" in name:
+        failures = os.path.join(out_dir, name.replace("extracted", "failures"))
+    index_base = args.index_base if args.index_base is not None else int("Valutazione" in out_dir)
+    default_splits = ("inference",) if "Inferenza" in out_dir else ("inference", "test")
+    recipe_ids = splits.ids_in(*(args.split or default_splits))
+
+    t0 = time.perf_counter()
+    report = score(load_outputs(args.outputs, failures, recipe_ids, index_base), load_gold(args.gold))
+    result = summary(report) | {"seconds": round(time.perf_counter() - t0, 3)}
+    if args.report:
+        report.to_csv(args.report, index=False)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(report, result)
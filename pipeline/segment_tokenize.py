@@ -0,0 +1,310 @@
+"""
+Tokenizzazione per segmenti degli esempi di addestramento.
+
+tokenize_and_mask passa il SYSTEM (identico per tutte le righe) da
+apply_chat_template e dal tokenizer due volte per riga. Qui il template
+viene renderizzato una volta con dei segnaposto e spezzato in
+
+    head | user | mid | assistant | tail
+
+(head = tutto fino al contenuto user, SYSTEM compreso): head si tokenizza
+una volta sola, per ogni riga solo user+mid e assistant+tail, e il confine
+delle labels e' noto senza ritokenizzare il prefisso. Vale solo se il
+tokenizer non fonde token attraverso i confini (un tokenizer SentencePiece
+che aggiunge uno spazio all'inizio di ogni segmento, ad esempio, non va):
+segment_template lo verifica su poche righe di prova, choose_tokenize_fn
+sulle righe vere di D3 una volta per tokenizer e dataset, e se non e' cosi'
+si usa tokenize_and_mask, dicendo perche'.
+"""
+import hashlib
+import json
+import os
+import time
+
+from pipeline import prompts
+
+_USER = "<<<USER_SEGMENT>>>"
+_ASSISTANT = "<<<ASSISTANT_SEGMENT>>>"
+
+# righe di prova per la verifica dei confini (spazi e a capo ai bordi compresi)
+_PROBES = [
+    ("Chicken Ole\nDice 4 cooked chicken breasts and bake at 375°F.",
+     '{"title": "Chicken Ole", "ingredients": ["4 chicken breasts"], "directions": ["Dice.", "Bake."]}'),
+    ("  Pancakes \n\n1 cup flour, 2 eggs; mix & fry.  ", ' {"title": "Pancakes"}\n'),
+    ("", "{}"),
+]
+
+# (template, motivo) per (tokenizer, system); template None = tokenizzazione per segmenti non sicura
+_TEMPLATES = {}
+# da incrementare quando cambia SegmentTemplate.encode (invalida le verifiche salvate)
+CHECK_FORMAT = 1
+
+
+class SegmentTemplate:
+    def __init__(self, tokenizer, system_text: str, head: str, mid: str, tail: str):
+        self.tokenizer = tokenizer
+        self.system_text = system_text
+        self.head, self.mid, self.tail = head, mid, tail
+        self.head_ids = tokenizer(head, add_special_tokens=False)["input_ids"] if head else []
+
+    def encode(self, user_texts, target_jsons):
+        """(ids, cut) per riga, senza troncamento: cut = token del prefisso system+user+generation prompt."""
+        tok = self.tokenizer
+        user_ids = tok([u + self.mid for u in user_texts], add_special_tokens=False)["input_ids"]
+        asst_ids = tok([a + self.tail for a in target_jsons], add_special_tokens=False)["input_ids"]
+        head = self.head_ids
+        return [(head + u + a, len(head) + len(u)) for u, a in zip(user_ids, asst_ids)]
+
+    def render(self, user_text: str, target_json: str) -> str:
+        return self.head + user_text + self.mid + target_json + self.tail
+
+
+def _messages(system_text, user_text, target_json=None):
+    messages = [{"role": "system", "content": system_text}, {"role": "user", "content": user_text}]
+    if target_json is not None:
+        messages.append({"role": "assistant", "content": target_json})
+    return messages
+
+
+def _split_template(tokenizer, system_text: str):
+    """(head, mid, tail) del template, o None se il template non e' una semplice concatenazione."""
+    render = tokenizer.apply_chat_template
+    prefix = render(_messages(system_text, _USER), tokenize=False, add_generation_prompt=True)
+    full = render(_messages(system_text, _USER, _ASSISTANT), tokenize=False, add_generation_prompt=False)
+    if prefix.count(_USER) != 1 or full.count(_USER) != 1 or full.count(_ASSISTANT) != 1:
+        return None
+    head, gen = prefix.split(_USER)
+    full_head, rest = full.split(_USER)
+    mid, tail = rest.split(_ASSISTANT)
+    # il prefisso deve essere esattamente l'inizio dell'esempio completo
+    if full_head != head or mid != gen:
+        return None
+    return head, mid, tail
+
+
+def _reference(tokenizer, system_text: str, user_text: str, target_json: str):
+    """(testo completo, ids, cut) come li calcola tokenize_and_mask, senza troncamento."""
+    prefix_str = tokenizer.apply_chat_template(
+        _messages(system_text, user_text), tokenize=False, add_generation_prompt=True
+    )
+    full_str = tokenizer.apply_chat_template(
+        _messages(system_text, user_text, target_json), tokenize=False, add_generation_prompt=False
+    )
+    ids = tokenizer(full_str, add_special_tokens=False)["input_ids"]
+    return full_str, ids, len(tokenizer(prefix_str, add_special_tokens=False)["input_ids"])
+
+
+def _mismatch(tokenizer, template: SegmentTemplate, user_texts, target_jsons):
+    """Motivo della prima riga su cui i segmenti non riproducono tokenize_and_mask (None se nessuna) e righe diverse."""
+    first, bad = None, 0
+    for (ids, cut), user_text, target_json in zip(template.encode(user_texts, target_jsons), user_texts, target_jsons):
+        full_str, ref_ids, ref_cut = _reference(tokenizer, template.system_text, user_text, target_json)
+        if template.render(user_text, target_json) != full_str:
+            reason = "il testo ricomposto dai segmenti differisce dal chat template"
+        elif ids != ref_ids:
+            reason = "token diversi ai confini dei segmenti (token fusi o spazio iniziale aggiunto dal tokenizer)"
+        elif cut != ref_cut:
+            reason = "confine delle labels diverso da quello del prefisso tokenizzato"
+        else:
+            continue
+        bad += 1
+        first = first or reason
+    return first, bad
+
+
+def segment_status(tokenizer, system_text: str = prompts.SYSTEM):
+    """
+    (SegmentTemplate, None) se la tokenizzazione per segmenti riproduce
+    esattamente tokenize_and_mask sulle righe di prova, altrimenti (None,
+    motivo): template che modifica i contenuti, token fusi ai confini,
+    spazio iniziale aggiunto da SentencePiece, ...
+    """
+    key = (tokenizer.name_or_path, len(tokenizer), str(tokenizer.chat_template), system_text)
+    if key in _TEMPLATES:
+        return _TEMPLATES[key]
+
+    parts = _split_template(tokenizer, system_text)
+    if parts is None:
+        status = None, "il chat template non e' una concatenazione di system / user / assistant"
+    else:
+        candidate = SegmentTemplate(tokenizer, system_text, *parts)
+        reason, _ = _mismatch(tokenizer, candidate, *zip(*_PROBES)) if _PROBES else (None, 0)
+        status = (None, f"righe di prova: {reason}") if reason else (candidate, None)
+
+    _TEMPLATES[key] = status
+    return status
+
+
+def segment_template(tokenizer, system_text: str = prompts.SYSTEM):
+    """SegmentTemplate per il tokenizer, o None se la tokenizzazione per segmenti non e' sicura (vedi segment_status)."""
+    return segment_status(tokenizer, system_text)[0]
+
+
+def verify_rows(tokenizer, user_texts, target_jsons, system_text: str = prompts.SYSTEM) -> dict:
+    """
+    Confronto riga per riga (senza troncamento ne' padding, che sono uguali
+    nei due percorsi) tra i segmenti e tokenize_and_mask sulle righe date.
+    """
+    template = segment_template(tokenizer, system_text)
+    if template is None:
+        return {"rows": len(user_texts), "mismatches": None, "reason": segment_status(tokenizer, system_text)[1]}
+    reason, bad = _mismatch(tokenizer, template, list(user_texts), list(target_jsons))
+    return {"rows": len(user_texts), "mismatches": bad, "reason": reason}
+
+
+def _check_key(tokenizer, system_text: str, user_texts, target_jsons) -> str:
+    h = hashlib.sha256()
+    h.update(json.dumps([CHECK_FORMAT, type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer),
+                         str(tokenizer.chat_template), system_text]).encode("utf-8"))
+    for user_text, target_json in zip(user_texts, target_jsons):
+        h.update(json.dumps([user_text, target_json]).encode("utf-8"))
+    return h.hexdigest()[:32]
+
+
+def choose_tokenize_fn(tokenizer, user_texts, target_jsons, system_text: str = prompts.SYSTEM,
+                       check_dir: str | None = None):
+    """
+    tokenize_and_mask_segments se i segmenti riproducono tokenize_and_mask su
+    TUTTE le righe date (le righe vere di D3, non solo quelle di prova),
+    altrimenti tokenize_and_mask; stampa quale e perche'. L'esito dipende solo
+    da tokenizer, template, system e righe, non da max_length ne' dal padding:
+    con `check_dir` viene salvato li' e le build successive della cache non
+    ripetono la verifica.
+    """
+    from pipeline.training import tokenize_and_mask
+
+    template, reason = segment_status(tokenizer, system_text)
+    if template is None:
+        print(f"Tokenizzazione: tokenize_and_mask (per segmenti non applicabile: {reason})")
+        return tokenize_and_mask
+
+    path = None
+    if check_dir is not None:
+        path = os.path.join(check_dir, f"segment-check-{_check_key(tokenizer, system_text, user_texts, target_jsons)}.json")
+    if path is not None and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            report = json.load(f)
+    else:
+        t0 = time.perf_counter()
+        report = verify_rows(tokenizer, user_texts, target_jsons, system_text)
+        report["seconds"] = round(time.perf_counter() - t0, 3)
+        if path is not None:
+            os.makedirs(check_dir, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
+    if report["mismatches"]:
+        print(f"Tokenizzazione: tokenize_and_mask ({report['mismatches']}/{report['rows']} righe diverse "
+              f"con i segmenti: {report['reason']})")
+        return tokenize_and_mask
+    print(f"Tokenizzazione: per segmenti (identica a tokenize_and_mask su {report['rows']} righe)")
+    return tokenize_and_mask_segments
+
+
+def tokenize_and_mask_segments(examples, tokenizer, max_length: int, system_text: str = prompts.SYSTEM,
+                               padding: str | bool = "max_length"):
+    """
+    Stessa firma e stesso output di training.tokenize_and_mask (troncamento,
+    padding e labels compresi), ma con il SYSTEM tokenizzato una volta sola.
+    Se il tokenizer non lo permette ripiega su tokenize_and_mask.
+    """
+    template = segment_template(tokenizer, system_text)
+    if template is None:
+        from pipeline.training import tokenize_and_mask
+
+        return tokenize_and_mask(examples, tokenizer, max_length, system_text, padding)
+
+    pad_id = tokenizer.pad_token_id
+    left_trunc = tokenizer.truncation_side == "left"
+    left_pad = tokenizer.padding_side == "left"
+
+    input_ids_batch, attention_mask_batch, labels_batch = [], [], []
+    for ids, cut in template.encode(examples["text"], examples["json"]):
+        if len(ids) > max_length:
+            ids = ids[-max_length:] if left_trunc else ids[:max_length]
+        attn = [1] * len(ids)
+        if padding == "max_length" and len(ids) < max_length:
+            fill = max_length - len(ids)
+            ids, attn = ([pad_id] * fill + ids, [0] * fill + attn) if left_pad else \
+                        (ids + [pad_id] * fill, attn + [0] * fill)
+
+        labels = ids.copy()
+        cut = min(cut, max_length)
+        labels[:cut] = [-100] * cut
+
+        input_ids_batch.append(ids)
+        attention_mask_batch.append(attn)
+        labels_batch.append(labels)
+
+    return {
+        "input_ids": input_ids_batch,
+        "attention_mask": attention_mask_batch,
+        "labels": labels_batch,
+    }
+
+
+# -----------------------
+# EQUIVALENZA + BENCHMARK
+# -----------------------
+def check_equivalence(tokenizer, dataset_path: str, max_length: int, padding: str | bool = "max_length",
+                      system_text: str = prompts.SYSTEM, batch_size: int = 1000) -> dict:
+    """
+    Confronta tokenize_and_mask e tokenize_and_mask_segments su tutto il CSV:
+    righe con input_ids / attention_mask / labels diversi (deve essere 0)
+    e tempo di ciascuna delle due.
+    """
+    from pipeline.training import tokenize_and_mask
+
+    from pipeline import columnar
+
+    table = columnar.load_d3(dataset_path)
+    examples = {"text": table.column("text").to_pylist(), "json": table.column("json").to_pylist()}
+    rows = examples["text"]
+
+    def run(fn):
+        out = {"input_ids": [], "attention_mask": [], "labels": []}
+        t0 = time.perf_counter()
+        for start in range(0, len(rows), batch_size):
+            batch = {k: v[start : start + batch_size] for k, v in examples.items()}
+            for k, v in fn(batch, tokenizer, max_length, system_text, padding).items():
+                out[k].extend(v)
+        return out, time.perf_counter() - t0
+
+    reference, t_ref = run(tokenize_and_mask)
+    template, reason = segment_status(tokenizer, system_text)  # verifica dei confini fuori dal tempo misurato
+    segmented, t_seg = run(tokenize_and_mask_segments)
+    mismatches = sum(
+        any(reference[k][i] != segmented[k][i] for k in reference) for i in range(len(rows))
+    )
+    return {
+        "rows": len(rows),
+        "segmented": template is not None,
+        "fallback_reason": reason,
+        "mismatches": mismatches,
+        "seconds_reference": round(t_ref, 3),
+        "seconds_segmented": round(t_seg, 3),
+        "speedup": round(t_ref / t_seg, 2) if t_seg else None,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from transformers import AutoTokenizer
+
+    from pipeline.training import DATASET_PATH
+
+    parser = argparse.ArgumentParser(description="Equivalenza e benchmark della tokenizzazione per segmenti su D3")
+    parser.add_argument("tokenizer", help="id HF o cartella locale del tokenizer")
+    parser.add_argument("--d3", default=DATASET_PATH)
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--no-padding", action="store_true", help="confronta con padding=False")
+    args = parser.parse_args()
+
+    tok = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    if tok.pad_token is None:
+        tok.pad_token = tok.eos_token
+    report = check_equivalence(tok, args.d3, args.max_length, False if args.no_padding else "max_length")
+    print(json.dumps(report, indent=2))
+    raise SystemExit(1 if report["mismatches"] else 0)
@@ -0,0 +1,156 @@
+"""
+Split train / validation / test deterministico per id di ricetta.
+
+Lo split di ogni id dipende solo dall'id e da SplitSpec (hash splitmix64
+vettoriale, quindi milioni di id in pochi ms): builder di D3, training e
+valutazione lo leggono dallo stesso manifest (0.Dataset/splits.parquet)
+invece di ricavarlo ognuno per conto suo (iloc[50:900], train_test_split,
+ricette incollate a mano). Gli intervalli del protocollo del progetto sono
+fissati a mano e prevalgono sull'hash: le prime 50 ricette (id 0-49,
+inferenza pre-fine-tuning, poi anche valutazione) e le ultime 101 (id
+900-1000, test) non finiscono mai in addestramento.
+
+Il manifest contiene gli id di D1 e di D2.txt; un id che non c'e' (es. una
+riga di RecipeNLG aggiunta dopo) non va ricostruito: assign() gli da' lo
+stesso split che avrebbe nel manifest, calcolato al momento.
+"""
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+from pipeline.profiles import ROOT
+
+MANIFEST_PATH = os.path.join(ROOT, "0.Dataset", "splits.parquet")
+SPLITS = ("train", "validation", "test", "inference")
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_C1 = np.uint64(0xBF58476D1CE4E5B9)
+_C2 = np.uint64(0x94D049BB133111EB)
+
+
+@dataclass(frozen=True)
+class SplitSpec:
+    seed: int = 42
+    validation: float = 0.1     # quota degli id non fissati che va in validation
+    test: float = 0.0           # quota degli id non fissati che va in test (corpus completo)
+    # (split, start, stop): id in [start, stop) assegnati a mano
+    pinned: tuple = (("inference", 0, 50), ("test", 900, 1001))
+
+    def digest(self) -> str:
+        return hashlib.sha256(json.dumps(asdict(self), sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+DEFAULT_SPEC = SplitSpec()
+
+
+def _unit(ids, seed: int) -> np.ndarray:
+    """Hash splitmix64 di (seed, id) portato in [0, 1): stesso id -> stesso valore, ovunque."""
+    with np.errstate(over="ignore"):
+        z = np.asarray(ids, dtype=np.int64).astype(np.uint64) + np.uint64(seed) * _GOLDEN + _GOLDEN
+        z = (z ^ (z >> np.uint64(30))) * _C1
+        z = (z ^ (z >> np.uint64(27))) * _C2
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def assign(ids, spec: SplitSpec = DEFAULT_SPEC) -> np.ndarray:
+    """
+    Nome dello split per ogni id (array di stringhe, stesso ordine di `ids`):
+    l'hash decide tra train / validation / test, poi gli intervalli di
+    spec.pinned (inferenza 0-49, test 900-1000) sovrascrivono il risultato.
+    Vale per qualsiasi id, anche fuori dal manifest.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    u = _unit(ids, spec.seed)
+    out = np.where(u < spec.validation, "validation",
+                   np.where(u < spec.validation + spec.test, "test", "train")).astype(object)
+    for name, start, stop in spec.pinned:
+        out[(ids >= start) & (ids < stop)] = name
+    return out
+
+
+# -----------------------
+# MANIFEST
+# -----------------------
+def build_manifest(ids=None, spec: SplitSpec = DEFAULT_SPEC, path: str = MANIFEST_PATH) -> str:
+    """
+    Scrive (id, split) ordinato per id, con gli split di assign() (intervalli
+    fissati compresi). Di default gli id sono l'unione di quelli di D1 e di
+    D2.txt (indice di recipe_io.D2Index); gli id che non ci sono si
+    assegnano al momento con assign(), con lo stesso risultato.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if ids is None:
+        from pipeline import columnar
+        from pipeline.recipe_io import D2Index
+
+        with D2Index(columnar.D2_PATH) as index:
+            d2_ids = np.asarray(index.ids, dtype=np.int64)
+        ids = np.concatenate([columnar.load_d1().column("id").to_numpy().astype(np.int64), d2_ids])
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    table = pa.table({"id": ids, "split": pa.array(assign(ids, spec), pa.string()).dictionary_encode()})
+    table = table.replace_schema_metadata({"spec": json.dumps(asdict(spec)), "digest": spec.digest()})
+    tmp = path + ".tmp"
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def load_manifest(spec: SplitSpec = DEFAULT_SPEC, path: str = MANIFEST_PATH):
+    """Tabella Arrow (id, split); ricostruita se manca, se lo spec e' cambiato o se D1 / D2 sono piu' recenti."""
+    import pyarrow.parquet as pq
+
+    from pipeline import columnar
+
+    stale = not os.path.exists(path)
+    if not stale:
+        meta = pq.read_schema(path).metadata or {}
+        stale = meta.get(b"digest", b"").decode() != spec.digest()
+        stale = stale or any(os.path.getmtime(path) < os.path.getmtime(source)
+                             for source in (columnar.D1_PATH, columnar.D2_PATH) if os.path.exists(source))
+    if stale:
+        build_manifest(spec=spec, path=path)
+    return pq.read_table(path, memory_map=True)
+
+
+def ids_in(*names, spec: SplitSpec = DEFAULT_SPEC, path: str = MANIFEST_PATH) -> np.ndarray:
+    """Id (ordinati) degli split indicati, dal manifest."""
+    unknown = set(names) - set(SPLITS)
+    if unknown:
+        raise ValueError(f"Split sconosciuti: {sorted(unknown)} (disponibili: {', '.join(SPLITS)})")
+    table = load_manifest(spec, path)
+    split = np.asarray(table.column("split").to_pylist(), dtype=object)
+    return table.column("id").to_numpy()[np.isin(split, list(names))]
+
+
+def records(*names, d2_path: str | None = None, spec: SplitSpec = DEFAULT_SPEC):
+    """(id, testo di D2) delle ricette degli split indicati, in ordine di id, via recipe_io.D2Index."""
+    from pipeline import columnar
+    from pipeline.recipe_io import D2Index
+
+    index = D2Index(d2_path or columnar.D2_PATH)
+    for rid in ids_in(*names, spec=spec).tolist():
+        if rid in index:
+            yield rid, index.get(rid)
+
+
+if __name__ == "__main__":
+    import argparse
+    import collections
+
+    parser = argparse.ArgumentParser(description="Manifest degli split per id di ricetta")
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        build_manifest()
+    manifest = load_manifest()
+    counts = collections.Counter(manifest.column("split").to_pylist())
+    print(f"{MANIFEST_PATH}: {manifest.num_rows} id, spec {DEFAULT_SPEC.digest()}")
+    for name in SPLITS:
+        print(f"  {name:<10} {counts.get(name, 0)}")
@@ -0,0 +1,182 @@
+import re
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+# caratteri che contano per capire quando l'oggetto JSON e' chiuso;
+# ogni altro tratto di testo diventa un solo "." (serve solo a consumare un escape)
+_OTHER = re.compile(r'[^{}"\\]+')
+
+# tabella token_id -> caratteri strutturali, una per tokenizer
+_TABLES = {}
+
+
+def structural_table(tokenizer):
+    """
+    Per ogni token del vocabolario tiene solo i caratteri { } " \\ del suo testo
+    (il resto compresso in "."; "" per i token senza testo, es. speciali).
+
+    I token vengono decodificati UNO ALLA VOLTA: un carattere multi-byte spezzato
+    tra due token diventa "�", che non e' mai un carattere strutturale,
+    quindi il conteggio delle graffe resta corretto per Phi-3 / Mistral
+    (SentencePiece con byte-fallback) e Qwen (byte-level BPE).
+    La tabella si calcola una volta sola per tokenizer.
+    """
+    key = (tokenizer.name_or_path, len(tokenizer))
+    table = _TABLES.get(key)
+    if table is None:
+        pieces = tokenizer.batch_decode([[i] for i in range(len(tokenizer))], skip_special_tokens=True)
+        table = [_OTHER.sub(".", piece) for piece in pieces]
+        _TABLES[key] = table
+    return table
+
+
+class StopOnJsonEnd(StoppingCriteria):
+    """
+    Ferma ogni riga del batch appena chiude il primo oggetto JSON { ... }.
+
+    Lo stato (profondita', dentro stringa, escape) e' tenuto per riga e
+    aggiornato solo con i token nuovi: il costo per step non cresce con la
+    lunghezza dell'output, a differenza di decodificare e riscandire tutto.
+    """
+
+    def __init__(self, tokenizer, start_len: int):
+        self.table = structural_table(tokenizer)
+        self.prev_len = start_len  # ignora il prompt
+        self.rows = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.rows is None:
+            # [depth, in_str, esc, started, done]
+            self.rows = [[0, False, False, False, False] for _ in range(input_ids.shape[0])]
+
+        cur_len = input_ids.shape[1]
+        if cur_len > self.prev_len:
+            new_ids = input_ids[:, self.prev_len:cur_len].tolist()
+            self.prev_len = cur_len
+            for row, ids in zip(self.rows, new_ids):
+                if not row[4]:
+                    for tok_id in ids:
+                        chars = self.table[tok_id] if tok_id < len(self.table) else ""
+                        if chars == "." and not row[2]:
+                            continue  # caso comune: testo normale, nessun escape pendente
+                        if chars and self._feed(row, chars):
+                            row[4] = True
+                            break
+
+        return torch.tensor([row[4] for row in self.rows], dtype=torch.bool, device=input_ids.device)
+
+    @staticmethod
+    def _feed(row, chars: str) -> bool:
+        depth, in_str, esc, started, _ = row
+        for ch in chars:
+            if not started:
+                if ch == "{":
+                    started = True
+                    depth = 1
+                continue
+
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == "\\":
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            else:
+                if ch == '"':
+                    in_str = True
+                elif ch == "{":
+                    depth += 1
+                elif ch == "}":
+                    depth -= 1
+                    if depth == 0:
+                        return True
+
+        row[0], row[1], row[2], row[3] = depth, in_str, esc, started
+        return False
+
+
+def json_stop_kwargs(tokenizer):
+    """kwargs_factory per generation.generate_batch: aggiunge StopOnJsonEnd."""
+    def factory(prompt_len):
+        return {"stopping_criteria": StoppingCriteriaList([StopOnJsonEnd(tokenizer, prompt_len)])}
+
+    return factory
+
+
+# -----------------------
+# MICRO-BENCHMARK
+# -----------------------
+def _rescan_is_complete(tokenizer, gen_ids) -> bool:
+    # vecchio approccio (1.Inferenza/Mistral): decodifica tutto e riscandisce dal primo '{'
+    text = tokenizer.decode(gen_ids, skip_special_tokens=True)
+    start = text.find("{")
+    if start == -1:
+        return False
+    depth, in_str, esc = 0, False, False
+    for ch in text[start:]:
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return True
+    return False
+
+
+def bench_stopping(tokenizer, lengths=(250, 500, 1000, 2000), batch_size: int = 1):
+    """
+    Misura il costo medio per step (in microsecondi) dei due stopper mentre
+    l'output cresce fino a `lengths` token. L'output e' un JSON mai chiuso,
+    cosi' entrambi devono guardare tutta la sequenza.
+    """
+    steps = ['"step number %d with some text, {braces} and \\"quotes\\""' % i for i in range(2000)]
+    text = '{"title": "x", "ingredients": [], "steps": [' + ", ".join(steps)
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    structural_table(tokenizer)  # costruzione tabella esclusa dalla misura
+
+    report = []
+    for n in lengths:
+        seq = torch.tensor([ids[:n]] * batch_size)
+        window = range(max(1, n - 50), n + 1)  # media sugli ultimi 50 step
+
+        stopper = StopOnJsonEnd(tokenizer, 0)
+        for k in range(1, window.start):
+            stopper(seq[:, :k], None)
+        t0 = time.perf_counter()
+        for k in window:
+            stopper(seq[:, :k], None)
+        incremental = (time.perf_counter() - t0) / len(window) * 1e6
+
+        t0 = time.perf_counter()
+        for k in window:
+            for row in seq[:, :k]:
+                _rescan_is_complete(tokenizer, row)
+        rescan = (time.perf_counter() - t0) / len(window) * 1e6
+
+        report.append({"tokens": n, "incremental_us": incremental, "rescan_us": rescan})
+        print(f"{n:>6} tokens | incremental {incremental:9.1f} us/step | rescan {rescan:9.1f} us/step")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Micro-benchmark dello stopping criterion JSON")
+    parser.add_argument("tokenizer", help="id HF o cartella locale del tokenizer")
+    parser.add_argument("--batch-size", type=int, default=1)
+    args = parser.parse_args()
+
+    bench_stopping(AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True), batch_size=args.batch_size)
@@ -0,0 +1,550 @@
+import gc
+import hashlib
+import json
+import math
+import os
+import shutil
+from dataclasses import replace
+
+import numpy as np
+import torch
+
+from pipeline import columnar, engine, prompts, segment_tokenize, splits
+from pipeline.profiles import ROOT, ModelProfile
+
+DATASET_PATH = os.path.join(ROOT, "2.Addestramento", "D3.csv")
+
+# max_length scelto dall'audit (profile.max_length None): quantile delle
+# lunghezze complete, arrotondato a multipli di AUTO_MULTIPLE, al massimo AUTO_CAP
+AUTO_QUANTILE = 0.95
+AUTO_MULTIPLE = 64
+AUTO_CAP = 1024
+
+# dataset tokenizzati e mascherati (Arrow, letti in memory map) riusati tra le run
+TOKENIZED_CACHE_DIR = os.path.join(ROOT, ".cache", "tokenized")
+# da incrementare quando cambia tokenize_and_mask / pack_examples
+TOKENIZED_FORMAT = 1
+
+# lunghezze (prefisso, completa) di D3, una volta per (tokenizer, dataset, system)
+_LENGTHS = {}
+# digest dei file di dati, per (percorso, mtime, dimensione)
+_FILE_DIGESTS = {}
+
+
+def load_splits(dataset_path: str = DATASET_PATH, spec: splits.SplitSpec = splits.DEFAULT_SPEC):
+    """
+    DatasetDict train / validation di D3 secondo il manifest degli split
+    (pipeline/splits.py). Le righe di D3 con id di inferenza o test vengono
+    scartate: nessuna ricetta di valutazione finisce in addestramento.
+    """
+    import pyarrow as pa
+    from datasets import DatasetDict
+
+    # D3 in Parquet (pipeline/columnar.py): tabella Arrow in memory map, stringhe gia' pulite (niente None)
+    table = columnar.load_d3(dataset_path).select(["id", "text", "json"])
+    assigned = splits.assign(table.column("id").to_numpy(), spec)
+    leaked = int(np.isin(assigned, ["inference", "test"]).sum())
+    if leaked:
+        print(f"D3: {leaked} righe con id di valutazione escluse dall'addestramento")
+    return DatasetDict({
+        name: columnar.to_dataset(table.filter(pa.array(assigned == name)))
+        for name in ("train", "validation")
+    })
+
+
+def tokenize_and_mask(examples, tokenizer, max_length: int, system_text: str = prompts.SYSTEM,
+                      padding: str | bool = "max_length"):
+    """
+    Tokenizzazione + mascheratura labels (loss SOLO su assistant).
+    Idea:
+    - prefix_str = template(system+user, add_generation_prompt=True)  -> finisce esattamente dove inizia assistant
+    - full_str   = template(system+user+assistant(target_json))
+    - tokenizziamo full_str
+    - labels = input_ids, ma mettiamo -100 su tutti i token < len(prefix_ids)
+    Con padding=False gli esempi restano a lunghezza variabile (troncati a
+    max_length): il padding lo fa PaddingCollator, oppure pack_examples.
+    """
+    input_ids_batch = []
+    attention_mask_batch = []
+    labels_batch = []
+
+    for user_text, target_json in zip(examples["text"], examples["json"]):
+        prefix_messages = [
+            {"role": "system", "content": system_text},
+            {"role": "user", "content": user_text},
+        ]
+        prefix_str = tokenizer.apply_chat_template(
+            prefix_messages,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+
+        full_messages = prefix_messages + [{"role": "assistant", "content": target_json}]
+        full_str = tokenizer.apply_chat_template(
+            full_messages,
+            tokenize=False,
+            add_generation_prompt=False
+        )
+
+        prefix_ids = tokenizer(prefix_str, add_special_tokens=False)["input_ids"]
+
+        enc = tokenizer(
+            full_str,
+            truncation=True,
+            max_length=max_length,
+            padding=padding,
+            add_special_tokens=False
+        )
+
+        input_ids = enc["input_ids"]
+        attn = enc["attention_mask"]
+
+        labels = input_ids.copy()
+        cut = min(len(prefix_ids), max_length)
+        labels[:cut] = [-100] * cut
+
+        input_ids_batch.append(input_ids)
+        attention_mask_batch.append(attn)
+        labels_batch.append(labels)
+
+    return {
+        "input_ids": input_ids_batch,
+        "attention_mask": attention_mask_batch,
+        "labels": labels_batch,
+    }
+
+
+# -----------------------
+# AUDIT LUNGHEZZE
+# -----------------------
+def example_lengths(tokenizer, dataset_path: str = DATASET_PATH, system_text: str = prompts.SYSTEM):
+    """
+    Token del prefisso (system+user+generation prompt) e dell'esempio completo
+    per ogni riga di D3, senza troncamento. Tokenizza D3 una sola volta per
+    tokenizer: le chiamate successive riusano il risultato.
+    """
+    key = (tokenizer.name_or_path, len(tokenizer), os.path.abspath(dataset_path), system_text)
+    if key in _LENGTHS:
+        return _LENGTHS[key]
+
+    table = columnar.load_d3(dataset_path)
+    rows = zip(table.column("text").to_pylist(), table.column("json").to_pylist())
+
+    prefix_strs, full_strs = [], []
+    for user_text, target_json in rows:
+        messages = [{"role": "system", "content": system_text}, {"role": "user", "content": user_text}]
+        prefix_strs.append(tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+        full_strs.append(tokenizer.apply_chat_template(
+            messages + [{"role": "assistant", "content": target_json}], tokenize=False, add_generation_prompt=False
+        ))
+
+    prefix = np.array([len(ids) for ids in tokenizer(prefix_strs, add_special_tokens=False)["input_ids"]])
+    full = np.array([len(ids) for ids in tokenizer(full_strs, add_special_tokens=False)["input_ids"]])
+    _LENGTHS[key] = (prefix, full)
+    return prefix, full
+
+
+def choose_max_length(full_lengths, quantile: float = AUTO_QUANTILE, multiple: int = AUTO_MULTIPLE,
+                      cap: int = AUTO_CAP) -> int:
+    """Il piu' piccolo multiplo di `multiple` che contiene per intero una quota `quantile` degli esempi."""
+    length = int(math.ceil(np.quantile(full_lengths, quantile) / multiple)) * multiple
+    return max(multiple, min(cap, length))
+
+
+def audit_lengths(tokenizer, max_length: int, dataset_path: str = DATASET_PATH,
+                  system_text: str = prompts.SYSTEM) -> dict:
+    """
+    Distribuzione delle lunghezze di D3 e cosa succede a max_length:
+    righe troncate (il JSON non ci sta tutto) e righe completamente mascherate
+    (il prefisso occupa tutta la riga: zero token con loss, forward/backward sprecati).
+    """
+    prefix, full = example_lengths(tokenizer, dataset_path, system_text)
+    supervised = np.clip(np.minimum(full, max_length) - prefix, 0, None)
+    return {
+        "rows": int(len(full)),
+        "max_length": max_length,
+        "prefix": {q: int(np.percentile(prefix, q)) for q in (50, 90, 95, 99, 100)},
+        "full": {q: int(np.percentile(full, q)) for q in (50, 90, 95, 99, 100)},
+        "truncated": int((full > max_length).sum()),
+        "fully_masked": int((supervised == 0).sum()),
+        # quota dei token di target (JSON) che resta dentro max_length
+        "target_kept": float(supervised.sum() / max(1, (full - prefix).sum())),
+        "suggested_max_length": choose_max_length(full),
+    }
+
+
+def print_audit(report: dict):
+    print(f"D3: {report['rows']} righe, max_length={report['max_length']}")
+    print("  prefisso (p50/p90/p95/p99/max): " + " / ".join(str(v) for v in report["prefix"].values()))
+    print("  completo (p50/p90/p95/p99/max): " + " / ".join(str(v) for v in report["full"].values()))
+    print(f"  troncate: {report['truncated']}  completamente mascherate: {report['fully_masked']}  "
+          f"target conservato: {report['target_kept']:.1%}  max_length suggerito: {report['suggested_max_length']}")
+
+
+def drop_unsupervised(dataset):
+    """Scarta le righe senza nemmeno un token con loss (labels tutte -100)."""
+    return dataset.filter(
+        lambda batch: [any(label != -100 for label in labels) for labels in batch["labels"]],
+        batched=True,
+    )
+
+
+# -----------------------
+# PACKING / PADDING DINAMICO
+# -----------------------
+def pack_examples(dataset, max_length: int):
+    """
+    Impacchetta gli esempi (tokenizzati senza padding) in righe da al piu'
+    max_length token, first-fit decreasing sulle lunghezze. Ogni riga porta
+    position_ids che ripartono da 0 a ogni esempio: senza attention_mask e
+    con use_cache=False (come in load_trainable_model), transformers ricava
+    da li' la maschera causale a blocchi, quindi un esempio non vede mai
+    quelli che lo precedono nella stessa riga.
+    """
+    from datasets import Dataset
+
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    bins, free = [], []
+    for i in order:
+        for b, room in enumerate(free):
+            if lengths[i] <= room:
+                bins[b].append(i)
+                free[b] -= lengths[i]
+                break
+        else:
+            bins.append([i])
+            free.append(max_length - lengths[i])
+
+    input_ids, labels = dataset["input_ids"], dataset["labels"]
+    rows = {"input_ids": [], "labels": [], "position_ids": []}
+    for members in bins:
+        ids, lab, pos = [], [], []
+        for i in members:
+            ids += input_ids[i]
+            # il primo token di un esempio non si predice dalla fine del precedente
+            lab += [-100] + labels[i][1:]
+            pos += range(lengths[i])
+        rows["input_ids"].append(ids)
+        rows["labels"].append(lab)
+        rows["position_ids"].append(pos)
+    return Dataset.from_dict(rows)
+
+
+class PaddingCollator:
+    """
+    Padding a destra fino all'esempio piu' lungo del batch (arrotondato a
+    pad_to_multiple_of), non a max_length: input_ids con pad_token_id,
+    labels con -100, attention_mask con 0, position_ids con 0 (ogni pad e'
+    una "sequenza" a se', quindi non sporca le righe impacchettate).
+    """
+
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: int | None = 8):
+        self.pad_values = {"input_ids": pad_token_id, "labels": -100, "attention_mask": 0, "position_ids": 0}
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features):
+        longest = max(len(f["input_ids"]) for f in features)
+        if self.pad_to_multiple_of:
+            longest = -(-longest // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        return {
+            key: torch.tensor([list(f[key]) + [pad] * (longest - len(f[key])) for f in features], dtype=torch.long)
+            for key, pad in self.pad_values.items()
+            if key in features[0]
+        }
+
+
+def packing_supported(model) -> bool:
+    """
+    Il packing senza attention_mask si affida alla maschera a blocchi che
+    transformers ricava dai position_ids: i modelli con codice remoto
+    (trust_remote_code) non la costruiscono, e nemmeno i modelli con
+    use_cache attivo (con una KV cache i position_ids non vengono guardati);
+    per loro si ripiega su "dynamic".
+    """
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    if getattr(base.config, "use_cache", False):
+        return False
+    return type(base).__module__.startswith("transformers.models.")
+
+
+def prepare_for_training(dataset, tokenizer, max_length: int, padding: str = "pack",
+                         system_text: str = prompts.SYSTEM, check_dir: str | None = None):
+    """
+    Tokenizza gli split e restituisce (dataset, data_collator) per la modalita':
+    - "max_length": come prima, ogni esempio paddato a max_length;
+    - "dynamic": nessun padding in tokenizzazione, PaddingCollator sul batch;
+    - "pack": esempi concatenati in righe piene (pack_examples) + PaddingCollator.
+    In tutti i casi le righe senza token supervisionati vengono scartate.
+    `check_dir` conserva l'esito della verifica della tokenizzazione per segmenti.
+    """
+    if padding not in ("max_length", "dynamic", "pack"):
+        raise ValueError(f"padding sconosciuto: {padding!r} (max_length | dynamic | pack)")
+
+    # SYSTEM tokenizzato una volta sola se i segmenti danno lo stesso output di
+    # tokenize_and_mask su tutte le righe (verificato una volta per tokenizer e dataset)
+    tokenize_fn = segment_tokenize.choose_tokenize_fn(
+        tokenizer,
+        [text for split in dataset for text in dataset[split]["text"]],
+        [target for split in dataset for target in dataset[split]["json"]],
+        system_text,
+        check_dir,
+    )
+    tokenized = dataset.map(
+        tokenize_fn,
+        batched=True,
+        remove_columns=dataset["train"].column_names,  # rimuove id/text/json originali
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "max_length": max_length,
+            "system_text": system_text,
+            "padding": "max_length" if padding == "max_length" else False,
+        },
+    )
+    # righe interamente mascherate (prefisso >= max_length): nessuna loss, solo costo
+    for split in tokenized:
+        kept = drop_unsupervised(tokenized[split])
+        if len(kept) < len(tokenized[split]):
+            print(f"[{split}] scartate {len(tokenized[split]) - len(kept)} righe senza token supervisionati")
+        tokenized[split] = kept
+    if len(tokenized["train"]) == 0:
+        raise ValueError(f"max_length={max_length}: nessuna riga con token supervisionati (vedi audit_lengths)")
+
+    if padding == "pack":
+        for split in tokenized:
+            tokenized[split] = pack_examples(tokenized[split], max_length)
+    return tokenized, data_collator_for(padding, tokenizer)
+
+
+def data_collator_for(padding: str, tokenizer):
+    from transformers import default_data_collator
+
+    return default_data_collator if padding == "max_length" else PaddingCollator(tokenizer.pad_token_id)
+
+
+# -----------------------
+# CACHE DEL DATASET TOKENIZZATO
+# -----------------------
+def file_digest(path: str) -> str:
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    digest = _FILE_DIGESTS.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        _FILE_DIGESTS[key] = digest
+    return digest
+
+
+def tokenized_cache_key(tokenizer, max_length: int, padding: str, dataset_path: str = DATASET_PATH,
+                        system_text: str = prompts.SYSTEM, spec: splits.SplitSpec = splits.DEFAULT_SPEC) -> str:
+    """
+    Impronta di tutto cio' che determina il dataset tokenizzato: tokenizer
+    (nome, vocabolario, chat template), hash del SYSTEM, max_length, modalita'
+    di padding, digest di D3 e spec degli split.
+    """
+    payload = json.dumps({
+        "format": TOKENIZED_FORMAT,
+        "tokenizer": [type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer)],
+        "chat_template": hashlib.sha256(str(tokenizer.chat_template or "").encode("utf-8")).hexdigest(),
+        "system": hashlib.sha256(system_text.encode("utf-8")).hexdigest(),
+        "max_length": max_length,
+        "padding": padding,
+        "dataset": file_digest(dataset_path),
+        "split": spec.digest(),
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def load_training_data(tokenizer, max_length: int, padding: str = "pack", dataset_path: str = DATASET_PATH,
+                       system_text: str = prompts.SYSTEM, cache_dir: str | None = TOKENIZED_CACHE_DIR):
+    """
+    Come prepare_for_training(load_splits(dataset_path), ...), ma il risultato
+    viene salvato in cache_dir (Arrow) sotto tokenized_cache_key: le run
+    successive, anche con altri iperparametri, lo rileggono in memory map
+    senza ritokenizzare. cache_dir=None disattiva la cache.
+    """
+    from datasets import load_from_disk
+
+    if cache_dir is None:
+        return prepare_for_training(load_splits(dataset_path), tokenizer, max_length, padding, system_text)
+
+    path = os.path.join(cache_dir, tokenized_cache_key(tokenizer, max_length, padding, dataset_path, system_text))
+    if os.path.isdir(path):
+        print(f"Dataset tokenizzato dalla cache: {path}")
+        return load_from_disk(path), data_collator_for(padding, tokenizer)
+
+    tokenized, collator = prepare_for_training(load_splits(dataset_path), tokenizer, max_length, padding, system_text,
+                                               check_dir=cache_dir)
+    # scrittura in una cartella temporanea + rename: una run concorrente non vede mai una cache a meta'
+    tmp = f"{path}.tmp-{os.getpid()}"
+    tokenized.save_to_disk(tmp)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # l'ha gia' scritta un'altra run
+    return load_from_disk(path), collator
+
+
+def padding_stats(dataset, max_length: int, padding: str) -> dict:
+    """Token reali (attention 1) rispetto agli slot effettivamente calcolati, con batch size 1."""
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    if padding == "max_length":
+        real = sum(sum(mask) for mask in dataset["attention_mask"])
+    else:
+        real = sum(lengths)
+    slots = sum(-(-n // 8) * 8 for n in lengths) if padding != "max_length" else len(lengths) * max_length
+    return {"rows": len(lengths), "real_tokens": real, "slots": slots, "fill": real / slots if slots else 0.0}
+
+
+def load_trainable_model(profile: ModelProfile):
+    """Modello base + LoRA (QLoRA se profile.train_quantization == "nf4")."""
+    from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+    from transformers import AutoModelForCausalLM
+
+    bnb_config = engine.quantization_config(profile, profile.train_quantization) if profile.train_quantization else None
+    if bnb_config is not None:
+        model = AutoModelForCausalLM.from_pretrained(
+            profile.model_id,
+            quantization_config=bnb_config,
+            device_map="auto",           # IMPORTANTISSIMO con modelli 4-bit
+            trust_remote_code=True,
+        )
+        # prepara modello per k-bit training (LayerNorm, input grads, ecc.)
+        model = prepare_model_for_kbit_training(model)
+    else:
+        use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        model = AutoModelForCausalLM.from_pretrained(
+            profile.model_id,
+            torch_dtype=torch.bfloat16 if use_bf16 else torch.float16,
+            device_map="auto" if torch.cuda.is_available() else None,
+            trust_remote_code=True,
+        )
+
+    peft_config = LoraConfig(
+        r=16,
+        lora_alpha=32,
+        target_modules=[
+            "q_proj", "k_proj", "v_proj", "o_proj",
+            "gate_proj", "up_proj", "down_proj"
+        ],
+        lora_dropout=0.05,
+        bias="none",
+        task_type="CAUSAL_LM",
+    )
+    model = get_peft_model(model, peft_config)
+    # IMPORTANTISSIMO con gradient checkpointing + PEFT
+    model.enable_input_require_grads()
+    model.gradient_checkpointing_enable()
+    model.config.use_cache = False
+
+    model.print_trainable_parameters()
+    return model
+
+
+def train(profile: ModelProfile, dataset_path: str = DATASET_PATH, output_dir: str | None = None):
+    """
+    Addestra l'adapter LoRA di un profilo fine-tuned (es. "phi3-ft") e lo salva,
+    con il tokenizer, in output_dir (default profile.adapter_dir, da dove lo
+    ricarica la valutazione).
+    """
+    from transformers import Trainer, TrainingArguments
+
+    output_dir = output_dir or profile.adapter_dir
+    if output_dir is None:
+        raise ValueError(f"Il profilo {profile.name!r} non ha un adapter_dir: passare output_dir")
+
+    # l'adapter non esiste ancora: tokenizer del modello base
+    tokenizer = engine.load_tokenizer(replace(profile, adapter_dir=None))
+    model = load_trainable_model(profile)
+
+    max_length = profile.max_length
+    if max_length is None:
+        max_length = choose_max_length(example_lengths(tokenizer, dataset_path, prompts.SYSTEM)[1])
+    print_audit(audit_lengths(tokenizer, max_length, dataset_path, prompts.SYSTEM))
+
+    padding = profile.padding
+    if padding == "pack" and not packing_supported(model):
+        print(f"Packing non supportato da {type(model).__name__} (codice remoto): uso padding dinamico")
+        padding = "dynamic"
+
+    tokenized, data_collator = load_training_data(tokenizer, max_length, padding, dataset_path, prompts.SYSTEM)
+    stats = padding_stats(tokenized["train"], max_length, padding)
+    print(f"Padding={padding}: {stats['rows']} righe, {stats['real_tokens']} token reali "
+          f"su {stats['slots']} slot ({stats['fill']:.1%})")
+
+    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    training_args = TrainingArguments(
+        output_dir=output_dir,
+        per_device_train_batch_size=1,
+        gradient_accumulation_steps=16,
+        learning_rate=2e-4,
+        num_train_epochs=3,
+        warmup_ratio=0.03,
+        logging_steps=10,
+        eval_strategy="steps",
+        eval_steps=50,
+        save_strategy="epoch",
+        report_to="none",
+        fp16=(torch.cuda.is_available() and not use_bf16),
+        bf16=(torch.cuda.is_available() and use_bf16),
+        optim=profile.optim,
+        # con il packing le righe sono gia' tutte (quasi) piene
+        group_by_length=profile.group_by_length and padding != "pack",
+        # train_tokens_per_second nei log: confrontabile tra max_length / dynamic / pack
+        include_num_input_tokens_seen="non_padding",
+    )
+
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=tokenized["train"],
+        eval_dataset=tokenized["validation"],
+        data_collator=data_collator,
+        processing_class=tokenizer,
+    )
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    print("Inizio addestramento...")
+    result = trainer.train()
+    runtime = result.metrics.get("train_runtime") or 0
+    if runtime:
+        print(f"Token/s di training (padding={padding}): {trainer.state.num_input_tokens_seen / runtime:.1f} "
+              f"({trainer.state.num_input_tokens_seen} token reali in {runtime:.0f}s)")
+
+    # adapter LoRA + tokenizer
+    model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    print(f"Modello salvato in: {output_dir}")
+    return trainer
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from pipeline.profiles import get_profile
+
+    parser = argparse.ArgumentParser(description="Audit delle lunghezze di D3 per il tokenizer di un profilo")
+    parser.add_argument("profile", help="nome del profilo (es. mistral-ft)")
+    parser.add_argument("--d3", default=DATASET_PATH)
+    parser.add_argument("--max-length", type=int, default=None, help="default: quello del profilo")
+    parser.add_argument("--json", action="store_true", help="stampa il report in JSON")
+    args = parser.parse_args()
+
+    prof = get_profile(args.profile)
+    tok = engine.load_tokenizer(replace(prof, adapter_dir=None))
+    length = args.max_length or prof.max_length
+    if length is None:
+        length = choose_max_length(example_lengths(tok, args.d3, prompts.SYSTEM)[1])
+    report = audit_lengths(tok, length, args.d3, prompts.SYSTEM)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_audit(report)
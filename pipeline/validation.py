@@ -0,0 +1,246 @@
+"""
+Controlli automatici di coerenza tra D1 (JSON strutturato) e D2 (testo),
+in aggiunta alla blacklist scritta a mano in training_dataset.py.
+
+Tutti i controlli lavorano su colonne intere: testi e liste vengono esplosi
+in coppie (id, parola) e confrontati con un join, senza cicli Python per
+riga, quindi lo stesso codice gira su un blocco di 20k righe nel builder di
+D3 e sull'intero RecipeNLG come job batch (python -m pipeline.validation).
+
+Flag per ricetta:
+- missing_text: l'id non ha un blocco in D2
+- unparseable: ingredients/directions non sono liste parsabili
+- empty_directions: nessun passo non vuoto
+- title_mismatch: il titolo di D2 non e' quello di D1 (testo di un'altra ricetta)
+- ingredient_mismatch: meno di meta' degli ingredienti del JSON compare nel testo
+- directions_mismatch: i passi del JSON non descrivono il testo (es. solo una nota)
+- merged_text: il blocco di D2 contiene il titolo di un'altra ricetta, o
+  l'id compare piu' volte in D2.txt con titoli diversi (due ricette sotto
+  lo stesso id; le riscritture della stessa ricetta, es. 837-843, non contano)
+"""
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from pipeline.profiles import ROOT
+
+REPORT_PATH = os.path.join(ROOT, "0.Dataset", "validation.parquet")
+FLAGS = ("missing_text", "unparseable", "empty_directions", "title_mismatch",
+         "ingredient_mismatch", "directions_mismatch", "merged_text")
+
+TITLE_MIN = 0.5         # quota minima di parole del titolo di D1 nella prima riga del testo
+INGREDIENT_MIN = 0.5    # quota minima di ingredienti del JSON citati nel testo
+DIRECTIONS_MIN = 0.2    # quota minima di parole dei passi presenti nel testo
+BATCH_ROWS = 50_000
+
+# vecchia blacklist a mano (ID_DA_ESCLUDERE di training_dataset.py): resta
+# passata a build_d3(exclude=...) finche' check() non la copre tutta
+BLACKLIST = (25, 261, 380, 383, 585, 619, 674, 844, 851, 899, 902, 993, 994, 999)
+# quelli che check() non segnala: ricette scherzo o non alimentari ("Coal Flowers",
+# "Recipe For A Happy Family", "Play Doh") e passi ridotti a una nota, giudizi
+# semantici che i controlli strutturali non riproducono
+KNOWN_EXCEPTIONS = (25, 383, 585, 619, 844, 851, 899, 902, 993, 994, 999)
+
+# unita' di misura e parole vuote: non identificano un ingrediente
+_STOPWORDS = frozenset("""
+cup cups tbsp tsp teaspoon teaspoons tablespoon tablespoons pound pounds ounce ounces pkg pkgs package
+packages can cans jar jars box boxes bottle stick sticks pint quart gallon small medium large with
+and the for into from each about plus more less optional taste chopped sliced diced minced fresh
+""".split())
+_WORD = r"[a-z]{3,}"   # parole di almeno 3 lettere
+
+
+# -----------------------
+# PAROLE (coppie id -> parola normalizzata)
+# -----------------------
+def _normalize(texts) -> pa.Array:
+    """Minuscolo, senza apostrofi ne' parentesi (note come "(Candy)", "(8 oz.)")."""
+    texts = pc.utf8_lower(pa.array(texts, pa.string()).fill_null(""))
+    texts = pc.replace_substring_regex(texts, r"['’]", "")
+    return pc.replace_substring_regex(texts, r"\([^)]*\)", " ")
+
+
+def _stem(words: np.ndarray) -> np.ndarray:
+    """Suffissi piu' comuni tolti (plurali, participi), cosi' "eggs" ~ "egg", "chopped" ~ "chop"."""
+    codes, unique = pd.factorize(words)   # ogni parola distinta una volta sola
+    unique = pc.replace_substring_regex(pa.array(unique, pa.string()), r"ies$", "y")
+    unique = pc.replace_substring_regex(unique, r"(?:es|s|ed|ing)$", "")
+    return unique.to_numpy(zero_copy_only=False)[codes]
+
+
+def word_pairs(ids, texts, item=None, numbers: bool = False) -> pd.DataFrame:
+    """
+    Coppie (id, [item,] word): una riga per parola; `item` numera gli elementi
+    di una lista. Con `numbers` restano anche le quantita' ("1", "1/2", "350").
+    """
+    tokens = pc.split_pattern_regex(_normalize(texts), r"[^a-z0-9/]+" if numbers else r"[^a-z]+")
+    rows = pc.list_parent_indices(tokens).to_numpy()
+    words = pc.list_flatten(tokens)
+    keep = pc.greater_equal(pc.utf8_length(words), 3)
+    if numbers:
+        keep = pc.or_(keep, pc.match_substring_regex(words, r"[0-9]"))
+    keep = keep.to_numpy(zero_copy_only=False)
+    frame = pd.DataFrame({"id": np.asarray(ids)[rows[keep]], "word": _stem(words.filter(keep).to_numpy(zero_copy_only=False))})
+    if item is not None:
+        frame["item"] = np.asarray(item)[rows[keep]]
+    return frame[~frame["word"].isin(_STOPWORDS)]
+
+
+def explode_list(ids, lists: pd.Series) -> pd.DataFrame:
+    """(id, item, value) per ogni elemento delle liste (None e liste vuote spariscono)."""
+    frame = pd.DataFrame({"id": np.asarray(ids), "value": lists.to_numpy()}).explode("value")
+    frame = frame.dropna(subset=["value"])
+    frame["item"] = np.arange(len(frame))
+    return frame
+
+
+def _found(pairs: pd.DataFrame, text_pairs: pd.MultiIndex) -> np.ndarray:
+    return pd.MultiIndex.from_arrays([pairs["id"].to_numpy(), pairs["word"].to_numpy()]).isin(text_pairs)
+
+
+def _share(ids, pairs: pd.DataFrame, hit: np.ndarray) -> pd.Series:
+    """Quota di parole trovate per id; NaN per gli id senza parole."""
+    return pd.Series(hit, index=pairs["id"].to_numpy()).groupby(level=0).mean().reindex(ids)
+
+
+# -----------------------
+# CONTROLLI
+# -----------------------
+def check(frame: pd.DataFrame, titles=None, conflicts=()) -> pd.DataFrame:
+    """
+    Flag di coerenza per ogni riga di `frame` (colonne id, title, ingredients,
+    directions, text; liste gia' parsate, None se non parsabili, text None se
+    manca in D2). `titles`: titoli noti per riconoscere testi che ne contengono
+    un altro (di default quelli di `frame`); `conflicts`: id presenti piu'
+    volte in D2 con titoli diversi (d2_conflicts). Restituisce id, FLAGS e le metriche usate.
+    """
+    ids = frame["id"].to_numpy()
+    text = frame["text"]
+    ingredients, directions = frame["ingredients"], frame["directions"]
+
+    text_words = word_pairs(ids, text)
+    text_pairs = pd.MultiIndex.from_arrays([text_words["id"].to_numpy(), text_words["word"].to_numpy()])
+    lines = pc.split_pattern(pa.array(text, pa.string()).fill_null(""), "\n")
+    head_words = word_pairs(ids, pc.list_element(lines, 0))
+    head_pairs = pd.MultiIndex.from_arrays([head_words["id"].to_numpy(), head_words["word"].to_numpy()])
+
+    title_words = word_pairs(ids, frame["title"])
+    title_share = _share(ids, title_words, _found(title_words, head_pairs))
+
+    ing = explode_list(ids, ingredients)
+    ing_words = word_pairs(ing["id"], ing["value"].astype(str), ing["item"])
+    ing_hit = pd.Series(_found(ing_words, text_pairs), index=ing_words["item"].to_numpy()).groupby(level=0).any()
+    ing["hit"] = ing_hit.reindex(ing["item"]).fillna(False).to_numpy(dtype=bool)
+    ing_found = ing.groupby("id")["hit"].sum().reindex(ids, fill_value=0)
+    ing_count = ing.groupby("id")["hit"].size().reindex(ids, fill_value=0)
+
+    steps = explode_list(ids, directions)
+    step_words = word_pairs(steps["id"], steps["value"].astype(str))
+    dir_share = _share(ids, step_words, _found(step_words, text_pairs))
+
+    # corpo del testo (righe dopo la prima) che coincide con il titolo di un'altra ricetta
+    known = pc.utf8_trim_whitespace(_normalize(frame["title"] if titles is None else titles))
+    body = pc.list_slice(lines, 1)
+    hit = pc.is_in(pc.utf8_trim_whitespace(_normalize(pc.list_flatten(body))), value_set=known.unique())
+    merged = ids[pc.list_parent_indices(body).to_numpy()[hit.to_numpy(zero_copy_only=False)]]
+
+    has_text = text.notna().to_numpy()
+    parsed = (ingredients.notna() & directions.notna()).to_numpy()
+    n_steps = steps[steps["value"].astype(str).str.strip() != ""].groupby("id").size().reindex(ids, fill_value=0)
+
+    report = pd.DataFrame({"id": ids})
+    report["missing_text"] = ~has_text
+    report["unparseable"] = ~parsed
+    report["empty_directions"] = parsed & (n_steps.to_numpy() == 0)
+    report["title_mismatch"] = has_text & (title_share.fillna(1.0).to_numpy() < TITLE_MIN)
+    report["ingredient_mismatch"] = has_text & parsed & (ing_count.to_numpy() > 0) & \
+        (ing_found.to_numpy() < INGREDIENT_MIN * ing_count.to_numpy())
+    report["directions_mismatch"] = has_text & (dir_share.fillna(1.0).to_numpy() < DIRECTIONS_MIN)
+    report["merged_text"] = has_text & (np.isin(ids, merged) | np.isin(ids, list(conflicts)))
+    report["title_share"] = title_share.to_numpy()
+    report["ingredients_found"] = ing_found.to_numpy()
+    report["ingredients_count"] = ing_count.to_numpy()
+    report["directions_share"] = dir_share.to_numpy()
+    return report
+
+
+def corrupt(report: pd.DataFrame) -> np.ndarray:
+    """True per le righe con almeno un flag."""
+    return report[list(FLAGS)].to_numpy().any(axis=1)
+
+
+def reasons(report: pd.DataFrame) -> pd.Series:
+    """Flag attivi di ogni riga, separati da virgola ("" se la ricetta e' valida)."""
+    flags = report[list(FLAGS)].to_numpy()
+    names = np.array(FLAGS, dtype=object)
+    return pd.Series([",".join(names[row]) for row in flags], index=report.index)
+
+
+# -----------------------
+# DATASET COMPLETO (job batch)
+# -----------------------
+def title_key(text: str) -> str:
+    """Prime parole di un blocco (il titolo, anche se il corpo e' sulla stessa riga)."""
+    return " ".join(re.findall(_WORD, re.sub(r"['’]", "", text.lower()))[:3])
+
+
+def d2_conflicts(txt_path: str) -> set:
+    """Id che compaiono piu' volte in D2.txt con titoli diversi."""
+    from pipeline.recipe_io import iter_d2
+
+    seen, conflicts = {}, set()
+    for rid, text in iter_d2(txt_path, normalize=False):
+        if seen.setdefault(rid, title_key(text)) != title_key(text):
+            conflicts.add(rid)
+    return conflicts
+
+
+def validate_dataset(d1_path: str | None = None, d2_path: str | None = None,
+                     batch_rows: int = BATCH_ROWS) -> pd.DataFrame:
+    """Report di check() su tutto D1 (+ testi di D2), a blocchi di `batch_rows` righe."""
+    from pipeline import columnar
+
+    d1 = columnar.load_d1(d1_path or columnar.D1_PATH)
+    d2 = columnar.load_d2(d2_path or columnar.D2_PATH).to_pandas().set_index("id")["text"]
+    titles = d1.column("title").to_pandas()
+    conflicts = d2_conflicts(d2_path or columnar.D2_PATH)
+
+    parts = []
+    for offset in range(0, d1.num_rows, batch_rows):
+        frame = d1.slice(offset, batch_rows).to_pandas()
+        frame["text"] = d2.reindex(frame["id"]).to_numpy()
+        parts.append(check(frame, titles=titles, conflicts=conflicts))
+    return pd.concat(parts, ignore_index=True) if parts else check(pd.DataFrame(columns=["id", "title", "ingredients", "directions", "text"]))
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Controlli di coerenza D1/D2 (ricette corrotte)")
+    parser.add_argument("--d1", default=None)
+    parser.add_argument("--d2", default=None)
+    parser.add_argument("--out", default=REPORT_PATH, help="report Parquet (id, flag, metriche)")
+    parser.add_argument("--compare", default=None, help="id separati da virgola (es. la vecchia blacklist)")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    report = validate_dataset(args.d1, args.d2)
+    elapsed = time.perf_counter() - t0
+    bad = corrupt(report)
+    report.assign(corrupt=bad, reasons=reasons(report)).to_parquet(args.out, index=False)
+
+    print(f"{len(report)} ricette in {elapsed:.1f}s ({len(report) / max(elapsed, 1e-9):.0f} righe/s), corrotte: {int(bad.sum())}")
+    for flag in FLAGS:
+        print(f"  {flag:<20} {int(report[flag].sum())}")
+    print(f"report: {args.out}")
+
+    if args.compare:
+        wanted = {int(x) for x in args.compare.split(",") if x.strip()}
+        flagged = set(report.loc[bad, "id"].tolist())
+        print(f"confronto: {len(wanted & flagged)}/{len(wanted)} trovati, "
+              f"non trovati {sorted(wanted - flagged)}, {len(flagged - wanted)} in piu'")
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import pytest
+
+from pipeline import baseline_client, fake_openai_server
+from pipeline.baseline_client import AdaptiveTokenBucket, retry_after_seconds
+
+
+def _error(headers):
+    return SimpleNamespace(status_code=429, response=SimpleNamespace(headers=headers))
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(_error({"retry-after-ms": "250"})) == 0.25
+    assert retry_after_seconds(_error({"retry-after": "1.5"})) == 1.5
+    when = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < retry_after_seconds(_error({"retry-after": when})) <= 30
+    assert retry_after_seconds(_error({})) is None
+    assert retry_after_seconds(_error({"retry-after": "soon"})) is None
+    assert retry_after_seconds(RuntimeError("no response")) is None
+
+
+def test_bucket_aimd():
+    bucket = AdaptiveTokenBucket(1.0, max_rate=1.1, min_rate=0.2, increase=0.05)
+    bucket.on_rate_limit()
+    assert bucket.rate == 0.5 and bucket.rate_limited == 1
+    for _ in range(4):
+        bucket.on_rate_limit()
+    assert bucket.rate == 0.2   # mai sotto min_rate
+    for _ in range(100):
+        bucket.on_success()
+    assert bucket.rate == 1.1   # risale fino a max_rate, non oltre
+
+
+def test_bucket_blocks_on_retry_after():
+    async def run():
+        bucket = AdaptiveTokenBucket(100.0, burst=4)
+        await bucket.acquire()
+        bucket.on_rate_limit(0.3)
+        t0 = time.monotonic()
+        await asyncio.gather(bucket.acquire(), bucket.acquire())
+        return time.monotonic() - t0
+
+    # nessuna richiesta parte prima che scada il retry-after, anche con token disponibili
+    assert asyncio.run(run()) >= 0.3
+
+
+class RecordingBucket(AdaptiveTokenBucket):
+    """Il bucket di extract_all, con lo storico del rate e dei retry-after ricevuti."""
+
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.history = [self.rate]
+        self.blocks = []     # (istante del 429, retry-after, bloccato fino a)
+        self.acquired = []   # istanti in cui una richiesta ha ottenuto il token
+        RecordingBucket.instances.append(self)
+
+    async def acquire(self):
+        await super().acquire()
+        self.acquired.append(time.monotonic())
+
+    def on_success(self):
+        super().on_success()
+        self.history.append(self.rate)
+
+    def on_rate_limit(self, retry_after=None):
+        super().on_rate_limit(retry_after)
+        self.blocks.append((time.monotonic(), retry_after, self._blocked_until))
+        self.history.append(self.rate)
+
+
+def test_extract_all_against_fake_server(monkeypatch):
+    pytest.importorskip("openai")
+    monkeypatch.setattr(RecordingBucket, "instances", [])
+    monkeypatch.setattr(baseline_client, "AdaptiveTokenBucket", RecordingBucket)
+    server, base_url = fake_openai_server.start_in_thread(rpm=4, window=0.5, latency=0.02)
+    try:
+        texts = [f"Recipe {i}\nMix {i} cups of flour with water and bake." for i in range(16)]
+        records = []
+        t0 = time.monotonic()
+        out = asyncio.run(baseline_client.extract_all(
+            baseline_client.make_client("fake", base_url), texts, "system", concurrency=4, rate=8.0,
+            max_rate=8.0, ids=range(500, 516), records=records,
+        ))
+        elapsed = time.monotonic() - t0
+    finally:
+        server.shutdown()
+
+    # stesso ordine dell'input nonostante le richieste concorrenti e i retry
+    assert [r["title"] for r in out] == [f"Recipe {i}" for i in range(16)]
+    assert [rec["id"] for rec in records] == list(range(500, 516))
+    assert all(rec["output"] is not None and rec["stage"] == "baseline" for rec in records)
+    assert server.rate_limited > 0
+    assert sum(rec["attempts"] for rec in records) == server.requests == 16 + server.rate_limited
+
+    bucket = RecordingBucket.instances[0]
+    # ogni 429 porta un retry-after e blocca il bucket: nessun token esce prima della scadenza
+    assert len(bucket.blocks) == server.rate_limited
+    for at, wait, until in bucket.blocks:
+        assert wait is not None and 0 < wait <= 0.5
+        assert all(t >= until for t in bucket.acquired if t > at)
+    # 4 richieste ogni 0.5 s: 16 ricette non possono finire prima di 3 finestre
+    assert elapsed >= 1.5
+    # AIMD: il rate si dimezza al primo 429 e poi risale con le risposte ok
+    history = bucket.history
+    first = next(i for i in range(1, len(history)) if history[i] < history[i - 1])
+    assert history[first] == pytest.approx(history[first - 1] / 2)
+    assert max(history[first:]) > history[first]
@@ -0,0 +1,39 @@
+import json
+import os
+
+import pytest
+
+from pipeline import baseline_client, benchmark, fake_openai_server
+
+COST_KEYS = ("seconds", "recipes_per_s", "tokens_per_s", "latency_p50", "latency_p95", "latency_p99", "ttft_p50",
+             "load_seconds", "model_mem_mb", "retry_rate", "stops")
+QUALITY_KEYS = ("syntax_ok_pct", "schema_ok_pct", "semantic_ok_pct", "ingredient_f1", "step_recall")
+
+
+def test_benchmark_stand_in(tiny_model_dir, tmp_path):
+    pytest.importorskip("openai")
+    out_dir = str(tmp_path / "benchmark")
+    server, url = fake_openai_server.start_in_thread(rpm=6000, latency=0.01)
+    try:
+        report = benchmark.run_benchmark(
+            ("qwen2.5", "qwen2.5-ft"), out_dir, limit=2, stand_in_dir=tiny_model_dir, max_new_tokens=16,
+            baseline={"base_url": url, "api_key": "fake", "rate": 50.0}, merged=True,
+        )
+    finally:
+        server.shutdown()
+
+    with open(os.path.join(out_dir, "benchmark.json"), encoding="utf-8") as f:
+        assert json.load(f) == json.loads(json.dumps(report))
+    assert len(report["recipes"]) == 2 and report["merged"]
+    # una riga per variante: base, adapter, checkpoint unito, baseline
+    models = [row["model"] for row in report["rows"]]
+    assert models == ["qwen2.5", "qwen2.5-ft", "qwen2.5-ft-merged", baseline_client.MODEL]
+    for row in report["rows"]:
+        assert row["recipes"] == 2 and 0 <= row["ok"] <= 2, row["model"]
+        assert all(key in row for key in COST_KEYS + QUALITY_KEYS), row["model"]
+        assert row["seconds"] > 0 and row["recipes_per_s"] > 0
+        assert os.path.exists(row["records"])
+    assert [row["adapter"] is not None for row in report["rows"]] == [False, True, False, False]
+    # la baseline finta risponde sempre con JSON valido
+    assert report["rows"][-1]["ok"] == 2 and report["rows"][-1]["syntax_ok_pct"] == 100.0
+    assert len(benchmark.format_table(report["rows"]).splitlines()) == 2 + len(models)
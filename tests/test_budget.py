@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from pipeline import budget, engine
+from pipeline.benchmark import stand_in
+from pipeline.profiles import PROFILES
+
+
+def test_quantile_budget_only_for_finetuned_profiles(tiny_model_dir, monkeypatch):
+    # i profili base non leggono D3: budget fisso max_new_tokens
+    def fail(*args, **kwargs):
+        raise AssertionError("budget stimato su D3 per un profilo base")
+
+    monkeypatch.setattr(budget, "fit_budget", fail)
+    for name, profile in PROFILES.items():
+        assert (profile.budget_quantile is not None) == bool(profile.adapter_dir), name
+        if profile.budget_quantile is None:
+            assert engine.first_budget(stand_in(profile, tiny_model_dir), ["1 cup flour"]) == profile.max_new_tokens
+
+
+def test_fit_budget_covers_quantile(tokenizer, tmp_path):
+    from pipeline.training import DATASET_PATH
+
+    path = tmp_path / "D3.csv"
+    pd.read_csv(DATASET_PATH).head(300).to_csv(path, index=False)
+    model = budget.fit_budget(tokenizer, str(path), quantile=0.9)
+    stats = budget.coverage(model, tokenizer, str(path))
+    assert model.n == stats["recipes"] == 300
+    assert stats["covered"] == pytest.approx(0.9, abs=0.03)
+    assert stats["mean_budget"] < stats["max_output"]
+    assert budget.fit_budget(tokenizer, str(path), quantile=0.9) is model   # una stima per tokenizer e dataset
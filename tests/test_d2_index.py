@@ -0,0 +1,46 @@
+import os
+
+from pipeline import recipe_io
+
+
+def _copy_d2(tmp_path, n_bytes=200_000):
+    """Inizio di D2.txt (blocchi interi) in una cartella temporanea: l'indice si scrive accanto."""
+    from conftest import D2_TXT
+
+    path = tmp_path / "D2.txt"
+    with open(D2_TXT, "rb") as f:
+        data = f.read(n_bytes)
+    path.write_bytes(data[: data.rindex(b"\nID ") + 1])
+    return str(path)
+
+
+def test_index_matches_iter_d2(tmp_path):
+    path = _copy_d2(tmp_path)
+    expected = dict(recipe_io.iter_d2(path))
+    with recipe_io.D2Index(path) as index:
+        assert index.ids == sorted(expected) and len(index) > 10
+        assert all(index.get(rid) == text for rid, text in expected.items())
+        lo, hi = index.ids[3], index.ids[9]
+        assert list(index.iter_range(lo, hi)) == [(rid, expected[rid]) for rid in sorted(expected) if lo <= rid < hi]
+        assert -1 not in index
+
+
+def test_sidecar_reused_and_rebuilt(tmp_path, monkeypatch):
+    path = _copy_d2(tmp_path)
+    recipe_io.D2Index(path).close()
+    assert os.path.exists(path + ".idx.npz")
+
+    # file invariato: l'indice si rilegge senza ripassare sul testo
+    def fail(self):
+        raise AssertionError("indice ricostruito con D2.txt invariato")
+
+    with monkeypatch.context() as m:
+        m.setattr(recipe_io.D2Index, "_build", fail)
+        recipe_io.D2Index(path).close()
+
+    # D2.txt modificato: l'indice vecchio non vale piu' e si ricostruisce
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("ID 999999 — Ricetta aggiunta\nacqua e sale\n")
+    with recipe_io.D2Index(path) as index:
+        assert 999999 in index
+        assert index.get(999999) == dict(recipe_io.iter_d2(path))[999999]
@@ -0,0 +1,31 @@
+import os
+from dataclasses import replace
+
+from pipeline import export, gen_cache
+from pipeline.profiles import get_profile
+
+
+def _adapter(tmp_path, weights: bytes):
+    adapter_dir = tmp_path / "qwen-recipe-json-model"
+    adapter_dir.mkdir(exist_ok=True)
+    (adapter_dir / "adapter_config.json").write_text('{"r": 8}', encoding="utf-8")
+    (adapter_dir / "adapter_model.safetensors").write_bytes(weights)
+    return str(adapter_dir)
+
+
+def test_merged_profile_keeps_adapter_digest(tmp_path):
+    profile = replace(get_profile("qwen2.5-ft"), adapter_dir=_adapter(tmp_path, b"v1"))
+    out_dir = export.merged_dir(profile)
+    os.makedirs(out_dir)
+    export._write_info(out_dir, profile, None)
+    first = export.merged_profile(profile)
+    assert first.adapter_dir is None and first.model_id == out_dir
+    assert gen_cache.weights_digest(first) == gen_cache.adapter_digest(profile.adapter_dir) != ""
+
+    # adapter riaddestrato e riesportato nella stessa cartella (--force): stesso model_id, chiave diversa
+    _adapter(tmp_path, b"v2-retrained")
+    assert not export.is_fresh(profile, out_dir)
+    export._write_info(out_dir, profile, None)
+    second = export.merged_profile(profile)
+    assert second.model_id == first.model_id
+    assert gen_cache.weights_digest(second) != gen_cache.weights_digest(first)
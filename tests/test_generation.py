@@ -0,0 +1,123 @@
+import pytest
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from pipeline import generation, grammar, parsing, prompts, stopping
+from pipeline.prefix_cache import PrefixKVCache
+
+MAX_NEW_TOKENS = 48
+
+
+class StopAfterRowBudget(StoppingCriteria):
+    """
+    Ferma ogni riga dopo un numero di token che dipende dalla riga (dagli
+    ultimi token del suo prompt, uguali con o senza padding a sinistra e con
+    o senza cache del prefisso). Con un modello casuale lo stop sul JSON
+    chiuso non scatta mai: cosi' le righe finiscono a lunghezze diverse e
+    con uno stato per riga il punto di stop non cambia con il batch.
+    """
+
+    def __init__(self, prompt_len: int, tail: int = 12, spread: int = 23):
+        self.prompt_len = prompt_len
+        self.tail = tail
+        self.spread = spread
+        self.budgets = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.budgets is None:
+            tails = input_ids[:, self.prompt_len - self.tail : self.prompt_len]
+            self.budgets = tails.sum(dim=1) % self.spread + 2
+        return input_ids.shape[1] - self.prompt_len >= self.budgets
+
+
+def _row_stop(prompt_len):
+    return {"stopping_criteria": StoppingCriteriaList([StopAfterRowBudget(prompt_len)])}
+
+
+@pytest.fixture(scope="module")
+def recipes():
+    from conftest import D2_TXT
+    from pipeline.recipe_io import iter_d2
+
+    texts = []
+    for _, text in iter_d2(D2_TXT):
+        texts.append(text)
+        if len(texts) == 6:
+            break
+    # lunghezze diverse: il padding a sinistra cambia da riga a riga
+    return [texts[0][:40], texts[1], texts[2][:120], texts[3], texts[4][:15], texts[5]]
+
+
+def _build(tokenizer):
+    return lambda text, system: prompts.build_prompt(tokenizer, text, system)
+
+
+def _generate(model, tokenizer, recipe_prompts, batch_size, prefix=None, constrained=True, row_stop=False):
+    factories = [_row_stop if row_stop else stopping.json_stop_kwargs(tokenizer)]
+    if constrained:
+        factories.append(grammar.schema_kwargs(tokenizer))
+    texts, lengths = [], []
+    for _, batch in generation.chunked(recipe_prompts, batch_size):
+        out, n = generation.generate_batch(
+            model, tokenizer, batch, MAX_NEW_TOKENS,
+            kwargs_factory=generation.combine_kwargs(*factories), prefix=prefix, return_lengths=True,
+        )
+        texts += out
+        lengths += n
+    return texts, lengths
+
+
+@pytest.mark.parametrize("constrained,row_stop", [(True, False), (False, False), (False, True)])
+def test_batch_size_invariance(model, tokenizer, recipes, constrained, row_stop):
+    recipe_prompts = [_build(tokenizer)(text, prompts.SYSTEM) for text in recipes]
+    reference, ref_lengths = _generate(model, tokenizer, recipe_prompts, 1, constrained=constrained, row_stop=row_stop)
+    if row_stop:
+        assert len(set(ref_lengths)) > 2 and max(ref_lengths) > min(ref_lengths) + 5
+    for batch_size in (2, 4, len(recipes)):
+        texts, lengths = _generate(model, tokenizer, recipe_prompts, batch_size, constrained=constrained,
+                                   row_stop=row_stop)
+        # stesso testo per riga e nello stesso ordine: il padding e lo stop di una riga non toccano le altre
+        assert texts == reference, batch_size
+        assert lengths == ref_lengths, batch_size
+
+
+def test_prefix_cache_equivalence(model, tokenizer, recipes):
+    build = _build(tokenizer)
+    cache = PrefixKVCache(model, tokenizer)
+    for system in (prompts.SYSTEM, prompts.SYSTEM + prompts.RETRY_SUFFIX):
+        prefix = cache.get(system, build)
+        assert len(prefix[0]) > 0
+        recipe_prompts = [build(text, system) for text in recipes]
+        assert all(tokenizer(p)["input_ids"][: len(prefix[0])] == prefix[0] for p in recipe_prompts)
+        for row_stop in (False, True):
+            reference = _generate(model, tokenizer, recipe_prompts, 3, row_stop=row_stop, constrained=not row_stop)
+            for batch_size in (1, 3):
+                assert _generate(model, tokenizer, recipe_prompts, batch_size, prefix=prefix, row_stop=row_stop,
+                                 constrained=not row_stop) == reference
+    # una voce per system prompt, riusata
+    assert cache.get(prompts.SYSTEM, build) is cache.get(prompts.SYSTEM, build)
+
+
+def test_json_stop_is_per_row(tokenizer):
+    texts = [
+        '{"a": "}"} and more text after the object',
+        '{"a": {"b": "\\"}{"}, "c": []} tail',
+        'no json yet {"a": [1, 2]}',
+        '{"never": "closed"',
+    ]
+    rows = [tokenizer(t, add_special_tokens=False)["input_ids"] for t in texts]
+    width = max(map(len, rows))
+    pad = tokenizer.eos_token_id
+    ids = torch.tensor([row + [pad] * (width - len(row)) for row in rows])
+    stopper = stopping.StopOnJsonEnd(tokenizer, start_len=0)
+    done_at = [None] * len(rows)
+    for step in range(1, width + 1):
+        for i, flag in enumerate(stopper(ids[:, :step], None).tolist()):
+            if flag and done_at[i] is None:
+                done_at[i] = step
+    # ogni riga si ferma sul token che chiude il SUO primo oggetto (graffe e escape dentro le stringhe compresi)
+    for i, row in enumerate(rows):
+        expected = next((k for k in range(1, len(row) + 1)
+                         if parsing.extract_first_json_block(tokenizer.decode(row[:k])) is not None), None)
+        assert done_at[i] == expected, texts[i]
+    assert done_at[3] is None and len(set(done_at)) == len(rows)
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from pipeline import grammar, parsing
+
+
+def _run(automaton, tokenizer, text):
+    """Stato finale dopo i token di `text` (None se un token esce dallo schema)."""
+    state = grammar.START
+    for token_id in tokenizer(text, add_special_tokens=False)["input_ids"]:
+        state = automaton.advance(state, token_id)
+        if state is None:
+            return None
+    return state
+
+
+def _obj(key):
+    return json.dumps({"title": "Pie", "ingredients": ["1 egg", "2 c. flour"], key: ["Mix.", "Bake \"hot\"."]})
+
+
+@pytest.mark.parametrize("lenient", [False, True])
+def test_accepts_what_try_parse_accepts(tokenizer, lenient):
+    keys = grammar.LENIENT_STEP_KEYS if lenient else grammar.STEP_KEYS
+    automaton = grammar.TokenSchemaAutomaton(tokenizer, keys)
+    for key in ("steps", "directions", "step", "notes"):
+        text = _obj(key)
+        obj, err, _ = parsing.try_parse(text, lenient)
+        accepted = _run(automaton, tokenizer, text) == automaton.end
+        # la grammatica non deve ammettere chiavi che try_parse rifiuta, ne' vietare l'alias
+        assert accepted == (key in keys), key
+        if accepted:
+            assert err is None and obj["steps"] == ["Mix.", "Bake \"hot\"."]
+
+
+def test_rejects_extra_text(tokenizer):
+    automaton = grammar.TokenSchemaAutomaton(tokenizer)
+    assert _run(automaton, tokenizer, "```json\n" + _obj("steps")) is None
+    assert _run(automaton, tokenizer, _obj("steps") + " ok") is None
+
+
+def test_schema_kwargs_follows_lenient(tokenizer):
+    strict = grammar.schema_kwargs(tokenizer)(0)["logits_processor"][0].automaton
+    lenient = grammar.schema_kwargs(tokenizer, lenient=True)(0)["logits_processor"][0].automaton
+    assert _run(strict, tokenizer, _obj("directions")) is None
+    assert _run(lenient, tokenizer, _obj("directions")) == lenient.end
@@ -0,0 +1,70 @@
+import torch
+from datasets import Dataset
+
+from pipeline import training
+
+
+def _examples(tokenizer, n=5):
+    from conftest import D2_TXT
+    from pipeline.recipe_io import iter_d2
+
+    rows = {"input_ids": [], "labels": []}
+    for _, (_, text) in zip(range(n), iter_d2(D2_TXT)):
+        ids = tokenizer(text[: 60 + 40 * len(rows["input_ids"])], add_special_tokens=False)["input_ids"]
+        rows["input_ids"].append(ids)
+        rows["labels"].append([-100] * (len(ids) // 2) + ids[len(ids) // 2 :])
+    return Dataset.from_dict(rows)
+
+
+def test_pack_layout(tokenizer):
+    dataset = _examples(tokenizer)
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    max_length = max(lengths) + min(lengths)
+    packed = training.pack_examples(dataset, max_length)
+    assert len(packed) < len(dataset)
+    seen = []
+    for ids, labels, pos in zip(packed["input_ids"], packed["labels"], packed["position_ids"]):
+        assert len(ids) == len(labels) == len(pos) <= max_length
+        starts = [i for i, p in enumerate(pos) if p == 0] + [len(pos)]
+        for a, b in zip(starts, starts[1:]):
+            assert pos[a:b] == list(range(b - a))
+            # il primo token di ogni esempio non e' predetto dall'esempio precedente
+            assert labels[a] == -100
+            seen.append(ids[a:b])
+    assert sorted(map(tuple, seen)) == sorted(map(tuple, dataset["input_ids"]))
+
+
+def test_packed_examples_do_not_attend_to_each_other(model, tokenizer, monkeypatch):
+    # come in training.load_trainable_model: senza cache la maschera a blocchi viene dai position_ids
+    monkeypatch.setattr(model.config, "use_cache", False)
+    assert training.packing_supported(model)
+    dataset = _examples(tokenizer, n=3)
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    packed = training.pack_examples(dataset, sum(lengths))
+    assert len(packed) == 1
+    batch = training.PaddingCollator(tokenizer.eos_token_id)([packed[0]])
+    with torch.no_grad():
+        logits = model(input_ids=batch["input_ids"], position_ids=batch["position_ids"], use_cache=False).logits[0]
+        pos = batch["position_ids"][0].tolist()
+        starts = [i for i, p in enumerate(pos[: sum(lengths)]) if p == 0] + [sum(lengths)]
+        for a, b in zip(starts, starts[1:]):
+            alone = model(input_ids=batch["input_ids"][:, a:b]).logits[0]
+            # stessi logit dell'esempio da solo: la maschera a blocchi isola gli esempi nella riga
+            torch.testing.assert_close(logits[a:b], alone, atol=1e-4, rtol=1e-4)
+    assert len(starts) == 4
+
+
+def test_packing_needs_cache_off(model, monkeypatch):
+    monkeypatch.setattr(model.config, "use_cache", True)
+    assert not training.packing_supported(model)
+    monkeypatch.setattr(model.config, "use_cache", False)
+    assert training.packing_supported(model)
+
+
+def test_padding_collator(tokenizer):
+    features = [{"input_ids": [5, 6, 7], "labels": [-100, 6, 7], "position_ids": [0, 1, 2]},
+                {"input_ids": [8], "labels": [8], "position_ids": [0]}]
+    batch = training.PaddingCollator(pad_token_id=1, pad_to_multiple_of=4)(features)
+    assert batch["input_ids"].tolist() == [[5, 6, 7, 1], [8, 1, 1, 1]]
+    assert batch["labels"].tolist() == [[-100, 6, 7, -100], [8, -100, -100, -100]]
+    assert batch["position_ids"].tolist() == [[0, 1, 2, 0], [0, 0, 0, 0]]
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from pipeline import recipe_io, results
+
+
+def test_resume_semantics(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    results.write_records(path, [
+        results.ResultRecord(id=1, model="m", output={"title": "a", "ingredients": [], "steps": []}),
+        results.ResultRecord(id=2, model="m", error="no_json", raw="..."),
+        results.ResultRecord(id=3, model="m", output={"title": "c", "ingredients": [], "steps": []}),
+    ])
+    # un retry riuscito e uno fallito dopo un successo: vale l'ultimo record per id
+    results.write_records(path, [
+        results.ResultRecord(id=2, model="m", attempts=2, output={"title": "b", "ingredients": [], "steps": []}),
+        results.ResultRecord(id=3, model="m", error="invalid_json"),
+    ], append=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"id": 4, "model": "m", "output": {"ti')   # riga scritta a meta' da un crash
+
+    records = results.read_records(path)
+    assert sorted(records) == [1, 2, 3]
+    assert records[2]["attempts"] == 2 and records[2]["ok"]
+    assert records[3]["error"] == "invalid_json" and not records[3]["ok"]
+    # il resume salta solo le riuscite: 3 (ultimo record fallito) e 4 (troncata) si ritentano
+    assert set(results.done_ids(path)) == {1, 2}
+
+    assert recipe_io.repair_jsonl_tail(path) > 0
+    results.write_records(path, [results.ResultRecord(id=4, model="m", error="no_json")], append=True)
+    assert sorted(results.read_records(path)) == [1, 2, 3, 4]
+
+
+def test_to_dict_roundtrip():
+    record = results.ResultRecord(id=7, model="qwen2.5", stage="stream", error="no_json", stop="budget")
+    row = record.to_dict()
+    assert row["ok"] is False and "extra" not in row
+    assert json.loads(json.dumps(row))["id"] == 7
+
+
+def test_jsonl_ids(tmp_path):
+    path = tmp_path / "recipes.jsonl"
+    path.write_text("\n".join(json.dumps(row) for row in [
+        {"id": 12, "text": "a"}, {"id": "13", "text": "b"}, {"text": "c"},
+    ]) + "\n", encoding="utf-8")
+    assert list(recipe_io.iter_recipes(str(path))) == [(12, "a"), (13, "b"), (2, "c")]
+
+    bad = tmp_path / "bad.jsonl"
+    bad.write_text(json.dumps({"id": "r-1", "text": "a"}) + "\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="riga 1"):
+        list(recipe_io.iter_recipes(str(bad)))
+
+
+def test_csv_ids(tmp_path):
+    path = tmp_path / "recipes.csv"
+    path.write_text("id,text\n5,a\n,b\nx7,c\n", encoding="utf-8")
+    rows = recipe_io.iter_recipes(str(path))
+    assert next(rows) == (5, "a") and next(rows) == (1, "b")
+    with pytest.raises(ValueError, match="x7"):
+        next(rows)
+
+
+def test_id_set():
+    ids = results.IdSet([3, 0, 5000, -2, 1 << 40])
+    ids.discard(3)
+    ids.discard(7)
+    assert 0 in ids and 5000 in ids and -2 in ids and (1 << 40) in ids
+    assert 3 not in ids and 7 not in ids and 10**6 not in ids and "3" not in ids
+    assert len(ids) == 4 and set(ids) == {0, 5000, -2, 1 << 40}
@@ -0,0 +1,117 @@
+import copy
+
+import pytest
+
+from pipeline import columnar, prompts, segment_tokenize, training
+
+
+@pytest.fixture(scope="module")
+def sp_tokenizer():
+    """Tokenizer stile SentencePiece (Metaspace): "▁" davanti al primo pezzo di ogni testo tokenizzato, come Mistral / Phi-3."""
+    from conftest import CHAT_TEMPLATE, D2_TXT
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    with open(D2_TXT, encoding="utf-8") as f:
+        text = f.read()
+    tok = Tokenizer(models.BPE(unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.Metaspace(replacement="\u2581", prepend_scheme="first")
+    tok.decoder = decoders.Metaspace(replacement="\u2581", prepend_scheme="first")
+    tok.train_from_iterator([text], trainers.BpeTrainer(
+        vocab_size=1000, special_tokens=["<unk>", "<s>", "</s>", "<|system|>", "<|user|>", "<|assistant|>"],
+    ))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tok, unk_token="<unk>", bos_token="<s>", eos_token="</s>")
+    tokenizer.chat_template = CHAT_TEMPLATE
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def examples():
+    table = columnar.load_d3(training.DATASET_PATH).slice(0, 40)
+    return {"text": table.column("text").to_pylist(), "json": table.column("json").to_pylist()}
+
+
+@pytest.fixture
+def pad_tokenizer(tokenizer):
+    tok = copy.deepcopy(tokenizer)
+    tok.pad_token = tok.eos_token
+    return tok
+
+
+def _assert_same(examples, tok, max_length, padding):
+    reference = training.tokenize_and_mask(examples, tok, max_length, prompts.SYSTEM, padding)
+    segmented = segment_tokenize.tokenize_and_mask_segments(examples, tok, max_length, prompts.SYSTEM, padding)
+    for key in ("input_ids", "attention_mask", "labels"):
+        assert segmented[key] == reference[key], key
+    return reference
+
+
+@pytest.mark.parametrize("padding", ["max_length", False])
+@pytest.mark.parametrize("max_length", [1024, 96])
+def test_same_ids_and_labels(examples, pad_tokenizer, max_length, padding):
+    assert segment_tokenize.segment_template(pad_tokenizer, prompts.SYSTEM) is not None
+    out = _assert_same(examples, pad_tokenizer, max_length, padding)
+    lengths = [sum(mask) for mask in out["attention_mask"]]
+    if max_length == 96:
+        # il troncamento a max_length deve scattare davvero (anche dentro il prefisso)
+        assert all(n == max_length for n in lengths)
+        assert any(all(label == -100 for label in labels) for labels in out["labels"])
+    else:
+        assert max(lengths) < max_length
+
+
+@pytest.mark.parametrize("padding", ["max_length", False])
+def test_left_side(examples, pad_tokenizer, padding):
+    pad_tokenizer.padding_side = "left"
+    pad_tokenizer.truncation_side = "left"
+    _assert_same(examples, pad_tokenizer, 96, padding)
+    _assert_same(examples, pad_tokenizer, 1024, padding)
+
+
+def test_fallback_when_template_rewrites_content(examples, pad_tokenizer):
+    # un template che modifica i contenuti non si puo' spezzare: si torna a tokenize_and_mask
+    pad_tokenizer.chat_template = pad_tokenizer.chat_template.replace("m['content']", "m['content'] | trim")
+    assert segment_tokenize.segment_template(pad_tokenizer, prompts.SYSTEM) is None
+    _assert_same(examples, pad_tokenizer, 96, "max_length")
+
+
+def test_sentencepiece_falls_back(examples, sp_tokenizer, capsys):
+    # lo spazio iniziale aggiunto a ogni segmento cambia i token: le righe di prova lo vedono
+    template, reason = segment_tokenize.segment_status(sp_tokenizer, prompts.SYSTEM)
+    assert template is None and "confini" in reason
+    _assert_same(examples, sp_tokenizer, 1024, False)
+    fn = segment_tokenize.choose_tokenize_fn(sp_tokenizer, examples["text"], examples["json"], prompts.SYSTEM)
+    assert fn is training.tokenize_and_mask
+    assert "tokenize_and_mask" in capsys.readouterr().out
+
+
+def test_real_rows_checked_beyond_probes(examples, sp_tokenizer, monkeypatch, capsys):
+    # senza righe di prova il template passa, ma la verifica sulle righe vere di D3 lo scarta
+    monkeypatch.setattr(segment_tokenize, "_PROBES", [])
+    monkeypatch.setattr(segment_tokenize, "_TEMPLATES", {})
+    assert segment_tokenize.segment_template(sp_tokenizer, prompts.SYSTEM) is not None
+    fn = segment_tokenize.choose_tokenize_fn(sp_tokenizer, examples["text"], examples["json"], prompts.SYSTEM)
+    assert fn is training.tokenize_and_mask
+    out = capsys.readouterr().out
+    assert f"{len(examples['text'])}/{len(examples['text'])} righe diverse" in out
+
+
+def test_check_saved_once_per_dataset(examples, pad_tokenizer, tmp_path, monkeypatch, capsys):
+    check_dir = str(tmp_path)
+    fn = segment_tokenize.choose_tokenize_fn(pad_tokenizer, examples["text"], examples["json"], prompts.SYSTEM,
+                                             check_dir)
+    assert fn is segment_tokenize.tokenize_and_mask_segments
+    assert "per segmenti" in capsys.readouterr().out
+
+    def fail(*args, **kwargs):
+        raise AssertionError("verifica ripetuta con lo stesso tokenizer e le stesse righe")
+
+    # stesse righe: l'esito salvato basta; righe diverse: si verifica di nuovo
+    with monkeypatch.context() as m:
+        m.setattr(segment_tokenize, "verify_rows", fail)
+        assert segment_tokenize.choose_tokenize_fn(pad_tokenizer, examples["text"], examples["json"],
+                                                   prompts.SYSTEM, check_dir) is fn
+    segment_tokenize.choose_tokenize_fn(pad_tokenizer, examples["text"][:5], examples["json"][:5], prompts.SYSTEM,
+                                        check_dir)
+    assert len(list(tmp_path.glob("segment-check-*.json"))) == 2
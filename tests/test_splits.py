@@ -0,0 +1,27 @@
+import numpy as np
+
+from pipeline import splits
+
+
+def test_pinned_ranges_override_hash():
+    ids = np.arange(0, 1200)
+    out = splits.assign(ids)
+    assert set(out[:50]) == {"inference"}
+    assert set(out[900:1001]) == {"test"}
+    assert set(out[50:900]) | set(out[1001:]) <= {"train", "validation"}
+
+
+def test_assign_is_stable_for_any_id():
+    ids = np.array([5, 123, 10**9, 2_231_141, 77])
+    # stesso id -> stesso split, indipendentemente dall'ordine e dagli altri id
+    assert list(splits.assign(ids)) == list(splits.assign(ids[::-1]))[::-1]
+    assert [splits.assign([i])[0] for i in ids] == list(splits.assign(ids))
+
+
+def test_manifest_matches_assign(tmp_path):
+    path = str(tmp_path / "splits.parquet")
+    splits.build_manifest(ids=[3, 1, 950, 400, 400], path=path)
+    table = splits.load_manifest(path=path)
+    assert table.column("id").to_pylist() == [1, 3, 400, 950]
+    assert table.column("split").to_pylist() == list(splits.assign([1, 3, 400, 950]))
+    assert splits.ids_in("test", path=path).tolist() == [950]
@@ -0,0 +1,78 @@
+import json
+from dataclasses import replace
+
+import pytest
+
+from pipeline import engine, recipe_io, results
+from pipeline.benchmark import stand_in
+from pipeline.profiles import get_profile
+
+BATCH_SIZE = 3
+
+
+@pytest.fixture
+def profile(tiny_model_dir):
+    prof = replace(stand_in(get_profile("qwen2.5"), tiny_model_dir), name="test-stream",
+                   max_new_tokens=16, retry_max_new_tokens=None, budget_quantile=None)
+    yield prof
+    engine.unload(prof)
+
+
+@pytest.fixture
+def recipes_jsonl(tmp_path):
+    from conftest import D2_TXT
+
+    path = tmp_path / "recipes.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for n, (_, text) in zip(range(8), recipe_io.iter_d2(D2_TXT)):
+            f.write(json.dumps({"id": str(100 + 3 * n), "text": text[:200]}) + "\n")
+    return str(path)
+
+
+def _lines(path):
+    return sum(1 for _ in recipe_io.read_jsonl(path))
+
+
+def test_stream_is_lazy_and_writes_one_record_per_id(profile, recipes_jsonl, tmp_path):
+    out_path, fail_path = str(tmp_path / "out.jsonl"), str(tmp_path / "fail.jsonl")
+    pulled = []
+
+    def records():
+        for k, (rid, text) in enumerate(recipe_io.iter_recipes(recipes_jsonl)):
+            # quando si legge il primo id di un micro-batch, i precedenti sono gia' tutti su disco
+            if k % BATCH_SIZE == 0:
+                assert _lines(out_path) == k
+            pulled.append(rid)
+            yield rid, text
+
+    n_ok, n_failed = engine.run_extraction_stream(profile, records(), out_path, fail_path, BATCH_SIZE)
+    rows = list(recipe_io.read_jsonl(out_path))
+    ids = [100 + 3 * n for n in range(8)]
+    assert [row["id"] for row in rows] == ids == pulled
+    assert n_ok + n_failed == len(ids)
+    assert all(row["stage"] == "stream" and row["model"] == "test-stream" for row in rows)
+    failed = [row for row in rows if not row["ok"]]
+    assert len(failed) == n_failed
+    fails = list(recipe_io.read_jsonl(fail_path))
+    assert [row["id"] for row in fails] == [row["id"] for row in failed]
+    assert all(row["recipe_text"] and row["error"] for row in fails)
+
+
+def test_stream_resume_skips_done_ids(profile, recipes_jsonl, tmp_path):
+    out_path, fail_path = str(tmp_path / "out.jsonl"), str(tmp_path / "fail.jsonl")
+    done = {"title": "x", "ingredients": [], "steps": []}
+    results.write_records(out_path, [
+        results.ResultRecord(id=100, model="test-stream", output=done),
+        results.ResultRecord(id=103, model="test-stream", error="no_json"),
+        results.ResultRecord(id=106, model="test-stream", output=done),
+    ])
+    with open(out_path, "a", encoding="utf-8") as f:
+        f.write('{"id": 109, "mod')   # crash a meta' riga
+
+    engine.run_extraction_stream(profile, recipe_io.iter_recipes(recipes_jsonl), out_path, fail_path,
+                                 BATCH_SIZE, resume=True)
+    rows = list(recipe_io.read_jsonl(out_path))
+    # i tre record di prima restano, la riga troncata sparisce, le riuscite non si rigenerano
+    assert [row["id"] for row in rows[:3]] == [100, 103, 106]
+    assert [row["id"] for row in rows[3:]] == [103] + [100 + 3 * n for n in range(3, 8)]
+    assert set(results.read_records(out_path)) == {100 + 3 * n for n in range(8)}
@@ -0,0 +1,65 @@
+import copy
+
+import pandas as pd
+import pytest
+
+from pipeline import prompts, training
+
+
+@pytest.fixture
+def d3_small(tmp_path):
+    """Prime righe di D3 in un CSV a parte (train e validation secondo il manifest)."""
+    path = tmp_path / "D3.csv"
+    pd.read_csv(training.DATASET_PATH).head(120).to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.fixture
+def pad_tokenizer(tokenizer):
+    tok = copy.deepcopy(tokenizer)
+    tok.pad_token = tok.eos_token
+    return tok
+
+
+def _rows(dataset):
+    return {split: dataset[split].to_dict() for split in dataset}
+
+
+def test_cache_roundtrip(d3_small, pad_tokenizer, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "tokenized")
+    fresh, _ = training.prepare_for_training(training.load_splits(d3_small), pad_tokenizer, 1024, "pack")
+    first, _ = training.load_training_data(pad_tokenizer, 1024, "pack", d3_small, cache_dir=cache_dir)
+    assert _rows(first) == _rows(fresh)
+
+    # la seconda run rilegge la cache senza ritokenizzare
+    def fail(*args, **kwargs):
+        raise AssertionError("ritokenizzato nonostante la cache")
+
+    monkeypatch.setattr(training, "prepare_for_training", fail)
+    second, collator = training.load_training_data(pad_tokenizer, 1024, "pack", d3_small, cache_dir=cache_dir)
+    assert _rows(second) == _rows(fresh)
+    assert isinstance(collator, training.PaddingCollator)
+
+
+def test_cache_key_fingerprint(d3_small, pad_tokenizer):
+    key = training.tokenized_cache_key(pad_tokenizer, 1024, "pack", d3_small)
+    assert key == training.tokenized_cache_key(pad_tokenizer, 1024, "pack", d3_small)
+
+    other_template = copy.deepcopy(pad_tokenizer)
+    other_template.chat_template = other_template.chat_template.replace("<|assistant|>", "<|assistant|>\n")
+    changed = [
+        training.tokenized_cache_key(pad_tokenizer, 2048, "pack", d3_small),
+        training.tokenized_cache_key(pad_tokenizer, 1024, "dynamic", d3_small),
+        training.tokenized_cache_key(pad_tokenizer, 1024, "pack", d3_small, system_text=prompts.SYSTEM_STRICT),
+        training.tokenized_cache_key(other_template, 1024, "pack", d3_small),
+    ]
+    assert key not in changed and len(set(changed)) == len(changed)
+
+    # una riga di D3 modificata (stessa dimensione del file) cambia il digest
+    with open(d3_small, "r+b") as f:
+        data = bytearray(f.read())
+        i = data.index(b"cup")
+        data[i : i + 3] = b"CUP"
+        f.seek(0)
+        f.write(data)
+    assert training.tokenized_cache_key(pad_tokenizer, 1024, "pack", d3_small) != key
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+from conftest import D1_CSV, D2_TXT
+from pipeline import d3_builder, splits, validation
+
+
+def _frame(rows):
+    return pd.DataFrame(rows, columns=["id", "title", "ingredients", "directions", "text"])
+
+
+GOOD = (1, "Egg Pie", ["2 eggs", "1 c. milk"], ["Beat the eggs with the milk.", "Bake until set."],
+        "Egg Pie\nBeat 2 eggs with 1 c. milk and bake until set.")
+
+
+def test_check_flags():
+    frame = _frame([
+        GOOD,
+        (2, "Egg Pie", ["2 eggs", "1 c. milk"], [""], "Egg Pie\nBeat 2 eggs with 1 c. milk."),
+        (3, "Beef Stew", ["2 eggs", "1 c. milk"], ["Beat the eggs with the milk."], "Lemon Cake\nBeat 2 eggs with milk."),
+        (4, "Egg Pie", ["2 eggs"], ["Beat the eggs."], "Egg Pie\nBeat 2 eggs.\nBeef Stew\nBrown the beef."),
+        (5, "Egg Pie", None, None, "Egg Pie\nBeat 2 eggs."),
+        (6, "Egg Pie", ["2 eggs"], ["Beat the eggs."], None),
+    ])
+    titles = pd.Series(["Egg Pie", "Beef Stew"])
+    report = validation.check(frame, titles=titles).set_index("id")
+    flagged = {rid: set(r.split(",")) - {""} for rid, r in zip(report.index, validation.reasons(report.reset_index()))}
+    assert flagged[1] == set()
+    assert "empty_directions" in flagged[2]
+    assert "title_mismatch" in flagged[3]
+    assert "merged_text" in flagged[4]
+    assert "unparseable" in flagged[5]
+    assert flagged[6] == {"missing_text"}
+
+
+@pytest.fixture(scope="module")
+def report():
+    return validation.validate_dataset()
+
+
+def test_blacklist_covered(report):
+    # ogni id della vecchia blacklist e' segnalato da check() o e' un'eccezione nota
+    flagged = set(report.loc[validation.corrupt(report), "id"].tolist())
+    missing = set(validation.BLACKLIST) - flagged - set(validation.KNOWN_EXCEPTIONS)
+    assert not missing, f"ricette della blacklist non piu' scartate: {sorted(missing)}"
+    assert set(validation.KNOWN_EXCEPTIONS) <= set(validation.BLACKLIST)
+
+
+def test_d3_drops_blacklist(tmp_path):
+    # stessi parametri di 2.Addestramento/training_dataset.py
+    out = tmp_path / "D3.csv"
+    stats = d3_builder.build_d3(D1_CSV, D2_TXT, str(out), start=0, stop=1001, exclude=validation.BLACKLIST,
+                                validate=True, workers=1, splits=("train", "validation"))
+    written = set(pd.read_csv(out)["id"])
+    assert stats["written"] == len(written) > 0
+    assert not written & set(validation.BLACKLIST)
+    assert not written & set(splits.ids_in("inference", "test"))